@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+"""
+Compare the encode and decode throughput of consecution's serialization codecs.
+
+Records are the rows of sample_data.csv, repeated to fill each batch, in the
+shapes an ETL pipeline typically moves between processes: dicts keyed by
+column name, plain tuples, and tuples with bytes fields for a fixed struct
+layout.  Each codec encodes and decodes whole batches, the way items cross
+the edges of a DistributedPipeline.
+
+    python benchmarks/codec_benchmark.py
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import os
+import time
+
+from consecution.serialization import (
+    MarshalCodec, MsgpackCodec, PickleCodec, StructCodec)
+
+
+SAMPLE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'sample_data.csv')
+
+
+def read_rows(num_rows):
+    # Parse the file repeatedly so every record is made of its own objects,
+    # as it would be when read from a real source.  Repeating the same
+    # objects would let pickle and marshal encode them as back-references.
+    with open(SAMPLE_FILE) as in_file:
+        header, body = in_file.readline(), in_file.readlines()
+    lines = [header] + (body * (num_rows // len(body) + 1))[:num_rows]
+    return [
+        {'gender': row['gender'], 'age': int(row['age']),
+         'spent': float(row['spent'])}
+        for row in csv.DictReader(lines)
+    ]
+
+
+def make_shapes(rows):
+    return [
+        ('dict', rows),
+        ('tuple', [(r['gender'], r['age'], r['spent']) for r in rows]),
+        ('struct', [
+            (r['gender'].encode('ascii'), r['age'], r['spent'])
+            for r in rows]),
+    ]
+
+
+def make_codecs():
+    codecs = [PickleCodec(), MarshalCodec()]
+    try:
+        codecs.append(MsgpackCodec())
+    except ImportError:
+        print('msgpack is not installed, so it is left out\n')
+    return codecs
+
+
+def time_codec(codec, batch, num_batches):
+    data = codec.dumps(batch)
+    starting = time.time()
+    for _ in range(num_batches):
+        codec.dumps(batch)
+    encode = time.time() - starting
+
+    starting = time.time()
+    for _ in range(num_batches):
+        codec.loads(data)
+    decode = time.time() - starting
+    return len(data), encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--batch-size', type=int, default=1000, help='records per batch')
+    parser.add_argument(
+        '--records', type=int, default=2000000,
+        help='records encoded and decoded for each codec and shape')
+    args = parser.parse_args()
+    num_batches = max(1, args.records // args.batch_size)
+    num_records = num_batches * args.batch_size
+
+    print('{: <8s} {: <20s} {: >12s} {: >14s} {: >14s}'.format(
+        'shape', 'codec', 'bytes/rec', 'encode rec/s', 'decode rec/s'))
+    codecs = make_codecs()
+    for shape, batch in make_shapes(read_rows(args.batch_size)):
+        shape_codecs = codecs
+        if shape == 'struct':
+            shape_codecs = codecs + [StructCodec('<6sqd')]
+        for codec in shape_codecs:
+            nbytes, encode, decode = time_codec(codec, batch, num_batches)
+            print('{: <8s} {: <20s} {: >12.1f} {: >14,.0f} {: >14,.0f}'.format(
+                shape, repr(codec), nbytes / float(args.batch_size),
+                num_records / encode, num_records / decode))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+"""
+Measure the overhead of running a pipeline with a MetricsReporter attached.
+
+A chain of trivial pass-through nodes is timed consuming the same items with
+and without a reporter, for several timing sample rates.  The difference is
+reported per node call, which is the cost the instrumentation adds to every
+node.
+
+    python benchmarks/metrics_benchmark.py
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from consecution import MetricsReporter, Node, Pipeline
+
+
+class Pass(Node):
+    def process(self, item):
+        self.push(item)
+
+
+class Sink(Node):
+    def process(self, item):
+        pass
+
+
+def make_pipeline(num_nodes):
+    nodes = [Pass('pass_{}'.format(ind)) for ind in range(num_nodes - 1)]
+    graph = nodes[0]
+    for node in nodes[1:]:
+        graph = graph | node
+    return Pipeline(graph | Sink('sink'))
+
+
+def run(num_nodes, num_items, sample_every):
+    pipe = make_pipeline(num_nodes)
+    reporter = None
+    if sample_every:
+        reporter = MetricsReporter(
+            pipe, interval=1., sample_every=sample_every)
+        reporter.start()
+    starting = time.perf_counter()
+    pipe.consume(range(num_items))
+    elapsed = time.perf_counter() - starting
+    if reporter is not None:
+        reporter.stop()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--nodes', type=int, default=5)
+    parser.add_argument('--items', type=int, default=200000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument(
+        '--sample-every', type=int, nargs='+', default=[1, 10, 100],
+        help='the sample_every settings of the reporter to time')
+    args = parser.parse_args()
+
+    def best(sample_every):
+        return min(
+            run(args.nodes, args.items, sample_every)
+            for _ in range(args.repeats))
+
+    calls = args.nodes * args.items
+    plain = best(0)
+    print('nodes: {}  items: {}'.format(args.nodes, args.items))
+    print('{: <22s} {: >14s} {: >14s}'.format(
+        'metrics', 'ns/node call', 'overhead ns'))
+    print('{: <22s} {: >14.1f} {: >14s}'.format(
+        'off', 1e9 * plain / calls, '-'))
+    for sample_every in args.sample_every:
+        elapsed = best(sample_every)
+        print('{: <22s} {: >14.1f} {: >14.1f}'.format(
+            'sample_every={}'.format(sample_every),
+            1e9 * elapsed / calls, 1e9 * (elapsed - plain) / calls))
+
+
+if __name__ == '__main__':
+    main()
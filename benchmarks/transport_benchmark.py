@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+"""
+Compare the throughput of moving items to a worker process with plain pickling
+against moving them with consecution's SharedMemoryTransport.
+
+Each item is a dict holding a float64 NumPy array, a bytes payload and an
+array.array.  The parent sends items through a multiprocessing Pipe and the
+worker loads each one, touches its buffers and acknowledges it.
+
+    python benchmarks/transport_benchmark.py
+"""
+from __future__ import print_function
+
+import argparse
+from array import array
+import multiprocessing
+import pickle
+import time
+
+import numpy
+
+from consecution.transport import SharedMemoryTransport
+
+
+def make_item(nbytes):
+    third = nbytes // 3
+    return {
+        'values': numpy.random.random(third // 8),
+        'raw': b'x' * third,
+        'counts': array('q', range(third // 8)),
+    }
+
+
+def touch(item):
+    return (
+        float(item['values'][-1]) + item['raw'][-1] + item['counts'][-1])
+
+
+def pickle_worker(conn):
+    while True:
+        frame = conn.recv_bytes()
+        if not frame:
+            break
+        conn.send(touch(pickle.loads(frame)))
+
+
+def shm_worker(transport, conn):
+    while True:
+        frame = conn.recv_bytes()
+        if not frame:
+            break
+        result = touch(transport.loads(frame))
+        transport.release(frame)
+        conn.send(result)
+    transport.close()
+
+
+def run(kind, item, num_items):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    if kind == 'pickle':
+        transport = None
+        proc = multiprocessing.Process(
+            target=pickle_worker, args=(child_conn,))
+
+        def dumps(obj):
+            return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        transport = SharedMemoryTransport()
+        proc = multiprocessing.Process(
+            target=shm_worker, args=(transport, child_conn))
+        dumps = transport.dumps
+
+    proc.start()
+    starting = time.time()
+    for _ in range(num_items):
+        parent_conn.send_bytes(dumps(item))
+        parent_conn.recv()
+    elapsed = time.time() - starting
+    parent_conn.send_bytes(b'')
+    proc.join()
+    if transport is not None:
+        transport.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--sizes', nargs='+', type=int,
+        default=[2 ** 14, 2 ** 18, 2 ** 22, 2 ** 25],
+        help='payload sizes in bytes')
+    parser.add_argument(
+        '--megabytes', type=int, default=512,
+        help='total megabytes moved for each size and transport')
+    args = parser.parse_args()
+
+    print('{: >12s} {: >12s} {: >12s} {: >9s}'.format(
+        'bytes/item', 'pickle MB/s', 'shm MB/s', 'speedup'))
+    for nbytes in args.sizes:
+        item = make_item(nbytes)
+        num_items = max(1, args.megabytes * 2 ** 20 // nbytes)
+        megabytes = num_items * nbytes / 2. ** 20
+        rates = [
+            megabytes / run(kind, item, num_items)
+            for kind in ['pickle', 'shm']
+        ]
+        print('{: >12d} {: >12.1f} {: >12.1f} {: >8.2f}x'.format(
+            nbytes, rates[0], rates[1], rates[1] / rates[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,25 @@
 # flake8: noqa
-from consecution.nodes import Node, GroupByNode
-from consecution.pipeline import Pipeline, GlobalState
+from consecution.nodes import (
+    Node, GroupByNode, StreamingGroupByNode, StopPipeline)
+from consecution.pipeline import Pipeline, PipelineTemplate, GlobalState
 from consecution.utils import Clock
+from consecution.batches import (
+    ColumnBatch, ToColumnBatch, FromColumnBatch, iter_batches)
+from consecution.transport import SharedMemoryTransport
+from consecution.errors import DeadLetter
+from consecution.control import Take, TakeWhile
+from consecution.ingest import ThreadedPusher
+from consecution.distributed import DistributedPipeline, RemoteError
+from consecution.serialization import (
+    Codec, PickleCodec, MarshalCodec, MsgpackCodec, StructCodec,
+    register_codec)
+from consecution.joins import HashJoin, MergeJoin
+from consecution.metrics import MetricsReporter
+from consecution.tracing import Tracer
+from consecution.recording import Recorder, Replay
+from consecution.shedding import Sampler, TokenBucket, AdaptiveShedder
+from consecution.timeouts import ProcessTimeout
+from consecution.tuning import BatchTuner
 
 __version__ = '0.2.0'
 
@@ -0,0 +1,358 @@
+from array import array
+from collections import OrderedDict
+from itertools import compress
+import time
+
+from consecution.nodes import Node
+from consecution.tuning import BatchTuner
+
+
+def _is_numpy_array(column):
+    return type(column).__module__ == 'numpy' and hasattr(column, 'dtype')
+
+
+_MIN_INT64, _MAX_INT64 = -2 ** 63, 2 ** 63 - 1
+
+
+def _infer_typecode(values):
+    """
+    Returns the array.array typecode that can hold all values, or None if the
+    values need to be kept in a plain list.
+    """
+    typecode = 'q'
+    for value in values:
+        if isinstance(value, bool):
+            return None
+        elif isinstance(value, int):
+            # ints too big for a signed 64 bit slot stay in a list
+            if not _MIN_INT64 <= value <= _MAX_INT64:
+                return None
+        elif isinstance(value, float):
+            typecode = 'd'
+        else:
+            return None
+    return typecode
+
+
+def _make_column(values, typecode=None, use_numpy=False):
+    if use_numpy:
+        # doing import inside function so that numpy dependency is optional
+        import numpy
+        return numpy.asarray(values)
+    if typecode is None:
+        typecode = _infer_typecode(values)
+    if typecode is None:
+        return list(values)
+    return array(typecode, values)
+
+
+class ColumnBatch(object):
+    """
+    :type columns: dict or list
+    :param columns: A mapping (or a list of ``(name, column)`` pairs) of column
+                    names to columns.  All columns must have the same length.
+
+    A ColumnBatch is a named set of equal-length columns.  Columns can be NumPy
+    arrays, ``array.array`` objects or, for non-numeric data, plain lists.
+    Pushing a single batch between nodes instead of one dict per row saves
+    allocating an object per record, and lets a node touch only the columns it
+    needs.
+
+    Filtering and projecting batches are slicing operations on the underlying
+    columns, so they never loop over rows in Python.
+
+    .. code-block:: python
+
+       from array import array
+       from consecution import ColumnBatch
+
+       batch = ColumnBatch([
+           ('age', array('q', [12, 45, 33])),
+           ('spent', array('d', [1.5, 20., 7.25])),
+       ])
+       adults = batch.filter([age >= 18 for age in batch['age']])
+       spent = adults.select('spent')
+    """
+    def __init__(self, columns):
+        self._columns = OrderedDict(columns)
+        lengths = {len(column) for column in self._columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(
+                'All columns of a ColumnBatch must have the same length. '
+                'Got lengths {}'.format(
+                    {name: len(c) for (name, c) in self._columns.items()})
+            )
+        self._length = lengths.pop() if lengths else 0
+
+    @classmethod
+    def from_records(
+            cls, records, names=None, typecodes=None, use_numpy=False):
+        """
+        Build a batch from an iterable of dict-like records.
+
+        :type records: iterable
+        :param records: The dicts to turn into columns
+
+        :type names: list
+        :param names: The fields to extract.  Defaults to the keys of the first
+                      record.
+
+        :type typecodes: dict
+        :param typecodes: An optional mapping of field names to
+                          ``array.array`` typecodes.  Fields without a typecode
+                          are stored in an ``array.array`` if all their values
+                          are ints or floats, and in a list otherwise.
+
+        :type use_numpy: Bool
+        :param use_numpy: Store every column as a NumPy array
+
+        :rtype: ColumnBatch
+        :return: A batch holding the records
+        """
+        records = list(records)
+        if names is None:
+            names = list(records[0].keys()) if records else []
+        typecodes = typecodes or {}
+        return cls([
+            (
+                name,
+                _make_column(
+                    [rec[name] for rec in records],
+                    typecodes.get(name), use_numpy)
+            )
+            for name in names
+        ])
+
+    @property
+    def names(self):
+        """
+        A list of the column names in this batch.
+        """
+        return list(self._columns.keys())
+
+    @property
+    def columns(self):
+        """
+        An ordered dict mapping column names to columns.
+        """
+        return OrderedDict(self._columns)
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._new([
+                (name, column[key]) for (name, column) in self._columns.items()
+            ])
+        return self._columns[key]
+
+    def __str__(self):
+        return 'ColumnBatch(rows={}, names={})'.format(len(self), self.names)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def _new(self, columns):
+        return self.__class__(columns)
+
+    def select(self, *names):
+        """
+        Project the batch onto the named columns.  No column data is copied.
+
+        :type names: str
+        :param names: The names of the columns to keep
+
+        :rtype: ColumnBatch
+        :return: A batch holding only the named columns
+        """
+        return self._new([(name, self._columns[name]) for name in names])
+
+    def with_column(self, name, column):
+        """
+        Return a new batch with a column added (or replaced).
+
+        :type name: str
+        :param name: The name of the column
+
+        :type column: sequence
+        :param column: A column the same length as this batch
+
+        :rtype: ColumnBatch
+        :return: A batch with the extra column
+        """
+        columns = OrderedDict(self._columns)
+        columns[name] = column
+        return self._new(columns)
+
+    def filter(self, mask):
+        """
+        Keep only the rows where ``mask`` is true.  NumPy columns are filtered
+        with boolean indexing and ``array.array`` columns with
+        ``itertools.compress``, so there is no per-row Python loop.
+
+        :type mask: sequence
+        :param mask: A sequence of booleans, one per row
+
+        :rtype: ColumnBatch
+        :return: A batch holding the selected rows
+        """
+        if len(mask) != len(self):
+            raise ValueError(
+                'Mask has length {} but batch has length {}'.format(
+                    len(mask), len(self)))
+        return self._new([
+            (name, self._filter_column(column, mask))
+            for (name, column) in self._columns.items()
+        ])
+
+    def _filter_column(self, column, mask):
+        if _is_numpy_array(column):
+            import numpy
+            return column[numpy.asarray(mask, dtype=bool)]
+        elif isinstance(column, array):
+            return array(column.typecode, compress(column, mask))
+        else:
+            return list(compress(column, mask))
+
+    def take(self, indices):
+        """
+        Return the rows at the given positions.
+
+        :type indices: sequence
+        :param indices: The integer row positions to take
+
+        :rtype: ColumnBatch
+        :return: A batch holding the selected rows
+        """
+        indices = list(indices)
+        return self._new([
+            (name, self._take_column(column, indices))
+            for (name, column) in self._columns.items()
+        ])
+
+    def _take_column(self, column, indices):
+        if _is_numpy_array(column):
+            return column[indices]
+        values = [column[ind] for ind in indices]
+        if isinstance(column, array):
+            return array(column.typecode, values)
+        return values
+
+    def iter_records(self):
+        """
+        Iterate over the rows of this batch as dicts.
+
+        :rtype: generator
+        :return: A generator of one dict per row
+        """
+        names = self.names
+        columns = [
+            column.tolist() if hasattr(column, 'tolist') else column
+            for column in self._columns.values()
+        ]
+        for row in zip(*columns):
+            yield dict(zip(names, row))
+
+    def to_records(self):
+        """
+        :rtype: list
+        :return: A list of one dict per row
+        """
+        return list(self.iter_records())
+
+
+def iter_batches(records, batch_size, **kwargs):
+    """
+    Chunk an iterable of records into ColumnBatches.
+
+    :type records: iterable
+    :param records: An iterable of dict-like records
+
+    :type batch_size: int
+    :param batch_size: The maximum number of rows in each batch
+
+    :type kwargs: keyword args
+    :param kwargs: Passed on to ``ColumnBatch.from_records``
+
+    :rtype: generator
+    :return: A generator of ColumnBatch objects
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == batch_size:
+            yield ColumnBatch.from_records(chunk, **kwargs)
+            chunk = []
+    if chunk:
+        yield ColumnBatch.from_records(chunk, **kwargs)
+
+
+class ToColumnBatch(Node):
+    """
+    :type name: str
+    :param name: The name of this node
+
+    :type batch_size: int or BatchTuner
+    :param batch_size: The number of records collected into each batch, or a
+                       tuner that picks it
+
+    :type kwargs: keyword args
+    :param kwargs: Passed on to ``ColumnBatch.from_records``
+
+    This node collects dict-like records and pushes them downstream as
+    ColumnBatch objects.  A final partial batch is pushed when the node ends.
+
+    With a ``BatchTuner`` the time taken to build each batch and process it
+    downstream is measured, and the batch size follows the tuner.
+    """
+    def __init__(self, name, batch_size=1000, **kwargs):
+        super(ToColumnBatch, self).__init__(name)
+        if isinstance(batch_size, BatchTuner):
+            self.batch_tuner, batch_size = batch_size, batch_size.size
+        self.batch_size = batch_size
+        self._batch_kwargs = kwargs
+        self._records = []
+
+    def process(self, item):
+        self._records.append(item)
+        if len(self._records) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._records:
+            records, self._records = self._records, []
+            if self.batch_tuner is None:
+                self.push(ColumnBatch.from_records(records, **self._batch_kwargs))
+                return
+            start = time.perf_counter()
+            self.push(ColumnBatch.from_records(records, **self._batch_kwargs))
+            self.batch_size = self.batch_tuner.record(
+                len(records), time.perf_counter() - start)
+
+    def end(self):
+        self._flush()
+
+    def reset(self):
+        self._records = []
+
+    def _fresh_copy(self):
+        node = super(ToColumnBatch, self)._fresh_copy()
+        node._records = []
+        if node.batch_tuner is not None:
+            node.batch_tuner = node.batch_tuner.copy()
+            node.batch_size = node.batch_tuner.size
+        return node
+
+
+class FromColumnBatch(Node):
+    """
+    This node turns every ColumnBatch it receives back into dict records and
+    pushes them downstream one at a time.
+    """
+    def process(self, batch):
+        for record in batch.iter_records():
+            self.push(record)
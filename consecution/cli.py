@@ -0,0 +1,208 @@
+"""
+Run a pipeline over standard input from the command line.
+
+    python -m consecution run my_module:make_pipeline < data.csv
+"""
+import argparse
+import cProfile
+import importlib
+import itertools
+import pstats
+import sys
+import time
+
+from consecution.metrics import MetricsCollector
+from consecution.pipeline import Pipeline
+
+
+def iter_line_batches(stream, buffer_size=1 << 20, encoding='utf-8'):
+    """
+    :type stream: file
+    :param stream: A file opened in binary mode
+
+    :type buffer_size: int
+    :param buffer_size: The number of bytes read at a time
+
+    :type encoding: str
+    :param encoding: The encoding the lines are decoded with.  If None, lines
+                     are left as bytes.
+
+    :rtype: generator
+    :return: A generator of lists of lines, without their newlines
+
+    Reads a stream in large blocks and splits each block into lines with a
+    single ``.split()`` call, which is much faster than iterating a text file
+    line by line.  A line that is cut off at the end of a block is carried
+    over to the next one.  Lines end at ``\\n`` only.
+    """
+    read = stream.read
+    tail = b''
+    while True:
+        block = read(buffer_size)
+        if not block:
+            break
+        if tail:
+            block = tail + block
+        last = block.rfind(b'\n')
+        if last < 0:
+            tail = block
+            continue
+        tail = block[last + 1:]
+        block = block[:last]
+        if encoding is None:
+            yield block.split(b'\n')
+        else:
+            yield block.decode(encoding).split('\n')
+    if tail:
+        yield [tail if encoding is None else tail.decode(encoding)]
+
+
+def _counted(line_batches, num_lines):
+    # lines are counted a block at a time, not one by one
+    for lines in line_batches:
+        num_lines[0] += len(lines)
+        yield lines
+
+
+def _rebatch(line_batches, batch_size):
+    # lists of exactly batch_size lines, except for the last one
+    pending = []
+    for lines in line_batches:
+        pending.extend(lines)
+        if len(pending) < batch_size:
+            continue
+        stop = len(pending) - len(pending) % batch_size
+        for start in range(0, stop, batch_size):
+            yield pending[start:start + batch_size]
+        pending = pending[stop:]
+    if pending:
+        yield pending
+
+
+def load_pipeline(spec):
+    """
+    :type spec: str
+    :param spec: A ``'module:factory'`` string naming a function that takes
+                 no arguments and returns a Pipeline, or a Node to build one
+                 from
+
+    :rtype: Pipeline
+    :return: The pipeline made by the factory
+    """
+    module_name, _, factory_name = spec.partition(':')
+    if not module_name or not factory_name:
+        raise ValueError(
+            '\n\nThe factory must be given as module:function.  '
+            'Got {}\n'.format(repr(spec)))
+    module = importlib.import_module(module_name)
+    pipeline = getattr(module, factory_name)()
+    if not isinstance(pipeline, Pipeline):
+        pipeline = Pipeline(pipeline)
+    return pipeline
+
+
+def _stats_report(collector, num_lines, seconds):
+    lines = ['{: <25s} {: >12s} {: >12s} {: >14s}'.format(
+        'node', 'items', 'seconds', 'us/item')]
+    for name, counters in collector.counters.items():
+        lines.append('{: <25s} {: >12d} {: >12.3f} {: >14.2f}'.format(
+            name, counters.items, counters.seconds,
+            1e6 * counters.seconds / max(counters.timed, 1)))
+    lines.append('')
+    lines.append('{} lines in {:.3f} seconds, {:,.0f} lines/second'.format(
+        num_lines, seconds, num_lines / max(seconds, 1e-9)))
+    return '\n'.join(lines) + '\n'
+
+
+def run(args, stdin, stdout, stderr):
+    pipeline = load_pipeline(args.factory)
+    collector = None
+    if args.stats:
+        collector = MetricsCollector()
+        pipeline.add_process_wrapper(collector.wrap_node)
+
+    num_lines = [0]
+    line_batches = _counted(iter_line_batches(
+        stdin, args.buffer_size, None if args.bytes else args.encoding),
+        num_lines)
+    if args.batch_size:
+        items = _rebatch(line_batches, args.batch_size)
+    else:
+        items = itertools.chain.from_iterable(line_batches)
+
+    profiler = cProfile.Profile() if args.profile else None
+    starting = time.time()
+    if profiler is not None:
+        profiler.enable()
+    result = pipeline.consume(items)
+    if profiler is not None:
+        profiler.disable()
+    seconds = time.time() - starting
+
+    if result is not None:
+        print(result, file=stdout)
+    if collector is not None:
+        stderr.write(_stats_report(collector, num_lines[0], seconds))
+    if profiler is not None:
+        stats = pstats.Stats(profiler, stream=stderr)
+        stats.sort_stats(args.sort).print_stats(args.limit)
+    return result
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m consecution',
+        description='Run consecution pipelines from the command line.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser(
+        'run', help='Feed the lines of stdin through a pipeline.',
+        description=(
+            'Feed the lines of stdin, without their newlines, through the '
+            'pipeline made by a factory.  Whatever the pipeline\'s .end() '
+            'returns is printed.'))
+    run_parser.add_argument(
+        'factory',
+        help='module:function returning a Pipeline or the Node to build one '
+             'from')
+    run_parser.add_argument(
+        '--batch-size', type=int, default=0,
+        help='push lists of this many lines instead of single lines')
+    run_parser.add_argument(
+        '--buffer-size', type=int, default=1 << 20,
+        help='bytes read from stdin at a time (default: %(default)s)')
+    run_parser.add_argument(
+        '--encoding', default='utf-8',
+        help='the encoding of stdin (default: %(default)s)')
+    run_parser.add_argument(
+        '--bytes', action='store_true',
+        help='push lines as undecoded bytes')
+    run_parser.add_argument(
+        '--stats', action='store_true',
+        help='write the items and time of every node to stderr')
+    run_parser.add_argument(
+        '--profile', action='store_true',
+        help='run under cProfile and write the profile to stderr')
+    run_parser.add_argument(
+        '--sort', default='cumulative',
+        help='the sort order of the profile (default: %(default)s)')
+    run_parser.add_argument(
+        '--limit', type=int, default=30,
+        help='the number of profile rows written (default: %(default)s)')
+    return parser
+
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    """
+    The entry point of ``python -m consecution``.
+
+    :type argv: list
+    :param argv: The command-line arguments.  Defaults to ``sys.argv[1:]``.
+
+    :return: Whatever the pipeline's ``.end()`` method returns
+    """
+    args = make_parser().parse_args(argv)
+    if stdin is None:
+        stdin = sys.stdin.buffer
+    return run(args, stdin, stdout or sys.stdout, stderr or sys.stderr)
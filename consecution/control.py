@@ -0,0 +1,69 @@
+from consecution.nodes import Node, StopPipeline
+
+
+class Take(Node):
+    """
+    :type name: str
+    :param name: The name of this node
+
+    :type limit: int
+    :param limit: The number of items to let through
+
+    This node pushes the first ``limit`` items it receives and then stops the
+    pipeline, so no more items are read from the source.  Items that still
+    reach it afterwards, for example from the ``.end()`` methods of nodes
+    upstream, are dropped.
+
+    .. code-block:: python
+
+       from consecution import Pipeline, Take
+
+       pipe = Pipeline(Take('first_ten', 10) | Printer('printer'))
+       pipe.consume(endless_generator())
+    """
+    def __init__(self, name, limit, **kwargs):
+        super(Take, self).__init__(name, **kwargs)
+        self.limit = limit
+        self.count = 0
+        self._stopped = False
+
+    def begin(self):
+        self.count = 0
+        self._stopped = False
+
+    def process(self, item):
+        if self.count < self.limit:
+            self.count += 1
+            self.push(item)
+        if self.count >= self.limit and not self._stopped:
+            self._stopped = True
+            raise StopPipeline()
+
+
+class TakeWhile(Node):
+    """
+    :type name: str
+    :param name: The name of this node
+
+    :type predicate: callable
+    :param predicate: A function of an item returning a boolean
+
+    This node pushes items for as long as ``predicate(item)`` is true.  The
+    first item for which it is false is dropped and the pipeline is stopped.
+    Items that still reach it afterwards are dropped too.
+    """
+    def __init__(self, name, predicate, **kwargs):
+        super(TakeWhile, self).__init__(name, **kwargs)
+        self.predicate = predicate
+        self._stopped = False
+
+    def begin(self):
+        self._stopped = False
+
+    def process(self, item):
+        if self._stopped:
+            return
+        if not self.predicate(item):
+            self._stopped = True
+            raise StopPipeline()
+        self.push(item)
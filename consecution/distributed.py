@@ -0,0 +1,687 @@
+from multiprocessing import connection
+import marshal
+import multiprocessing
+import time
+import traceback
+
+from consecution.nodes import Node, StopPipeline, _RouterNode
+from consecution.pipeline import Pipeline
+from consecution.serialization import get_codec
+from consecution.tuning import BatchTuner
+
+
+# an empty frame tells the receiving side that no more items will come
+_END = b''
+
+
+class RemoteError(RuntimeError):
+    """
+    Raised by a ``DistributedPipeline`` when a partition process fails.  The
+    message holds the traceback from the failing process.
+    """
+
+
+class _Disconnected(Exception):
+    """
+    Raised when the process at the other end of a channel has gone away.  It
+    failed for a reason of its own, which it reports to the coordinator.
+    """
+
+
+class _Channel(object):
+    """
+    Batches the items bound for one partition process into frames.  Items
+    are collected in ``(target_name, items)`` runs, so consecutive items for
+    the same target cost one list append each, and the order of items across
+    targets is kept.  Each run is encoded with the codec of its edge, and a
+    frame is the marshalled list of ``(target_name, encoded_run)`` pairs.
+    Connections add a length prefix to each frame.
+
+    Given a BatchTuner, the channel tunes its frame size with a copy of its
+    own.  The time to encode and send a frame is the processing time, and
+    the time from its first item to its sending the latency.
+    """
+    def __init__(self, conn, batch_size, codecs):
+        self.conn = conn
+        self.batch_tuner = None
+        if isinstance(batch_size, BatchTuner):
+            self.batch_tuner = batch_size.copy()
+            batch_size = self.batch_tuner.size
+        self.batch_size = batch_size
+        self.codecs = codecs
+        self._runs = []
+        self._count = 0
+        self._started = None
+
+    def put(self, name, item):
+        """
+        Add an item to the current frame.  Returns True if the frame was
+        full and got sent.
+        """
+        runs = self._runs
+        if runs and runs[-1][0] == name:
+            runs[-1][1].append(item)
+        else:
+            if not runs and self.batch_tuner is not None:
+                self._started = time.perf_counter()
+            runs.append((name, [item]))
+        self._count += 1
+        if self._count >= self.batch_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if self._runs:
+            codecs = self.codecs
+            start = time.perf_counter()
+            self._send(marshal.dumps([
+                (name, codecs[name].dumps(items))
+                for (name, items) in self._runs
+            ]))
+            if self.batch_tuner is not None:
+                now = time.perf_counter()
+                self.batch_size = self.batch_tuner.record(
+                    self._count, now - start, now - self._started)
+            self._runs = []
+            self._count = 0
+
+    def close(self):
+        self.flush()
+        self._send(_END)
+        self.conn.close()
+
+    def _send(self, frame):
+        try:
+            self.conn.send_bytes(frame)
+        except OSError:
+            raise _Disconnected()
+
+
+class _Inlet(Node):
+    """
+    Stands in for an upstream node that runs in another process.  It has the
+    name of that node, so join nodes can still tell their inputs apart.
+    """
+    def process(self, item):
+        self.push(item)
+
+
+class _Outlet(Node):
+    """
+    Stands in for the downstream nodes of a node that run in another process.
+    """
+    def __init__(self, name, target, channel):
+        super(_Outlet, self).__init__(name)
+        self._target = target
+        self._put = channel.put
+
+    def process(self, item):
+        self._put(self._target, item)
+
+
+def _link(upstream, downstream):
+    # the graph was validated when the partitions were planned, so there is
+    # no need to go through add_downstream
+    upstream._downstream_nodes.append(downstream)
+    downstream._upstream_nodes.append(upstream)
+
+
+class _Partition(object):
+    """
+    The part of the graph that runs in one process.
+
+    :ivar index: The position of the partition in the list of partitions
+    :ivar nodes: The nodes of the original graph that run here
+    :ivar partition_of: A dict mapping every node name to its partition index
+    :ivar inlets: A dict mapping the names of upstream nodes in other
+                  partitions to the names of the nodes here they feed
+    :ivar roots: The names of the root nodes fed by the coordinator
+    :ivar upstreams: The partitions that send items here
+    :ivar downstreams: The partitions items are sent to from here
+    :ivar codecs: A dict mapping ``(target_name, partition_index)`` pairs to
+                  the codec of the items sent to that target.  It is shared
+                  by all partitions.
+    """
+    def __init__(self, index, nodes, partition_of, batch_size, global_state):
+        self.index = index
+        self.nodes = nodes
+        self.partition_of = partition_of
+        self.batch_size = batch_size
+        self.global_state = global_state
+        self.inlets = {}
+        self.roots = [n.name for n in nodes if not n._upstream_nodes]
+        self.upstreams = set()
+        self.downstreams = set()
+        self.codecs = {}
+
+    def codecs_for(self, index):
+        """
+        :rtype: dict
+        :return: The codecs of the items sent to a partition, keyed by
+                 target name
+        """
+        return {
+            name: codec for ((name, target), codec) in self.codecs.items()
+            if target == index
+        }
+
+    @property
+    def num_inbound(self):
+        """
+        The number of connections items arrive on.  The coordinator makes
+        one to every partition holding a root node.
+        """
+        return len(self.upstreams) + (1 if self.roots else 0)
+
+    def build(self, channels):
+        """
+        Build a pipeline from fresh copies of the nodes of this partition.
+
+        :type channels: dict
+        :param channels: A dict mapping downstream partition indexes to the
+                         channels that send items to them
+
+        :rtype: Pipeline
+        :return: The pipeline running this partition
+        """
+        copies = {node.name: node._fresh_copy() for node in self.nodes}
+        outlets = {}
+        for node in self.nodes:
+            for downstream in node._downstream_nodes:
+                if downstream.name in copies:
+                    _link(copies[node.name], copies[downstream.name])
+                    continue
+                index = self.partition_of[downstream.name]
+                name = '{}.to_partition_{}'.format(node.name, index)
+                if name not in outlets:
+                    outlets[name] = _Outlet(name, node.name, channels[index])
+                    _link(copies[node.name], outlets[name])
+
+        for upstream_name, names in sorted(self.inlets.items()):
+            inlet = _Inlet(upstream_name)
+            for name in names:
+                _link(inlet, copies[name])
+
+        # point routing nodes at the new copies of their end points
+        for node in copies.values():
+            if hasattr(node, '_end_point_map'):
+                node._end_point_map = {
+                    name: copies[name] for name in node._end_point_map
+                }
+        return Pipeline(copies[self.nodes[0].name],
+                        global_state=self.global_state)
+
+    def run(self, listener, addresses, control, authkey):
+        """
+        Connect to the neighbouring partitions, then run the pipeline of this
+        partition until every inbound connection has ended.
+
+        :type listener: multiprocessing.connection.Listener
+        :param listener: The listener this partition accepts inbound
+                         connections on
+
+        :type addresses: list
+        :param addresses: The listener addresses of all partitions
+
+        :type control: multiprocessing.connection.Connection
+        :param control: The connection status messages are sent to the
+                        coordinator on
+        """
+        channels = {
+            index: _Channel(
+                connection.Client(addresses[index], authkey=authkey),
+                self.batch_size, self.codecs_for(index))
+            for index in sorted(self.downstreams)
+        }
+        inbound = [listener.accept() for _ in range(self.num_inbound)]
+
+        pipeline = self.build(channels)
+        pipeline.begin()
+        control.send(('ready', None))
+        self.serve(pipeline, inbound, channels, control)
+        pipeline.end()
+
+        # downstream partitions end only once every upstream one has ended
+        for channel in channels.values():
+            channel.close()
+        tuners = {
+            'partition_{}.to_partition_{}'.format(self.index, index):
+                channel.batch_tuner
+            for (index, channel) in channels.items()
+            if channel.batch_tuner is not None
+        }
+        if tuners:
+            control.send(('tuners', tuners))
+        control.send(('done', pipeline.global_state))
+
+    def serve(self, pipeline, inbound, channels, control):
+        """
+        Process the frames arriving on the inbound connections until each of
+        them has sent its end frame.
+        """
+        targets = {
+            name: (pipeline[name]._process, codec.loads)
+            for (name, codec) in self.codecs_for(self.index).items()
+        }
+        is_stopped = False
+        while inbound:
+            for conn in connection.wait(inbound):
+                frame = conn.recv_bytes()
+                if frame == _END:
+                    inbound.remove(conn)
+                    conn.close()
+                    continue
+                # once a node stops the pipeline, frames are only drained
+                if is_stopped:
+                    continue
+                try:
+                    for name, data in marshal.loads(frame):
+                        process, loads = targets[name]
+                        for item in loads(data):
+                            process(item)
+                except StopPipeline:
+                    is_stopped = True
+                    control.send(('stop', None))
+
+                # a frame that arrived is passed on without waiting for more
+                for channel in channels.values():
+                    channel.flush()
+
+
+def _run_partition(partition, listener, addresses, control, authkey):  # pragma: no cover  runs in a child process
+    try:
+        partition.run(listener, addresses, control, authkey)
+    except _Disconnected:
+        control.send(('broken', None))
+    except Exception:
+        control.send(('error', traceback.format_exc()))
+
+
+def _assign(nodes, partitions):
+    # map node names to the index of the partition they run in
+    partition_of = {}
+    for index, names in enumerate(partitions):
+        if not names:
+            raise ValueError('\n\nPartition {} is empty\n'.format(index))
+        for name in names:
+            if name not in nodes:
+                raise ValueError(
+                    '\n\nNode {} is not in the pipeline\n'.format(repr(name)))
+            if name in partition_of:
+                raise ValueError(
+                    '\n\nNode {} is in more than one partition\n'.format(
+                        repr(name)))
+            partition_of[name] = index
+
+    for name in sorted(nodes):
+        if name not in partition_of and not isinstance(
+                nodes[name], _RouterNode):
+            raise ValueError(
+                '\n\nNode {} is not in any partition\n'.format(repr(name)))
+    _assign_routers(nodes, partition_of)
+    return partition_of
+
+
+def _assign_routers(nodes, partition_of):
+    # Routers call the nodes they route to directly, so they run in the same
+    # process.  Routers made by the connection mini-language are not named by
+    # the user, so they don't need to be listed.
+    for name, node in sorted(nodes.items()):
+        if not isinstance(node, _RouterNode):
+            continue
+        indexes = {partition_of[n.name] for n in node._downstream_nodes}
+        if name in partition_of:
+            indexes.add(partition_of[name])
+        if len(indexes) > 1:
+            raise ValueError(
+                '\n\nRouter node {} and the nodes it routes to must be in the '
+                'same partition\n'.format(repr(name)))
+        partition_of[name] = indexes.pop()
+
+
+def _check_acyclic(parts):
+    # A partition ends once all of its upstream partitions have, so a cycle
+    # between partitions would never end.
+    in_degree = {part.index: len(part.upstreams) for part in parts}
+    ready = [index for (index, degree) in in_degree.items() if not degree]
+    num_done = 0
+    while ready:
+        num_done += 1
+        for index in parts[ready.pop()].downstreams:
+            in_degree[index] -= 1
+            if not in_degree[index]:
+                ready.append(index)
+    if num_done < len(parts):
+        raise ValueError(
+            '\n\nItems must not flow from a partition back into a partition '
+            'upstream of it\n')
+
+
+def _check_connected(part):
+    # union-find over the nodes of the partition and its inlets
+    parent = {node.name: node.name for node in part.nodes}
+    parent.update({('inlet', name): ('inlet', name) for name in part.inlets})
+
+    def find(key):
+        while parent[key] != key:
+            key = parent[key]
+        return key
+
+    edges = [(node.name, downstream.name)
+             for node in part.nodes
+             for downstream in node._downstream_nodes
+             if downstream.name in parent]
+    edges.extend((('inlet', upstream_name), name)
+                 for (upstream_name, names) in part.inlets.items()
+                 for name in names)
+    for left, right in edges:
+        parent[find(left)] = find(right)
+    if len({find(key) for key in parent}) > 1:
+        raise ValueError(
+            '\n\nThe nodes of partition {} do not form a connected graph\n'
+            .format(part.index))
+
+
+def _edge_codecs(nodes, partition_of, root_name, codecs, default_codec):
+    # All edges from one node into another partition share its connection,
+    # so they must share a codec.  The coordinator feeds the root as None.
+    edges = [(None, root_name)] + [
+        (name, downstream.name)
+        for (name, node) in nodes.items()
+        for downstream in node._downstream_nodes
+        if partition_of[name] != partition_of[downstream.name]
+    ]
+    specs, unused = {}, set(codecs)
+    for upstream, downstream in edges:
+        for key in [(upstream, downstream), upstream]:
+            if key in codecs:
+                spec = codecs[key]
+                unused.discard(key)
+                break
+        else:
+            spec = default_codec
+        name = downstream if upstream is None else upstream
+        target = (name, partition_of[downstream])
+        if specs.setdefault(target, spec) != spec:
+            raise ValueError(
+                '\n\nEdges from {} into partition {} share a connection and '
+                'must use the same codec\n'.format(repr(upstream), target[1]))
+    if unused:
+        raise ValueError(
+            '\n\nCodecs were given for {}, which are not edges between '
+            'partitions\n'.format(sorted(unused, key=repr)))
+    return {target: get_codec(spec) for (target, spec) in specs.items()}
+
+
+def _plan(pipeline, partitions, batch_size, codecs, default_codec):
+    nodes = {node.name: node for node in pipeline.top_node.all_nodes}
+    partition_of = _assign(nodes, partitions)
+    parts = [
+        _Partition(
+            index,
+            sorted(n for n in nodes.values() if partition_of[n.name] == index),
+            partition_of, batch_size, pipeline.global_state)
+        for index in range(len(partitions))
+    ]
+    for node in nodes.values():
+        source = partition_of[node.name]
+        for downstream in node._downstream_nodes:
+            target = partition_of[downstream.name]
+            if source != target:
+                parts[target].inlets.setdefault(node.name, []).append(
+                    downstream.name)
+                parts[target].upstreams.add(source)
+                parts[source].downstreams.add(target)
+    _check_acyclic(parts)
+    for part in parts:
+        _check_connected(part)
+
+    edge_codecs = _edge_codecs(
+        nodes, partition_of, pipeline.root_nodes[0].name, codecs or {},
+        default_codec)
+    for part in parts:
+        part.codecs = edge_codecs
+    return parts
+
+
+class DistributedPipeline(object):
+    """
+    :type pipeline: Pipeline
+    :param pipeline: The pipeline to run.  It must have a single root node.
+
+    :type partitions: list
+    :param partitions: A list of lists of node names.  Each list is a
+                       partition of the graph that runs in its own process.
+                       Router nodes made by the connection mini-language join
+                       the partition of the nodes they route to and need not
+                       be listed.
+
+    :type batch_size: int or BatchTuner
+    :param batch_size: The most items sent in one frame, or a tuner that
+                       picks it.  Every connection tunes its frames with a
+                       copy of the tuner.  The copies are collected in
+                       ``.batch_tuners`` when the pipeline ends.
+
+    :type family: str
+    :param family: 'AF_UNIX' to connect the processes with Unix domain
+                   sockets or 'AF_INET' to use TCP sockets on localhost
+
+    :type codecs: dict
+    :param codecs: Codecs for the edges between partitions, given as codec
+                   names or objects.  A key is either an
+                   ``(upstream_name, downstream_name)`` edge, or the name of
+                   an upstream node to set the codec of all its edges.  The
+                   edge from the coordinator to the root node is
+                   ``(None, root_name)``.
+
+    :type default_codec: str or Codec
+    :param default_codec: The codec of every other edge
+
+    Runs the partitions of a pipeline's graph in separate processes, so that
+    one pipeline can use every core of a machine.  Items crossing from one
+    partition to another are encoded in batches and sent as length-prefixed
+    frames over a socket.  The process calling ``.push()`` or ``.consume()``
+    is the coordinator.  It feeds the root node and runs no nodes itself.
+
+    The ``.begin()`` methods of every partition are called before any item is
+    sent.  A partition ends once every partition upstream of it has, so the
+    ``.end()`` methods are called in top-down order across the processes,
+    just as they are in a single process.  An error in any process stops all
+    of them and is raised by the coordinator as a ``RemoteError``.  Each
+    process works on its own copy of the global state.  The copies are sent
+    back when the pipeline ends and kept in ``.global_states``, indexed by
+    partition.
+
+    The worker processes are forked, so this needs a platform that can fork.
+
+    .. code-block:: python
+
+       from consecution import DistributedPipeline
+
+       pipe = Pipeline(parse | enrich | [score, archive])
+       dist = DistributedPipeline(
+           pipe, [['parse', 'enrich'], ['score'], ['archive']])
+       dist.consume(read_records())
+       print(dist.global_states)
+    """
+    def __init__(self, pipeline, partitions, batch_size=1000,
+                 family='AF_UNIX', codecs=None, default_codec='pickle'):
+        roots = pipeline.root_nodes
+        if len(roots) != 1:
+            raise ValueError(
+                '\n\nA distributed pipeline must have a single root node.  '
+                'Found {}\n'.format([n.name for n in roots]))
+        if family not in ('AF_UNIX', 'AF_INET'):
+            raise ValueError(
+                '\n\nfamily must be \'AF_UNIX\' or \'AF_INET\'.  Got {}\n'
+                .format(repr(family)))
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.family = family
+        self._root_name = roots[0].name
+        self._partitions = _plan(
+            pipeline, partitions, batch_size, codecs, default_codec)
+        self.global_states = [None] * len(self._partitions)
+        self.batch_tuners = {}
+        self._is_running = False
+        self._is_stopped = False
+        self._processes = []
+        # partitions that lost a downstream and wait for its error report
+        self._broken = set()
+
+    def begin(self):
+        """
+        Start a process for each partition and wait until all of them have
+        begun.
+        """
+        context = multiprocessing.get_context('fork')
+        authkey = multiprocessing.current_process().authkey
+        self._listeners = [
+            connection.Listener(
+                family=self.family, backlog=part.num_inbound,
+                authkey=authkey)
+            for part in self._partitions
+        ]
+        addresses = [listener.address for listener in self._listeners]
+        self._controls = []
+        self._processes = []
+        for part in self._partitions:
+            control, child_control = context.Pipe(duplex=False)
+            process = context.Process(
+                target=_run_partition,
+                args=(part, self._listeners[part.index], addresses,
+                      child_control, authkey),
+                name='consecution-partition-{}'.format(part.index))
+            process.daemon = True
+            process.start()
+            child_control.close()
+            self._controls.append(control)
+            self._processes.append(process)
+
+        root_index = self._partitions[0].partition_of[self._root_name]
+        self._feed = _Channel(
+            connection.Client(addresses[root_index], authkey=authkey),
+            self.batch_size, {
+                self._root_name:
+                    self._partitions[0].codecs[(self._root_name, root_index)]
+            })
+        self.global_states = [None] * len(self._partitions)
+        self.batch_tuners = {}
+        if self._feed.batch_tuner is not None:
+            self.batch_tuners['coordinator.to_partition_{}'.format(
+                root_index)] = self._feed.batch_tuner
+        self._is_running = True
+        self._is_stopped = False
+        self._broken = set()
+        self._wait_for('ready')
+
+    def _wait_for(self, kind):
+        # block until every partition that is not broken has sent a message
+        # of this kind
+        waiting = set(range(len(self._partitions))) - self._broken
+        while waiting:
+            for control in connection.wait(
+                    [self._controls[index] for index in waiting]):
+                index = self._controls.index(control)
+                if self._handle(index) in (kind, 'broken'):
+                    waiting.discard(index)
+
+    def _poll(self):
+        # a broken partition has exited, so its control pipe only reads EOF
+        for index, control in enumerate(self._controls):
+            while index not in self._broken and control.poll():
+                self._handle(index)
+
+    def _handle(self, index):
+        try:
+            kind, value = self._controls[index].recv()
+        except EOFError:
+            kind, value = 'error', 'The process exited unexpectedly\n'
+        if kind == 'error':
+            self._abort()
+            raise RemoteError(
+                '\n\nPartition {} failed with\n\n{}'.format(index, value))
+        elif kind == 'broken':
+            self._broken.add(index)
+        elif kind == 'stop':
+            self._is_stopped = True
+        elif kind == 'tuners':
+            self.batch_tuners.update(value)
+        elif kind == 'done':
+            self.global_states[index] = value
+        return kind
+
+    def _abort(self):
+        for process in self._processes:
+            process.terminate()
+            process.join()
+        self._close()
+
+    def _close(self):
+        self._feed.conn.close()
+        for listener in self._listeners:
+            listener.close()
+        for control in self._controls:
+            control.close()
+        self._processes = []
+        self._is_running = False
+
+    def _send(self, method, *args):
+        # A failed send means a partition died.  Its error message explains
+        # why better than the broken connection does.
+        try:
+            return method(*args)
+        except _Disconnected:
+            self._wait_for('error')
+
+    def push(self, item):
+        """
+        Send an item to the root node.  Items are sent in batches, so call
+        ``.flush()`` to send a partial batch right away.
+
+        :type item: object
+        :param item: Any picklable object
+        """
+        if not self._is_running:
+            self.begin()
+        if self._is_stopped:
+            return
+        if self._send(self._feed.put, self._root_name, item):
+            self._poll()
+
+    def flush(self):
+        """
+        Send the items pushed so far without waiting for a full batch.
+        """
+        self._send(self._feed.flush)
+
+    def consume(self, iterable):
+        """
+        Process every item of the iterable and end the pipeline.
+
+        :type iterable: A Python Iterable
+        :param iterable: An iterable of picklable objects
+
+        If a node raises ``StopPipeline``, no more items are read from the
+        iterable soon after and the pipeline ends normally.
+        """
+        self.begin()
+        put, name, send = self._feed.put, self._root_name, self._send
+        for item in iterable:
+            if send(put, name, item):
+                self._poll()
+                if self._is_stopped:
+                    break
+        self.end()
+
+    def end(self):
+        """
+        Send the last batch, wait for every partition to end in top-down
+        order and collect their global states.
+        """
+        self._send(self._feed.close)
+        self._wait_for('done')
+        for process in self._processes:
+            process.join()
+        self._close()
@@ -0,0 +1,124 @@
+import functools
+import sys
+import time
+import traceback
+
+from consecution.nodes import StopPipeline
+
+
+class DeadLetter(object):
+    """
+    The record sent to a dead-letter node when a node fails on an item.
+
+    :ivar item: The item the node failed on
+    :ivar node_name: The name of the node that failed
+    :ivar error: The exception that was raised
+    :ivar traceback: The formatted traceback of the exception
+    """
+    __slots__ = ['item', 'node_name', 'error', 'traceback']
+
+    def __init__(self, item, node_name, error, traceback):
+        self.item = item
+        self.node_name = node_name
+        self.error = error
+        self.traceback = traceback
+
+    def __repr__(self):
+        return 'DeadLetter(node_name={}, item={}, error={})'.format(
+            repr(self.node_name), repr(self.item), repr(self.error))
+
+
+class ErrorCounts(object):
+    """
+    Error counters for one node.
+
+    :ivar errors: The number of items the node failed on
+    :ivar dead_lettered: The number of records sent to the dead-letter node
+    :ivar rate_limited: The number of failed items skipped without a dead
+                        letter because the rate limit was reached
+    """
+    __slots__ = ['errors', 'dead_lettered', 'rate_limited']
+
+    def __init__(self):
+        self.errors = 0
+        self.dead_lettered = 0
+        self.rate_limited = 0
+
+    def __repr__(self):
+        return 'ErrorCounts(errors={}, dead_lettered={}, rate_limited={})'.format(
+            self.errors, self.dead_lettered, self.rate_limited)
+
+
+def guard_process(node, process, counts):
+    """
+    Wrap the processing callable of a node that opted into an error policy.
+    Only these nodes pay for the wrapper.  The policy applies to errors
+    raised by the node itself.  Errors raised downstream of it are passed on
+    untouched, as long as the node pushes through the callables returned by
+    the ``.wire()`` attribute of the wrapper.
+
+    :type node: Node
+    :param node: A node with an error policy set by ``.on_error()``
+
+    :type process: callable
+    :param process: The processing callable of the node
+
+    :type counts: ErrorCounts
+    :param counts: The counters to update
+
+    :rtype: callable
+    :return: A processing callable that applies the error policy
+    """
+    policy, sink, max_per_second, max_errors = node._error_policy
+    name = node.name
+    # [start of the current one second window, dead letters sent in it]
+    window = [0., 0]
+    # the last error that came back from downstream through a push
+    downstream = [None]
+
+    send = functools.partial(
+        _send_dead_letter, sink, name, counts, max_per_second, window)
+
+    def guarded(item):
+        try:
+            return process(item)
+        except StopPipeline:
+            raise
+        except Exception as error:
+            if error is downstream[0]:
+                downstream[0] = None
+                raise
+            counts.errors += 1
+            if max_errors is not None and counts.errors > max_errors:
+                raise
+            if policy == 'dead_letter':
+                send(item, error)
+
+    guarded.wire = functools.partial(_wire_checked_push, downstream)
+    return guarded
+
+
+def _send_dead_letter(sink, name, counts, max_per_second, window, item, error):
+    now = time.time()
+    if now - window[0] >= 1.:
+        window[0], window[1] = now, 0
+    if max_per_second is not None and window[1] >= max_per_second:
+        counts.rate_limited += 1
+        return
+    window[1] += 1
+    counts.dead_lettered += 1
+    sink._process(DeadLetter(
+        item, name, error, ''.join(traceback.format_exception(
+            *sys.exc_info()))))
+
+
+def _wire_checked_push(downstream, push):
+    # remember errors coming back from downstream so the guard can tell
+    # them apart from the errors of its own node
+    def checked_push(item):
+        try:
+            return push(item)
+        except Exception as error:
+            downstream[0] = error
+            raise
+    return checked_push
@@ -0,0 +1,186 @@
+from queue import Empty, SimpleQueue
+import threading
+import time
+
+from consecution.nodes import StopPipeline
+from consecution.tuning import BatchTuner
+
+
+# put on the queue by .close() to tell the executor thread to finish
+_CLOSE = object()
+
+
+class ThreadedPusher(object):
+    """
+    :type pipeline: Pipeline
+    :param pipeline: The pipeline to feed
+
+    :type max_batch_size: int or BatchTuner
+    :param max_batch_size: The most items the executor thread takes off the
+                           queue at a time before it blocks again, or a tuner
+                           that picks it.
+
+    Nodes are not thread safe, so a pipeline must not be pushed to from
+    several threads at once.  A ThreadedPusher lets any number of producer
+    threads feed one pipeline anyway.  Its ``.push()`` method only puts the
+    item on a ``queue.SimpleQueue`` while holding a short lock that keeps
+    items from being queued behind ``.close()``, and a single executor thread
+    does all the work of running the pipeline.  The pipeline's ``.begin()`` is
+    called exactly once, on the executor thread, when the pusher is created.
+
+    When the executor wakes up it drains whatever has piled up in the queue,
+    up to ``max_batch_size`` items, before blocking again, so the cost of
+    waking it is shared by every item that arrived in the meantime.  With a
+    ``BatchTuner``, the time taken by each batch is measured and the limit
+    follows the tuner.  The tuner is listed as 'pusher' in the
+    ``.batch_tuners`` of the pipeline.
+
+    Calling ``.close()`` processes every item pushed before it was called,
+    ends the pipeline and returns what the pipeline's ``.end()`` returned.
+    If a node raised an error, the error is re-raised by ``.close()`` and by
+    any later ``.push()``.
+
+    .. code-block:: python
+
+       from consecution import ThreadedPusher
+
+       with ThreadedPusher(pipeline) as pusher:
+           # .push() can be called from any number of threads
+           for record in records:
+               pusher.push(record)
+    """
+    def __init__(self, pipeline, max_batch_size=1000):
+        pipeline._check_single_root()
+        self.pipeline = pipeline
+        self.batch_tuner = None
+        if isinstance(max_batch_size, BatchTuner):
+            self.batch_tuner, max_batch_size = (
+                max_batch_size, max_batch_size.size)
+        self.max_batch_size = max_batch_size
+        self.num_items = 0
+        self.num_batches = 0
+        self._queue = SimpleQueue()
+        self._closed = False
+        # makes checking for close and queueing one step
+        self._lock = threading.Lock()
+        self._error = None
+        self._result = None
+        self._thread = threading.Thread(
+            target=self._run, name='consecution-pusher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def push(self, item):
+        """
+        Queue an item for the pipeline.  Safe to call from any thread.
+
+        :type item: object
+        :param item: Any object you would like the pipeline to process
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError(
+                    '\n\nCannot push to a closed ThreadedPusher.\n')
+            if self._error is not None:
+                raise self._error
+            self._queue.put(item)
+
+    def close(self):
+        """
+        Process all queued items, end the pipeline and stop the executor
+        thread.
+
+        :rtype: object
+        :return: Whatever the ``.end()`` method of the pipeline returned
+        """
+        with self._lock:
+            closing = not self._closed
+            if closing:
+                self._closed = True
+                self._queue.put(_CLOSE)
+        if closing:
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _next_batch(self):
+        # block for the first item, then take whatever else is waiting
+        batch = [self._queue.get()]
+        get_nowait = self._queue.get_nowait
+        try:
+            while len(batch) < self.max_batch_size:
+                batch.append(get_nowait())
+        except Empty:
+            pass
+        self._batch = batch
+        return batch
+
+    def _has_close(self):
+        # items may not support comparison, so only identity is checked
+        return any(item is _CLOSE for item in self._batch)
+
+    def _drain(self):
+        # discard items until close is called
+        while not self._has_close():
+            self._next_batch()
+
+    def _run(self):
+        self._batch = []
+        try:
+            self.pipeline.begin()
+            if self.batch_tuner is not None:
+                self.pipeline.batch_tuners['pusher'] = self.batch_tuner
+                self._process_tuned_batches()
+            else:
+                self._process_batches()
+        except StopPipeline:
+            self.pipeline._is_stopped = True
+            self._drain()
+        except Exception as e:
+            self._error = e
+            self._drain()
+            return
+
+        try:
+            self._result = self.pipeline.end()
+        except Exception as e:
+            self._error = e
+
+    # Nothing is queued after _CLOSE, so it is the last item of its batch and
+    # every other item in that batch has been processed when it is reached.
+    def _process_batches(self):
+        process = self.pipeline._input_process
+        while True:
+            batch = self._next_batch()
+            self.num_batches += 1
+            for item in batch:
+                if item is _CLOSE:
+                    self.num_items += len(batch) - 1
+                    return
+                process(item)
+            self.num_items += len(batch)
+
+    def _process_tuned_batches(self):
+        # Like ._process_batches(), but timing each batch from when it was
+        # taken off the queue.  Waiting for the first item is not counted.
+        process = self.pipeline._input_process
+        clock = time.perf_counter
+        tuner = self.batch_tuner
+        while True:
+            batch = self._next_batch()
+            start = clock()
+            self.num_batches += 1
+            for item in batch:
+                if item is _CLOSE:
+                    self.num_items += len(batch) - 1
+                    return
+                process(item)
+            self.num_items += len(batch)
+            self.max_batch_size = tuner.record(len(batch), clock() - start)
@@ -0,0 +1,368 @@
+from collections import deque
+import pickle
+import tempfile
+
+from consecution.nodes import Node
+
+
+JOIN_TYPES = ('inner', 'left', 'outer')
+
+
+class _JoinNode(Node):
+    """
+    Base class for nodes that join the items of two named upstream nodes.
+    Joined items are pushed as ``(left_item, right_item)`` tuples, with None
+    standing in for the missing side of unmatched items in left and outer
+    joins.
+
+    When the pipeline layers logging, policies or process wrappers on the
+    node, items reach them as ``(input_name, item)`` tuples, so that all of
+    it applies to joins as it does to other nodes.
+    """
+    def __init__(self, name, left, right, left_key, right_key=None,
+                 how='inner', **kwargs):
+        super(_JoinNode, self).__init__(name, **kwargs)
+        if how not in JOIN_TYPES:
+            raise ValueError(
+                '\n\nJoin type must be one of {}.  Got {}\n'.format(
+                    JOIN_TYPES, repr(how)))
+        self.left = left
+        self.right = right
+        self.left_key = left_key
+        self.right_key = right_key if right_key is not None else left_key
+        self.how = how
+
+    def _input_callable(self, upstream):
+        name = upstream.name
+        if name == self.left:
+            direct = self._process_left
+        elif name == self.right:
+            direct = self._process_right
+        else:
+            raise ValueError(
+                '\n\nJoin node {} has inputs {} and {}, but is connected to '
+                '{}\n'.format(self.name, repr(self.left), repr(self.right),
+                              repr(name)))
+        # a bare node takes each input straight to its side
+        if self._process == self.process:
+            return direct
+        process = self._process
+
+        def tagged(item):
+            return process((name, item))
+        return tagged
+
+    def process(self, item):
+        if type(item) is tuple and len(item) == 2:
+            name, value = item
+            if name == self.left:
+                return self._process_left(value)
+            if name == self.right:
+                return self._process_right(value)
+        raise ValueError(
+            '\n\nJoin node {} can only receive items from its upstream '
+            'nodes {} and {}\n'.format(
+                self.name, repr(self.left), repr(self.right)))
+
+    def _process_left(self, item):  # pragma: no cover
+        raise NotImplementedError
+
+    def _process_right(self, item):  # pragma: no cover
+        raise NotImplementedError
+
+
+class HashJoin(_JoinNode):
+    """
+    :type name: str
+    :param name: The name of this node
+
+    :type left: str
+    :param left: The name of the upstream node feeding the left side
+
+    :type right: str
+    :param right: The name of the upstream node feeding the right side
+
+    :type left_key: callable
+    :param left_key: A function returning the join key of a left item
+
+    :type right_key: callable
+    :param right_key: A function returning the join key of a right item.
+                      Defaults to ``left_key``.
+
+    :type how: str
+    :param how: One of 'inner', 'left' or 'outer'
+
+    :type build: str
+    :param build: Which side, 'left' or 'right', is loaded into the hash
+                  table.  The other side probes it.
+
+    :type build_first: Bool
+    :param build_first: Set this if every build item arrives before the
+                        first probe item, for example by feeding the roots
+                        with ``.consume_sources(..., order=[...])``.  Probe
+                        items are then joined as they arrive instead of being
+                        held until the node ends.
+
+    :type max_items: int
+    :param max_items: The most items held in memory.  Past this, both sides
+                      are spilled to partitioned temporary files and joined
+                      one partition at a time when the node ends.
+
+    :type num_partitions: int
+    :param num_partitions: The number of partitions used when spilling
+
+    :type spill_dir: str
+    :param spill_dir: The directory for temporary files.  Defaults to the
+                      system temporary directory.
+
+    A join that loads the build side into a dict keyed on the join key and
+    looks up each probe item in it.
+    """
+    def __init__(self, name, left, right, left_key, right_key=None,
+                 how='inner', build='right', build_first=False,
+                 max_items=1000000, num_partitions=16, spill_dir=None,
+                 **kwargs):
+        super(HashJoin, self).__init__(
+            name, left, right, left_key, right_key, how, **kwargs)
+        if build not in ('left', 'right'):
+            raise ValueError(
+                '\n\nbuild must be \'left\' or \'right\'.  Got {}\n'.format(
+                    repr(build)))
+        self.build = build
+        self.build_first = build_first
+        self.max_items = max_items
+        self.num_partitions = num_partitions
+        self.spill_dir = spill_dir
+
+    def begin(self):
+        # build items grouped by key
+        self._table = {}
+        # probe items waiting for the build side
+        self._pending = []
+        self._num_items = 0
+        self._probing = False
+        # one (build_file, probe_file) pair per partition once spilled
+        self._partitions = None
+
+        # whether unmatched items of each side are pushed
+        keep_left = self.how in ('left', 'outer')
+        keep_right = self.how == 'outer'
+        if self.build == 'right':
+            self._keep_build, self._keep_probe = keep_right, keep_left
+        else:
+            self._keep_build, self._keep_probe = keep_left, keep_right
+        self._matched_keys = set()
+
+    def _process_left(self, item):
+        if self.build == 'left':
+            self._add_build(self.left_key(item), item)
+        else:
+            self._add_probe(self.left_key(item), item)
+
+    def _process_right(self, item):
+        if self.build == 'right':
+            self._add_build(self.right_key(item), item)
+        else:
+            self._add_probe(self.right_key(item), item)
+
+    def _emit(self, build_item, probe_item):
+        if self.build == 'right':
+            self.push((probe_item, build_item))
+        else:
+            self.push((build_item, probe_item))
+
+    def _add_build(self, key, item):
+        if self._probing:
+            raise ValueError(
+                '\n\nJoin node {} got a build item after probing started.  '
+                'Only use build_first=True when the whole build side arrives '
+                'before the probe side.\n'.format(self.name))
+        if self._partitions is not None:
+            self._spill(0, key, item)
+            return
+        self._table.setdefault(key, []).append(item)
+        self._count()
+
+    def _add_probe(self, key, item):
+        if self._partitions is not None:
+            self._spill(1, key, item)
+        elif self.build_first:
+            self._probing = True
+            self._probe(key, item)
+        else:
+            self._pending.append((key, item))
+            self._count()
+
+    def _count(self):
+        self._num_items += 1
+        if self._num_items > self.max_items:
+            self._start_spilling()
+
+    def _start_spilling(self):
+        self._partitions = [
+            (tempfile.TemporaryFile(dir=self.spill_dir),
+             tempfile.TemporaryFile(dir=self.spill_dir))
+            for _ in range(self.num_partitions)
+        ]
+        # Spilling only ever starts before any probe item was joined, so
+        # everything held so far can be moved to the partitions.
+        for key, items in self._table.items():
+            for item in items:
+                self._spill(0, key, item)
+        for key, item in self._pending:
+            self._spill(1, key, item)
+        self._table = {}
+        self._pending = []
+
+    def _spill(self, side, key, item):
+        partition = self._partitions[hash(key) % self.num_partitions]
+        pickle.dump((key, item), partition[side], pickle.HIGHEST_PROTOCOL)
+
+    def _probe(self, key, item):
+        matches = self._table.get(key)
+        if matches is None:
+            if self._keep_probe:
+                self._emit(None, item)
+            return
+        if self._keep_build:
+            self._matched_keys.add(key)
+        for build_item in matches:
+            self._emit(build_item, item)
+
+    def _flush_table(self):
+        # push the build items that no probe item matched
+        if self._keep_build:
+            for key, items in self._table.items():
+                if key not in self._matched_keys:
+                    for item in items:
+                        self._emit(item, None)
+        self._table = {}
+        self._matched_keys = set()
+
+    def end(self):
+        if self._partitions is None:
+            for key, item in self._pending:
+                self._probe(key, item)
+            self._pending = []
+            self._flush_table()
+            return
+
+        partitions, self._partitions = self._partitions, None
+        for build_file, probe_file in partitions:
+            for key, item in _read_spill(build_file):
+                self._table.setdefault(key, []).append(item)
+            for key, item in _read_spill(probe_file):
+                self._probe(key, item)
+            self._flush_table()
+
+
+def _read_spill(spill_file):
+    spill_file.seek(0)
+    try:
+        while True:
+            yield pickle.load(spill_file)
+    except EOFError:
+        pass
+    finally:
+        spill_file.close()
+
+
+class MergeJoin(_JoinNode):
+    """
+    :type name: str
+    :param name: The name of this node
+
+    :type left: str
+    :param left: The name of the upstream node feeding the left side
+
+    :type right: str
+    :param right: The name of the upstream node feeding the right side
+
+    :type left_key: callable
+    :param left_key: A function returning the join key of a left item
+
+    :type right_key: callable
+    :param right_key: A function returning the join key of a right item.
+                      Defaults to ``left_key``.
+
+    :type how: str
+    :param how: One of 'inner', 'left' or 'outer'
+
+    A join of two inputs that are each sorted by the join key.  Items are
+    joined as soon as it is certain nothing further can match them, so only
+    the items of the current key, plus whatever one side runs ahead of the
+    other, are held in memory.  Feeding the two sides from
+    ``.consume_sources()`` with a key keeps the sides in step, so memory use
+    stays constant.  A ValueError is raised if either side is out of order.
+    """
+    def begin(self):
+        self._lefts = deque()
+        self._rights = deque()
+        self._last_keys = {}
+
+    def _check_order(self, side, key):
+        last_key = self._last_keys.get(side)
+        if last_key is not None and key < last_key:
+            raise ValueError(
+                '\n\nThe {} input of join node {} is not sorted.  Key {} '
+                'came after {}\n'.format(
+                    side, self.name, repr(key), repr(last_key)))
+        self._last_keys[side] = key
+
+    def _process_left(self, item):
+        key = self.left_key(item)
+        self._check_order('left', key)
+        self._lefts.append((key, item))
+        self._advance()
+
+    def _process_right(self, item):
+        key = self.right_key(item)
+        self._check_order('right', key)
+        self._rights.append((key, item))
+        self._advance()
+
+    def _advance(self, final=False):
+        lefts, rights = self._lefts, self._rights
+        while lefts and rights:
+            left_key, right_key = lefts[0][0], rights[0][0]
+            if left_key < right_key:
+                self._unmatched_left(lefts.popleft()[1])
+            elif right_key < left_key:
+                self._unmatched_right(rights.popleft()[1])
+            elif not self._join_groups(left_key, final):
+                return
+
+    def _join_groups(self, key, final):
+        # A group is complete once a larger key arrives on its side, because
+        # the sides are sorted.
+        lefts, rights = self._lefts, self._rights
+        if not final and (lefts[-1][0] == key or rights[-1][0] == key):
+            return False
+        left_group = _pop_group(lefts, key)
+        right_group = _pop_group(rights, key)
+        for left_item in left_group:
+            for right_item in right_group:
+                self.push((left_item, right_item))
+        return True
+
+    def _unmatched_left(self, item):
+        if self.how != 'inner':
+            self.push((item, None))
+
+    def _unmatched_right(self, item):
+        if self.how == 'outer':
+            self.push((None, item))
+
+    def end(self):
+        self._advance(final=True)
+        while self._lefts:
+            self._unmatched_left(self._lefts.popleft()[1])
+        while self._rights:
+            self._unmatched_right(self._rights.popleft()[1])
+
+
+def _pop_group(items, key):
+    group = []
+    while items and items[0][0] == key:
+        group.append(items.popleft()[1])
+    return group
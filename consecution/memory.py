@@ -0,0 +1,144 @@
+from collections import OrderedDict
+import tracemalloc
+
+
+PHASES = ('begin', 'process', 'end')
+
+
+class MemoryUsage(object):
+    """
+    Memory used by one kind of call (``begin``, ``process`` or ``end``) on
+    one node.
+
+    :ivar calls: The number of calls measured
+    :ivar retained: Bytes allocated by the calls and still held when they
+                    returned, summed over all calls.  Frees count against it,
+                    so it can be negative.
+    :ivar peak: The largest number of bytes any single call had allocated
+                above its starting point at any moment.
+    """
+    __slots__ = ['calls', 'retained', 'peak']
+
+    def __init__(self):
+        self.calls = 0
+        self.retained = 0
+        self.peak = 0
+
+    def __repr__(self):
+        return 'MemoryUsage(calls={}, retained={}, peak={})'.format(
+            self.calls, self.retained, self.peak)
+
+
+class MemoryProfiler(object):
+    """
+    Attributes memory allocations traced by ``tracemalloc`` to the nodes of a
+    pipeline.  Pipelines created with ``profile_memory=True`` own one of these.
+
+    Memory is read and the tracemalloc peak is reset at every node boundary.
+    A node's ``.process()`` method calls the methods of its downstreams
+    through ``.push()``, so I keep a stack of open calls and subtract what the
+    inner calls allocated from the outer one.  Every byte is then charged to
+    the node whose code allocated it, not to its upstreams.
+    """
+    def __init__(self):
+        self.stats = OrderedDict()
+        self._stack = []
+        self._started_tracing = False
+
+    def start(self):
+        """
+        Clear old results and start tracing if nothing else already is.
+        """
+        self.stats = OrderedDict()
+        self._stack = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        """
+        Stop tracing if this profiler started it.
+        """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _enter(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            # close the peak window of the enclosing call before resetting it
+            outer = self._stack[-1]
+            outer[1] = max(outer[1], peak - outer[0] - outer[2])
+        # each frame holds [start, peak, bytes retained by inner calls]
+        self._stack.append([current, 0, 0])
+        tracemalloc.reset_peak()
+
+    def _exit(self, name, phase):
+        current, peak = tracemalloc.get_traced_memory()
+        start, own_peak, inner = self._stack.pop()
+        inclusive = current - start
+
+        usage = self.stats.setdefault(name, OrderedDict()).get(phase)
+        if usage is None:
+            usage = self.stats[name][phase] = MemoryUsage()
+        usage.calls += 1
+        usage.retained += inclusive - inner
+        usage.peak = max(usage.peak, own_peak, peak - start - inner)
+
+        if self._stack:
+            self._stack[-1][2] += inclusive
+        tracemalloc.reset_peak()
+
+    def call(self, name, phase, func, *args):
+        """
+        Call ``func(*args)`` and charge its allocations to the named node.
+
+        :type name: str
+        :param name: The name of the node
+
+        :type phase: str
+        :param phase: One of 'begin', 'process' or 'end'
+
+        :type func: callable
+        :param func: The callable to measure
+        """
+        self._enter()
+        try:
+            return func(*args)
+        finally:
+            self._exit(name, phase)
+
+    def wrap(self, name, phase, func):
+        """
+        :rtype: callable
+        :return: A one-argument callable that measures calls to ``func``
+        """
+        call = self.call
+
+        def measured(item):
+            return call(name, phase, func, item)
+        return measured
+
+    def wrap_node(self, node, process):
+        """
+        A process wrapper for ``Pipeline.add_process_wrapper()`` that measures
+        the ``.process()`` calls of a node.
+        """
+        return self.wrap(node.name, 'process', process)
+
+    def report(self):
+        """
+        :rtype: str
+        :return: A table of the memory used by each node
+        """
+        lines = ['{: <25s} {: <8s} {: >10s} {: >14s} {: >14s}'.format(
+            'node', 'phase', 'calls', 'retained', 'peak')]
+        for name, usages in self.stats.items():
+            for phase in PHASES:
+                usage = usages.get(phase)
+                if usage is None:
+                    continue
+                lines.append(
+                    '{: <25s} {: <8s} {: >10d} {: >14d} {: >14d}'.format(
+                        name, phase, usage.calls, usage.retained, usage.peak))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,345 @@
+from collections import deque, OrderedDict
+import os
+import threading
+import time
+
+from consecution.nodes import StopPipeline
+
+
+class NodeCounters(object):
+    """
+    Running totals for one node.
+
+    :ivar items: The number of items the node has processed
+    :ivar errors: The number of timed ``.process()`` calls that raised
+    :ivar timed: The number of ``.process()`` calls that were timed
+    :ivar seconds: Seconds spent in the timed ``.process()`` calls, not
+                   counting the time spent in downstream nodes they pushed to
+    """
+    __slots__ = ['items', 'errors', 'timed', 'seconds']
+
+    def __init__(self):
+        self.items = 0
+        self.errors = 0
+        self.timed = 0
+        self.seconds = 0.
+
+    def __repr__(self):
+        return (
+            'NodeCounters(items={}, errors={}, timed={}, seconds={:.6f})'
+        ).format(self.items, self.errors, self.timed, self.seconds)
+
+
+class MetricsCollector(object):
+    """
+    :type sample_every: int
+    :param sample_every: Time one in this many items fed to the root nodes.
+                         Items are always counted.
+
+    Counts the items processed by every node of a pipeline and the time spent
+    processing them.  Pushes call downstream nodes synchronously, so I keep a
+    stack of open calls and subtract the time spent in inner calls from the
+    outer one.  That way the time of each node covers only its own code.
+
+    Reading the clock twice per node call costs more than a trivial node, so
+    timing can be sampled.  The decision is made once per root item and
+    holds for everything downstream of it, which keeps the stack accounting
+    consistent.
+    """
+    def __init__(self, sample_every=1):
+        self.sample_every = sample_every
+        self.counters = OrderedDict()
+        self._stack = []
+        # [timing the current root item, number of root items seen]
+        self._sampling = [False, 0]
+
+    def wrap_node(self, node, process):
+        """
+        A process wrapper for ``Pipeline.add_process_wrapper()``.
+        """
+        counters = self.counters.setdefault(node.name, NodeCounters())
+        timed = self._timed(counters, process)
+        if self.sample_every <= 1:
+            return timed
+
+        sampling = self._sampling
+        if node._upstream_nodes:
+            def counted(item):
+                if sampling[0]:
+                    return timed(item)
+                counters.items += 1
+                return process(item)
+            return counted
+
+        every = self.sample_every
+
+        def counted_root(item):
+            sampling[1] += 1
+            if sampling[1] % every:
+                counters.items += 1
+                return process(item)
+            sampling[0] = True
+            try:
+                return timed(item)
+            finally:
+                sampling[0] = False
+        return counted_root
+
+    def _timed(self, counters, process):
+        stack = self._stack
+        clock = time.perf_counter
+
+        def timed(item):
+            stack.append(0.)
+            start = clock()
+            try:
+                return process(item)
+            except StopPipeline:
+                raise
+            except Exception:
+                counters.errors += 1
+                raise
+            finally:
+                elapsed = clock() - start
+                counters.items += 1
+                counters.timed += 1
+                counters.seconds += elapsed - stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+        return timed
+
+    def snapshot(self):
+        """
+        :rtype: tuple
+        :return: A ``(timestamp, {node_name: (items, errors, timed,
+                 seconds)})`` tuple holding the current counter values
+        """
+        return time.time(), OrderedDict(
+            (name, (c.items, c.errors, c.timed, c.seconds))
+            for (name, c) in list(self.counters.items())
+        )
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+_METRICS = [
+    ('consecution_node_items_total', 'counter',
+     'Items processed by each node.'),
+    ('consecution_node_errors_total', 'counter',
+     'Timed calls to the process method of each node that raised an error.'),
+    ('consecution_node_timed_items_total', 'counter',
+     'Items for which the process method of each node was timed.'),
+    ('consecution_node_seconds_total', 'counter',
+     'Seconds spent in timed calls to the process method of each node, '
+     'excluding time spent in downstream nodes.'),
+    ('consecution_node_items_per_second', 'gauge',
+     'Items processed per second by each node over the last interval.'),
+    ('consecution_node_latency_seconds', 'gauge',
+     'Mean seconds per timed item spent in each node over the last '
+     'interval.'),
+    ('consecution_batch_size', 'gauge',
+     'The batch size picked by the tuner of each tuned stage.'),
+]
+
+
+class MetricsReporter(object):
+    """
+    :type pipeline: Pipeline
+    :param pipeline: The pipeline to report on.  It must not be running yet.
+
+    :type interval: float
+    :param interval: Seconds between snapshots
+
+    :type history: int
+    :param history: The number of snapshots kept in the ring buffer
+
+    :type path: str
+    :param path: If set, the metrics are written to this file after every
+                 snapshot.  The file is replaced atomically, so it can be read
+                 by the node exporter textfile collector at any time.
+
+    :type port: int
+    :param port: If set, the metrics are served over HTTP on this port.  Use
+                 0 to pick a free port, which is then available as ``.port``.
+
+    :type host: str
+    :param host: The interface the HTTP server listens on
+
+    :type sample_every: int
+    :param sample_every: Time only one in this many root items.  Every item
+                         is still counted.
+
+    A background reporter for long-running pipelines.  Every node is
+    instrumented to count items, errors and the time spent in its
+    ``.process()`` method.  A daemon thread takes a snapshot of the counters
+    every ``interval`` seconds and keeps the last ``history`` snapshots in a
+    ring buffer.  Throughput and latency gauges are computed from the two most
+    recent snapshots.  Metrics are exported in the Prometheus text exposition
+    format.
+
+    .. code-block:: python
+
+       from consecution import MetricsReporter
+
+       pipe = Pipeline(my_nodes)
+       with MetricsReporter(pipe, interval=10, port=9100):
+           for item in service_items():
+               pipe.push(item)
+           pipe.end()
+    """
+    def __init__(self, pipeline, interval=5., history=120, path=None,
+                 port=None, host='127.0.0.1', sample_every=1):
+        self.pipeline = pipeline
+        self.interval = interval
+        self.path = path
+        self.host = host
+        self.port = port
+        self.collector = MetricsCollector(sample_every)
+        pipeline.add_process_wrapper(self.collector.wrap_node)
+        self._attached = True
+
+        self.history = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """
+        Start the snapshot thread and, if a port was given, the HTTP server.
+        A reporter that was stopped instruments the pipeline again from the
+        next time it begins.
+        """
+        if not self._attached:
+            self.pipeline.add_process_wrapper(self.collector.wrap_node)
+            self._attached = True
+        self.snapshot()
+        if self.port is not None:
+            self._start_server()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='consecution-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Take a final snapshot, stop the thread and the HTTP server and remove
+        the instrumentation from the pipeline.
+        """
+        if self._attached:
+            self.pipeline.remove_process_wrapper(self.collector.wrap_node)
+            self._attached = False
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.snapshot()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Add a snapshot of the counters to the ring buffer and write the
+        metrics file if there is one.
+        """
+        with self._lock:
+            self.history.append(self.collector.snapshot())
+        if self.path is not None:
+            temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as out_file:
+                out_file.write(self.render())
+            os.replace(temp_path, self.path)
+
+    def _rates(self):
+        # throughput and latency over the last two snapshots
+        with self._lock:
+            if len(self.history) < 2:
+                return {}
+            (then, old), (now, new) = self.history[-2], self.history[-1]
+        rates = {}
+        for name, (items, _, timed, seconds) in new.items():
+            old_items, _, old_timed, old_seconds = old.get(
+                name, (0, 0, 0, 0.))
+            num_timed = timed - old_timed
+            rates[name] = (
+                (items - old_items) / (now - then) if now > then else 0.,
+                (seconds - old_seconds) / num_timed if num_timed else 0.,
+            )
+        return rates
+
+    def render(self):
+        """
+        :rtype: str
+        :return: The latest snapshot in Prometheus text exposition format
+        """
+        with self._lock:
+            counts = self.history[-1][1] if self.history else {}
+        rates = self._rates()
+        values = {
+            'consecution_node_items_total': {
+                name: c[0] for (name, c) in counts.items()},
+            'consecution_node_errors_total': {
+                name: c[1] for (name, c) in counts.items()},
+            'consecution_node_timed_items_total': {
+                name: c[2] for (name, c) in counts.items()},
+            'consecution_node_seconds_total': {
+                name: c[3] for (name, c) in counts.items()},
+            'consecution_node_items_per_second': {
+                name: r[0] for (name, r) in rates.items()},
+            'consecution_node_latency_seconds': {
+                name: r[1] for (name, r) in rates.items()},
+            'consecution_batch_size': {
+                name: tuner.size
+                for (name, tuner) in sorted(self.pipeline.batch_tuners.items())},
+        }
+        lines = []
+        for metric, kind, doc in _METRICS:
+            lines.append('# HELP {} {}'.format(metric, doc))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for name, value in values[metric].items():
+                lines.append('{}{{node="{}"}} {}'.format(
+                    metric, _escape(name), repr(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _start_server(self):
+        # doing imports inside method so they are only paid for when serving
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        reporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = reporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(
+            target=self._server.serve_forever, name='consecution-metrics-http')
+        thread.daemon = True
+        thread.start()
@@ -1,9 +1,38 @@
+import copy
 import sys
 from collections import Counter, deque, OrderedDict
 import traceback
 from consecution.utils import Clock
 
 
+class StopPipeline(Exception):
+    """
+    Raise this from the ``.process()`` method of a node to tell the pipeline
+    that no more input is needed.  The pipeline stops reading its iterable,
+    abandons the rest of the current item, and ends normally, so the
+    ``.end()`` methods of all nodes still run in top-down order.
+    """
+
+
+class _TopologyCache(object):
+    """
+    Holds the results of graph walks for one connected group of nodes.  Every
+    node in a connected group shares the same cache object, so invalidating
+    the cache from any node invalidates it for the whole group.
+    """
+    __slots__ = ['nodes', 'results']
+
+    def __init__(self, nodes=None):
+        # the set of all nodes in the group, or None if the cache is invalid
+        self.nodes = nodes
+        # results of other graph queries keyed on (query_name, node)
+        self.results = {}
+
+    def invalidate(self):
+        self.nodes = None
+        self.results = {}
+
+
 class Node(object):
     """
     :type name: str
@@ -26,6 +55,22 @@ class Node(object):
     to nodes connected to the downstream side of the node.
 
     """
+    # Generated graphs can have tens of thousands of nodes, so the attributes
+    # every node has live in slots.  The __dict__ slot is only filled in when
+    # a subclass or a keyword arg sets an attribute of its own.
+    __slots__ = [
+        'name', 'pipeline', 'global_state', 'push', '_process',
+        '_end_hook', '_push_targets', '_upstream_nodes', '_downstream_nodes',
+        '_topology_cache', '_router', '_logging', '_error_policy',
+        '_timeout_policy', '_clock', '__dict__', '__weakref__',
+    ]
+
+    # the shape of this node in graph visualizations
+    _pydot_shape = 'rectangle'
+
+    # the BatchTuner picking the batch size of nodes that batch their input
+    batch_tuner = None
+
     def __init__(self, name, **kwargs):
         # assign any user-defined attributes
         for k, v in kwargs.items():
@@ -34,20 +79,49 @@ class Node(object):
         self._upstream_nodes = []
         self._downstream_nodes = []
 
-        self._num_top_down_calls = 0
-
-        # node network can be visualized with pydot.  These hold args and kwargs
-        # that will be used to add and connect this node in the graph visualization
-        self._pydot_node_kwargs = dict(name=self.name, shape='rectangle')
-        self._pydot_edge_kwarg_list = []
+        # results of graph walks are cached until the graph is changed.  The
+        # cache starts out invalid, so that a lone node is cheap to create.
+        self._topology_cache = _TopologyCache()
 
         self._router = None
 
         # this will be one of three values: None, 'input', 'output'
         self._logging = None
 
-        # add a clock to allow for timing
-        self.clock = Clock()
+        # set by .on_error() to (policy, sink, max_per_second, max_errors)
+        self._error_policy = None
+
+        # set by .on_timeout() to (seconds, policy, sink, mode)
+        self._timeout_policy = None
+
+        # the clock is only made when it is first used
+        self._clock = None
+
+    @property
+    def clock(self):
+        """
+        A ``Clock`` for timing code in this node.  It is created the first
+        time it is used.  Subclasses may assign their own.
+        """
+        if self._clock is None:
+            self._clock = Clock()
+        return self._clock
+
+    @clock.setter
+    def clock(self, clock):
+        self._clock = clock
+
+    @property
+    def _pydot_node_kwargs(self):
+        # graph visualizations are built from these kwargs
+        return dict(name=self.name, shape=self._pydot_shape)
+
+    @property
+    def _pydot_edge_kwarg_list(self):
+        return [
+            dict(tail_name=self.name, head_name=downstream.name)
+            for downstream in self._downstream_nodes
+        ]
 
     def __str__(self):
         return 'N({})'.format(self.name)
@@ -150,11 +224,46 @@ class Node(object):
         self._connect_lefts_to_rights(other, self)
         return self
 
+    def _get_topology_cache(self):
+        cache = self._topology_cache
+        if cache.nodes is None:
+            # a fresh cache is shared by every node connected to this one
+            cache = _TopologyCache(self.depth_first_walk('both'))
+            for node in cache.nodes:
+                node._topology_cache = cache
+        return cache
+
+    def _merge_topology_caches(self, other):
+        """
+        Called when an edge has been added between self and other.  This
+        merges the caches of the two groups of nodes, which saves walking the
+        graph to find the new group.
+        """
+        mine = self._get_topology_cache()
+        theirs = other._get_topology_cache()
+        if mine is not theirs:
+            small, large = sorted(
+                [mine, theirs], key=lambda cache: len(cache.nodes))
+            for node in small.nodes:
+                node._topology_cache = large
+            large.nodes.update(small.nodes)
+            mine = large
+        # all other cached queries may have changed with the new edge
+        mine.results = {}
+
+    def _cached(self, query, node, compute):
+        results = self._get_topology_cache().results
+        key = (query, node)
+        if key not in results:
+            results[key] = compute()
+        return results[key]
+
     @property
     def top_node(self):
         """
-        This attribute always holds the top-most node in the node graph.
-        Consecution only allows one top node.
+        This attribute always holds the top-most node in the node graph.  It
+        raises a ValueError if the graph has more than one root node.  Use
+        ``.root_nodes`` for graphs fed by several sources.
         """
         root_nodes = self.root_nodes
         if len(root_nodes) > 1:
@@ -169,10 +278,10 @@ class Node(object):
         """
         This attribute holds a set of all bottom nodes in the node graph.
         """
-        return {
+        return set(self._cached('terminal_node_set', self, lambda: {
             node for node in self.depth_first_walk('down')
             if len(node._downstream_nodes) == 0
-        }
+        }))
 
     @property
     def initial_node_set(self):
@@ -182,11 +291,10 @@ class Node(object):
         set of nodes.  Node that consecution can only make pipelines from
         graphs having a single top node.
         """
-        self.depth_first_walk('up')
-        return {
+        return set(self._cached('initial_node_set', self, lambda: {
             node for node in self.depth_first_walk('up')
             if len(node._upstream_nodes) == 0
-        }
+        }))
 
     @property
     def root_nodes(self):
@@ -194,17 +302,17 @@ class Node(object):
         This attribute holds a list of all nodes that do not have any upstream
         nodes attached.
         """
-        return [
+        return list(self._cached('root_nodes', None, lambda: [
             node for node in self.all_nodes
             if len(node._upstream_nodes) == 0
-        ]
+        ]))
 
     @property
     def all_nodes(self):
         """
         This attribute contains a set of all nodes in the graph.
         """
-        return self.depth_first_walk('both')
+        return set(self._get_topology_cache().nodes)
 
     def log(self, what):
         """
@@ -223,6 +331,89 @@ class Node(object):
             )
         self._logging = what
 
+    def on_error(self, policy, sink=None, max_per_second=None, max_errors=None):
+        """
+        Set what happens when the ``.process()`` method of this node raises.
+        Errors raised by downstream nodes come back through ``.push()`` but
+        are not handled here.  They are passed on untouched.
+
+        :type policy: str
+        :param policy: One of 'raise' (the default), 'skip' to drop the item
+                       and carry on, or 'dead_letter' to also send a
+                       ``DeadLetter`` record to the sink node.
+
+        :type sink: Node
+        :param sink: The node that receives dead letters.  It is not wired
+                     into the graph, but the pipeline begins and ends it.
+
+        :type max_per_second: int
+        :param max_per_second: The most dead letters sent per second.  Items
+                               failing beyond the limit are skipped and
+                               counted.
+
+        :type max_errors: int
+        :param max_errors: If set, the error after this many is raised so that
+                           a systematic failure still stops the pipeline.
+        """
+        allowed = ['raise', 'skip', 'dead_letter']
+        if policy not in allowed:
+            raise ValueError(
+                '\'policy\' argument must be in {}'.format(allowed))
+        if policy == 'dead_letter' and sink is None:
+            raise ValueError('The dead_letter policy needs a sink node')
+        if policy == 'raise':
+            self._error_policy = None
+        else:
+            self._error_policy = (policy, sink, max_per_second, max_errors)
+
+    def on_timeout(self, seconds=None, policy='skip', sink=None, mode='thread'):
+        """
+        Limit the time the ``.process()`` method of this node may take on an
+        item, and skip items whose deadline has passed.  Deadlines are set
+        with the ``deadline`` argument of the pipeline.
+
+        :type seconds: float
+        :param seconds: The most seconds a call may take.  If None, only
+                        deadlines are checked.
+
+        :type policy: str
+        :param policy: What happens to an item that timed out.  One of 'skip'
+                       (the default) to drop it, 'dead_letter' to send a
+                       ``DeadLetter`` record to the sink node, or 'raise' to
+                       raise a ``ProcessTimeout`` error.
+
+        :type sink: Node
+        :param sink: The node that receives timed out items.  It is not wired
+                     into the graph, but the pipeline begins and ends it.
+
+        :type mode: str
+        :param mode: 'thread' to run calls on a worker thread, or 'process'
+                     to run them in a forked process that is killed when a
+                     call times out
+        """
+        if policy not in ['skip', 'dead_letter', 'raise']:
+            raise ValueError(
+                '\'policy\' argument must be in {}'.format(
+                    ['skip', 'dead_letter', 'raise']))
+        if mode not in ['thread', 'process']:
+            raise ValueError(
+                '\'mode\' argument must be in {}'.format(['thread', 'process']))
+        if policy == 'dead_letter' and sink is None:
+            raise ValueError('The dead_letter policy needs a sink node')
+        self._timeout_policy = (seconds, policy, sink, mode)
+
+    def _policy_sinks(self):
+        """
+        Returns the dead-letter nodes named by the error and timeout policies
+        of this node.
+        """
+        sinks = []
+        if self._error_policy is not None and self._error_policy[1]:
+            sinks.append(self._error_policy[1])
+        if self._timeout_policy is not None and self._timeout_policy[2]:
+            sinks.append(self._timeout_policy[2])
+        return sinks
+
     def _get_downstream_reps(self):
         if self._downstream_nodes:
             downstreams = sorted([n.name for n in self._downstream_nodes])
@@ -248,9 +439,42 @@ class Node(object):
         self.pipeline._longest_node_name_len_ = max(
             len(n.name) for n in self.all_nodes)
         self.pipeline._node_repr = ''
-        self.top_node.top_down_call('_get_downstream_reps')
+        self.top_down_call('_get_downstream_reps')
+
+    @property
+    def topological_layers(self):
+        """
+        This attribute holds the nodes of the graph grouped into layers in
+        top-down order.  The first layer holds the root nodes, and every other
+        node is in the layer just below its lowest upstream.  Nodes in the same
+        layer never depend on each other.  Nodes within a layer are sorted by
+        name.
+        """
+        return [
+            list(layer) for layer in
+            self._cached('topological_layers', None, self._compute_layers)
+        ]
 
-    def top_down_call(self, method_name):
+    def _compute_layers(self):
+        # Kahn's algorithm processed one wave of ready nodes at a time
+        nodes = self.all_nodes
+        num_waiting = {node: len(node._upstream_nodes) for node in nodes}
+        layer = sorted(node for node in nodes if num_waiting[node] == 0)
+        layers = []
+        while layer:
+            layers.append(layer)
+            next_layer = []
+            for node in layer:
+                for downstream in node._downstream_nodes:
+                    num_waiting[downstream] -= 1
+                    if num_waiting[downstream] == 0:
+                        next_layer.append(downstream)
+            layer = sorted(next_layer)
+        if sum(len(layer) for layer in layers) != len(nodes):
+            raise ValueError('\n\nYour graph is not acyclic.  It has loops.')
+        return layers
+
+    def top_down_call(self, method_name, max_workers=None):
         """
         This utility method traverses the graph in top-down order and invokes
         the named method on every node it encounters. It is used internally
@@ -260,30 +484,32 @@ class Node(object):
         :type method_name: str
         :param method_name: The name of the method you would like to call in
                             top-down order.
+
+        :type max_workers: int
+        :param max_workers: If set, the methods of nodes in the same
+                            topological layer are called concurrently on a
+                            thread pool with this many threads.  A layer is
+                            not started until every call in the layer above
+                            it has finished.
         """
-        # record the number of upstreams this node has
-        num_upstreams = len(self._upstream_nodes)
-
-        # if this node isn't pulling from multiple upstreams, it's ready
-        # to recurse to downstreams
-        if num_upstreams <= 1:
-            ready_for_downstreams = True
-        # this node isn't ready to recurse to downstreams until the current
-        # call would mean the last required call.
-        elif self._num_top_down_calls == num_upstreams - 1:
-            ready_for_downstreams = True
-        else:
-            ready_for_downstreams = False
-
-        # if ready to recurse, then call the method on self and recurse
-        # downwards.
-        if ready_for_downstreams:
-            getattr(self, method_name)()
-            for downstream in self._downstream_nodes:
-                downstream.top_down_call(method_name)
-            self._num_top_down_calls = 0
-        else:
-            self._num_top_down_calls += 1
+        layers = self.topological_layers
+        if not max_workers:
+            for layer in layers:
+                for node in layer:
+                    getattr(node, method_name)()
+            return
+
+        # doing import inside method so it is only paid for by concurrent hooks
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for layer in layers:
+                futures = [
+                    executor.submit(getattr(node, method_name))
+                    for node in layer
+                ]
+                # re-raise the first error, if any
+                for future in futures:
+                    future.result()
 
     def depth_first_walk(self, direction='both', as_ordered_list=False):
         """
@@ -432,15 +658,13 @@ class Node(object):
         self._validate_node(other)
         self._downstream_nodes.append(other)
         other._upstream_nodes.append(self)
+        self._merge_topology_caches(other)
 
         self._check_for_dups()
         if self.name == other.name:
             raise ValueError('{} can\'t be downstream to itself'.format(self))
         self._check_for_cycles()
 
-        self._pydot_edge_kwarg_list.append(
-            dict(tail_name=self.name, head_name=other.name))
-
     def remove_downstream(self, other):
         """
         This method removes the given node from being attached as a downstream
@@ -457,13 +681,64 @@ class Node(object):
         self._downstream_nodes = [
             n for n in self._downstream_nodes if n.name != other.name]
 
-        # remove this connection from the pydot kwargs list
-        new_kwargs_list = []
-        for kwargs in self._pydot_edge_kwarg_list:
-            if kwargs['head_name'] == other.name:
-                continue
-            new_kwargs_list.append(kwargs)
-        self._pydot_edge_kwarg_list = new_kwargs_list
+        # removing an edge can split a group of nodes in two
+        self._topology_cache.invalidate()
+        other._topology_cache.invalidate()
+
+    def _replace_with(self, other):
+        """
+        Puts the unconnected node other in the place of this node, taking
+        over every edge in the same position, and leaves this node
+        unconnected.  The graph keeps its shape, so nothing needs to be
+        checked for duplicates or cycles, and the cost is proportional to the
+        number of edges of this node, not to the size of the graph.
+        """
+        if other._upstream_nodes or other._downstream_nodes:
+            raise ValueError(
+                '\n\nReplacement node {} must not be connected to other '
+                'nodes.\n'.format(other))
+
+        for upstream in self._upstream_nodes:
+            downstreams = upstream._downstream_nodes
+            downstreams[downstreams.index(self)] = other
+            # routers look their endpoints up by name
+            end_point_map = getattr(upstream, '_end_point_map', None)
+            if end_point_map is not None:
+                end_point_map[self.name] = other
+        for downstream in self._downstream_nodes:
+            upstreams = downstream._upstream_nodes
+            upstreams[upstreams.index(self)] = other
+
+        other._upstream_nodes, self._upstream_nodes = self._upstream_nodes, []
+        other._downstream_nodes, self._downstream_nodes = (
+            self._downstream_nodes, [])
+
+        # the group keeps its cache with other in place of this node, but
+        # the cached query results refer to this node, so they are dropped
+        cache = self._topology_cache
+        if cache.nodes is not None:
+            cache.nodes.discard(self)
+            cache.nodes.add(other)
+        cache.results = {}
+        other._topology_cache = cache
+        self._topology_cache = _TopologyCache({self})
+
+    def _fresh_copy(self):
+        """
+        Returns a shallow copy of this node that is not connected to any other
+        node or pipeline.  This is used to create pipelines from templates.
+        """
+        node = copy.copy(self)
+        for name in [
+                'pipeline', 'global_state', 'push', '_process', '_end_hook',
+                '_push_targets']:
+            if hasattr(node, name):
+                delattr(node, name)
+        node._upstream_nodes = []
+        node._downstream_nodes = []
+        node._topology_cache = _TopologyCache()
+        node._clock = None
+        return node
 
     def _build_pydot_graph(self):
         """
@@ -592,6 +867,14 @@ class Node(object):
     def end(self):
         pass
 
+    def _input_callable(self, upstream):
+        """
+        Returns the callable that the given upstream node pushes to.  Nodes
+        that need to know which upstream an item came from can override this
+        to hand each upstream its own callable.
+        """
+        return self._process
+
     def _write_log(self, item):
         sys.stdout.write('node_log,{},{},{}\n'.format(self._logging, self.name, item))
 
@@ -602,14 +885,14 @@ class Node(object):
         if self._logging == 'output':
             self._write_log(item)
 
-        # The _process attribute will be set to the appropriate callable
-        # when initializing the pipeline.  I do this because I want the
-        # chaining to be as efficient as possible.  If logging is not set,
-        # I don't want to have to hit that logic every push, so I just
-        # invoke a callable attribute at each process that has been set
-        # to the appropriate callable.
-        for downstream in self._downstream_nodes:
-            downstream._process(item)
+        # The _push_targets attribute holds the _process callables of all
+        # downstreams and is set when initializing the pipeline.  I do this
+        # because I want the chaining to be as efficient as possible.  If
+        # logging is not set, I don't want to have to hit that logic every
+        # push, so I just invoke callables that have been set to the
+        # appropriate downstream callable.
+        for process in self._push_targets:
+            process(item)
 
 
 class _RouterNode(Node):
@@ -617,10 +900,11 @@ class _RouterNode(Node):
     This node will route to downstreams.  The router function needs to
     return the name of the destination node.
     """
+    _pydot_shape = 'oval'
+
     def __init__(self, name, end_point_map, route_callable):
         super(_RouterNode, self).__init__(name)
         self._end_point_map = end_point_map
-        self._pydot_node_kwargs = dict(name=self.name, shape='oval')
         self._route_callable = route_callable
 
     def process(self, item):
@@ -644,6 +928,22 @@ class _RouterNode(Node):
 
 
 class GroupByNode(Node):
+    """
+    :type name: str
+    :param name: The name of this node.  Must be unique within a pipeline.
+
+    :type max_batch_size: int
+    :param max_batch_size: If set, a group holding more than this many items
+                           is handed to ``.process()`` in consecutive partial
+                           batches of at most this size, so the memory held
+                           by the node is bounded.
+
+    A node that collects consecutive items having the same key into batches.
+    """
+    # the default is set on the class so that the max_batch_size keyword
+    # lands on the instance through the usual Node kwargs handling
+    max_batch_size = None
+
     def __init__(self, *args, **kwargs):
         super(GroupByNode, self).__init__(*args, **kwargs)
         self._batch_ = []
@@ -683,6 +983,11 @@ class GroupByNode(Node):
             if len(self._batch_) > 0:
                 self.process(self._batch_)
             self._batch_ = [item]
+        elif self.max_batch_size and len(self._batch_) >= self.max_batch_size:
+            # I flush a full batch only when the group gets another item so
+            # that a group never ends with an empty partial batch
+            self.process(self._batch_)
+            self._batch_ = [item]
         else:
             self._batch_.append(item)
 
@@ -690,6 +995,12 @@ class GroupByNode(Node):
         self.process(self._batch_)
         self._batch_ = []
 
+    def _fresh_copy(self):
+        node = super(GroupByNode, self)._fresh_copy()
+        node._batch_ = []
+        node._previous_key = '__no_previous_key__'
+        return node
+
     def __getattribute__(self, name):
         """
         This should trap for the end() method calls and install
@@ -702,3 +1013,84 @@ class GroupByNode(Node):
             return wrapper
         else:
             return super(GroupByNode, self).__getattribute__(name)
+
+
+class StreamingGroupByNode(GroupByNode):
+    """
+    A GroupBy node that never holds a group in memory.  Instead of receiving
+    whole batches, it is told where each group starts and ends and sees the
+    items of the group one at a time as they arrive.  This is the natural fit
+    for reducers that need a single pass over each group.
+
+    You must define ``.key()`` and ``.process()``.  The ``.begin_group()``
+    and ``.end_group()`` hooks are optional.
+
+    .. code-block:: python
+
+       from consecution import StreamingGroupByNode
+
+       class SumByUser(StreamingGroupByNode):
+           def key(self, item):
+               return item['user']
+
+           def begin_group(self, key):
+               self.total = 0
+
+           def process(self, item):
+               self.total += item['amount']
+
+           def end_group(self, key):
+               self.push((key, self.total))
+    """
+    def __init__(self, *args, **kwargs):
+        super(StreamingGroupByNode, self).__init__(*args, **kwargs)
+        self._in_group = False
+
+    def begin_group(self, key):
+        """
+        Called before the first item of each group is processed.
+
+        :type key: hashable object
+        :param key: The key of the group
+        """
+
+    def process(self, item):
+        """
+        You must define this method.
+
+        :type item: object
+        :param item: The next item of the current group
+        """
+        raise NotImplementedError(
+            'You must define a .process(self, item) method on all '
+            'StreamingGroupBy nodes.'
+        )
+
+    def end_group(self, key):
+        """
+        Called after the last item of each group is processed.  This is
+        usually where the result for the group is pushed.
+
+        :type key: hashable object
+        :param key: The key of the group
+        """
+
+    def _process_item(self, item):
+        key = self.key(item)
+        if not self._in_group or key != self._previous_key:
+            if self._in_group:
+                self.end_group(self._previous_key)
+            self._previous_key = key
+            self._in_group = True
+            self.begin_group(key)
+        self.process(item)
+
+    def _end(self):
+        if self._in_group:
+            self._in_group = False
+            self.end_group(self._previous_key)
+
+    def _fresh_copy(self):
+        node = super(StreamingGroupByNode, self)._fresh_copy()
+        node._in_group = False
+        return node
@@ -1,5 +1,10 @@
+import heapq
 import sys
-from consecution.nodes import GroupByNode
+from collections import deque
+from consecution.errors import ErrorCounts, guard_process
+from consecution.memory import MemoryProfiler
+from consecution.nodes import GroupByNode, StopPipeline
+from consecution.timeouts import TimeoutCounts, TimeoutGuard
 
 
 class GlobalState(object):
@@ -52,14 +57,45 @@ class Pipeline(object):
     :param global_state: Any python object you want to use for holding global
                          state.
 
+    :type hook_workers: int
+    :param hook_workers: If set, the ``.begin()`` and ``.end()`` methods of
+                         nodes in the same topological layer are run
+                         concurrently on a thread pool with this many threads.
+                         This speeds up nodes that do slow I/O when they
+                         begin.  Nodes that push from ``.end()`` can then push
+                         to a shared downstream from several threads at once,
+                         so only use it for ``.end()`` methods that are safe to
+                         run that way.
+
+    :type profile_memory: Bool
+    :param profile_memory: If true, memory allocated by the ``.begin()``,
+                           ``.process()`` and ``.end()`` methods of every node
+                           is traced with ``tracemalloc``.  A table of the
+                           peak and retained bytes of each node is written to
+                           stderr when the pipeline ends, and the numbers are
+                           available in the ``.memory_stats`` attribute.
+                           Tracing slows processing down considerably and
+                           ``hook_workers`` is ignored while it is on.
+
+    :type deadline: callable
+    :param deadline: An optional function of an item fed to a root node
+                     returning the ``time.time()`` by which it must be
+                     processed, or None for no deadline.  The deadline holds
+                     for every item derived from it downstream.  Nodes that
+                     set ``.on_timeout()`` skip items past their deadline.
+
     Once Nodes have been wired together, they must be placed in a pipeline in
     order to process data.  If you would like to peform pipeline-level set up and
     tear-down logic, you can subclass from Pipeline and override the
     ``.begin()`` and ``end()`` methods.
     """
-    def __init__(self, node, global_state=None):
+    def __init__(
+            self, node, global_state=None, hook_workers=None,
+            profile_memory=False, deadline=None):
         # get a reference to the top node of the connected nodes supplied.
-        self.top_node = node.top_node
+        # A graph may have several root nodes, each fed by its own iterable.
+        # The top node is then just the first of them in name order.
+        self.top_node = min(node.root_nodes)
 
         # set the pipeline global state
         if global_state:
@@ -67,6 +103,19 @@ class Pipeline(object):
         else:
             self.global_state = GlobalState()
 
+        self.hook_workers = hook_workers
+        self.memory_profiler = None
+        self._process_wrappers = []
+        if profile_memory:
+            self.memory_profiler = MemoryProfiler()
+            self._process_wrappers.append(self.memory_profiler.wrap_node)
+
+        # pushes are synchronous, so the deadline of the root item being
+        # processed is the deadline of everything downstream of it
+        self.deadline = deadline
+        self._deadline = [None]
+        self._timeout_guards = {}
+
         # initialize an empty lookup for nodes
         self._node_lookup = {}
 
@@ -78,14 +127,44 @@ class Pipeline(object):
         # it will only be true between when the .begin() is run and the
         # .end() method is run.
         self._is_running = False
+        self._is_stopped = False
         self._needs_log_header = False
+        self.error_counts = {}
+        self._error_guards = {}
+        self.timeout_counts = {}
+        self.batch_tuners = {}
+        self._close_timeout_guards()
 
         # initialize each node
+        node_for_name = {}
         for node in self.top_node.all_nodes:
-            self.initialize_node(node, with_push)
+            node_for_name[node.name] = node
+            self.initialize_node(node)
+
+        # dead-letter nodes outside the graph are set up here
+        for sink in self._find_sinks():
+            if sink.name in node_for_name:
+                raise ValueError(
+                    '\n\nDead-letter node name {} is already used in the '
+                    'pipeline.\n'.format(repr(sink.name)))
+            self.initialize_node(sink)
+            self._wire_push(sink)
+
+        # wire up the push callables
+        if with_push:
+            self._wire_pushes()
+
+        # items pushed to the pipeline go to its only root node
+        roots = self.root_nodes
+        for root in roots:
+            self._read_deadline(root)
+        if len(roots) == 1:
+            self._input_process = roots[0]._process
+        else:
+            self._input_process = self._raise_for_multiple_roots
 
-        # build the pipeline repr by cycling through all the nodes
-        self.top_node.top_down_make_repr()
+        # the pipeline repr is built lazily the next time it is printed
+        self._node_repr = None
 
         # print a logging header if any node is logging
         if self._needs_log_header:
@@ -110,22 +189,174 @@ class Pipeline(object):
             self._needs_log_header = True
             node._process = node._logged_process
 
-        # for single downstreams with no logging, can short-circuit all logic
-        # and directly wire up the downstream process() callable as the
-        # push callable on this node
-        short_it = len(node._downstream_nodes) == 1
-        short_it = short_it and node._downstream_nodes[0]._logging is None
-        short_it = short_it and not isinstance(
-            node._downstream_nodes[0], GroupByNode)
+        if node.batch_tuner is not None:
+            self.batch_tuners[node.name] = node.batch_tuner
+
+        # the pipeline ends nodes through this, so that a node whose calls
+        # run in a child process is ended where its state is
+        end = node.end
+
+        # timeouts go inside the process wrappers, which only ever see the
+        # calling thread
+        if node._timeout_policy is not None:
+            counts = self.timeout_counts[node.name] = TimeoutCounts()
+            node._process = self._timeout_guards[node.name] = TimeoutGuard(
+                node, node._process, counts, self._deadline)
+            end = node._process.end
+        node._end_hook = self._stoppable(end)
+
+        for wrapper in self._process_wrappers:
+            node._process = wrapper(node, node._process)
+
+        # only nodes that opted into an error policy pay for error handling
+        self._error_guards.pop(node.name, None)
+        if node._error_policy is not None:
+            counts = self.error_counts[node.name] = ErrorCounts()
+            node._process = self._error_guards[node.name] = guard_process(
+                node, node._process, counts)
 
         # only initialize push if requsted
         if with_push:
-            if short_it and node._logging is None:
-                node.push = node._downstream_nodes[0].process
+            self._wire_push(node)
+
+    def _stoppable(self, end):
+        # A node that stops the pipeline while the nodes are ending must not
+        # keep the others from ending.
+        def end_hook():
+            try:
+                end()
+            except StopPipeline:
+                self._is_stopped = True
+        return end_hook
+
+    def _wire_push(self, node):
+        # Pushing needs logic only when output is logged or there are
+        # several downstreams.  Otherwise the push callable can be the input
+        # callable of the single downstream, which is normally its _process.
+        # The targets are kept either way for nodes that pick among them.
+        targets = [
+            downstream._input_callable(node)
+            for downstream in node._downstream_nodes]
+        # errors raised downstream are not the error policy's business
+        guard = self._error_guards.get(node.name)
+        if guard is not None:
+            targets = [guard.wire(target) for target in targets]
+        node._push_targets = tuple(targets)
+        if node._logging != 'output' and len(node._push_targets) == 1:
+            self._set_push(node, node._push_targets[0])
+        else:
+            self._set_push(node, node._push)
+
+    def _set_push(self, node, push):
+        # a node with a timeout pushes through its guard
+        guard = self._timeout_guards.get(node.name)
+        node.push = push if guard is None else guard.wire(push)
+
+    def _close_timeout_guards(self):
+        for guard in self._timeout_guards.values():
+            guard.close()
+        self._timeout_guards = {}
+
+    def _read_deadline(self, root):
+        if self.deadline is None:
+            return
+        deadline, cell, process = self.deadline, self._deadline, root._process
+
+        def with_deadline(item):
+            cell[0] = deadline(item)
+            try:
+                return process(item)
+            finally:
+                # items pushed from .end() belong to no root item
+                cell[0] = None
+        root._process = with_deadline
+
+    @property
+    def root_nodes(self):
+        """
+        A list of the nodes with no upstreams, sorted by name.
+        """
+        return sorted(self.top_node.root_nodes)
 
-            # logged or multiple downstreams require logic, so no short circuit
-            else:
-                node.push = node._push
+    def add_process_wrapper(self, wrapper):
+        """
+        Register a function that wraps the processing callable of every node
+        for instrumentation.  It is called as ``wrapper(node, process)`` each
+        time the pipeline initializes a node and must return a callable taking
+        one item.  Wrappers take effect the next time the pipeline begins, so
+        they must be added before it is started.
+
+        :type wrapper: callable
+        :param wrapper: The wrapping function
+        """
+        if self._is_running:
+            raise ValueError(
+                '\n\nProcess wrappers must be added before the pipeline '
+                'begins.\n')
+        self._process_wrappers.append(wrapper)
+
+    def remove_process_wrapper(self, wrapper):
+        """
+        Unregister a function added with ``.add_process_wrapper()``.  Like
+        adding one, this takes effect the next time the pipeline begins, so
+        the nodes of a running pipeline stay wrapped until it ends.
+
+        :type wrapper: callable
+        :param wrapper: The wrapping function
+        """
+        if wrapper not in self._process_wrappers:
+            raise ValueError(
+                '\n\n{} is not a process wrapper of this pipeline.\n'.format(
+                    repr(wrapper)))
+        self._process_wrappers.remove(wrapper)
+
+    def _find_sinks(self):
+        # the dead-letter nodes that are not part of the graph
+        nodes = self.top_node.all_nodes
+        graph_ids = {id(node) for node in nodes}
+        sinks = {}
+        for node in nodes:
+            for sink in node._policy_sinks():
+                if id(sink) not in graph_ids:
+                    sinks[id(sink)] = sink
+        return sorted(sinks.values())
+
+    def _check_single_root(self):
+        # checked before beginning, so a failure leaves nothing to end
+        if len(self.top_node.root_nodes) > 1:
+            self._raise_for_multiple_roots(None)
+
+    def _raise_for_multiple_roots(self, item):
+        raise ValueError(
+            '\n\nThis pipeline has root nodes {}.\n'
+            'Use .consume_sources() to give each of them an input.\n'.format(
+                [node.name for node in self.root_nodes]))
+
+    def _walk_down(self):
+        """
+        Returns a list of all nodes ordered by a depth-first walk down from
+        each root node in turn.
+        """
+        nodes = []
+        seen = set()
+        for root in self.root_nodes:
+            for node in root.depth_first_walk('down', as_ordered_list=True):
+                if node not in seen:
+                    seen.add(node)
+                    nodes.append(node)
+        return nodes
+
+    def _wire_pushes(self):
+        """
+        Wire the push callable of every node in the graph.  Nodes call
+        .push() from inside .process(), so a run of nodes can't be collapsed
+        into a single python frame.  Instead, a node with a single downstream
+        gets the processing callable of that downstream bound directly as its
+        .push(), so an item moves along a linear run of nodes with one call
+        per hop.
+        """
+        for node in self.top_node.all_nodes:
+            self._wire_push(node)
 
     def __getitem__(self, name):
         node = self._node_lookup.get(name, None)
@@ -134,6 +365,15 @@ class Pipeline(object):
         return node
 
     def __setitem__(self, name_to_replace, replacement_node):
+        """
+        Replace the named node with a new, unconnected node of the same name.
+        The replacement takes over every edge of the old node in place.  This
+        also works between ``.push()`` calls on a running pipeline.  The old
+        node is then ended, so anything it buffered is pushed on, and the
+        replacement is begun.  Only the push callables of the replacement and
+        its upstreams are re-wired, so the cost grows with the number of
+        edges of the node, not with the size of the pipeline.
+        """
         # make sure replacement node has proper name
         if name_to_replace != replacement_node.name:
             raise ValueError(
@@ -143,33 +383,39 @@ class Pipeline(object):
         # this will automatically raise error if the name doesn't exist
         node_to_replace = self[name_to_replace]
 
-        removals = []
-        additions = []
-
-        for upstream in node_to_replace._upstream_nodes:
-            removals.append((upstream, node_to_replace))
-            additions.append((upstream, replacement_node))
-            # handle special case of upstream being a routing node
-            if hasattr(upstream, '_end_point_map'):
-                upstream._end_point_map[name_to_replace] = replacement_node
+        if self._is_running:
+            node_to_replace._end_hook()
 
-        for downstream in node_to_replace._downstream_nodes:
-            removals.append((node_to_replace, downstream))
-            additions.append((replacement_node, downstream))
-
-        for upstream, downstream in removals:
-            upstream.remove_downstream(downstream)
-
-        for upstream, downstream in additions:
-            upstream.add_downstream(downstream)
+        node_to_replace._replace_with(replacement_node)
 
         # initialize the replacement node within the pipeline
+        guard = self._timeout_guards.pop(name_to_replace, None)
+        if guard is not None:
+            guard.close()
         self.initialize_node(replacement_node)
+        if not replacement_node._upstream_nodes:
+            self._read_deadline(replacement_node)
+        self._node_repr = None
 
         # if top node was replaced then make sure pipeline nows about it
         if replacement_node.name == self.top_node.name:
             self.top_node = replacement_node
 
+        if self._is_running:
+            self._wire_live(node_to_replace, replacement_node)
+
+    def _wire_live(self, old, new):
+        new._begin()
+        self._wire_push(new)
+        if not new._downstream_nodes:
+            # terminal nodes keep whatever .stream() redirected pushes to
+            new._push_targets = old._push_targets
+            self._set_push(new, new._push)
+        for upstream in new._upstream_nodes:
+            self._wire_push(upstream)
+        if self._input_process is old._process:
+            self._input_process = new._process
+
     def __getattribute__(self, name):
         """
         This should trap for the begin() and end() method calls and install
@@ -216,14 +462,47 @@ class Pipeline(object):
     def _reset(self):
         self.top_node.top_down_call('reset')
 
+    def _call_hooks(self, method_name, phase):
+        profiler = self.memory_profiler
+        if profiler is None:
+            self.top_node.top_down_call(method_name, self.hook_workers)
+            return
+        # tracemalloc counts allocations for the whole process, so hooks run
+        # one at a time to keep their allocations apart
+        for layer in self.top_node.topological_layers:
+            for node in layer:
+                profiler.call(node.name, phase, getattr(node, method_name))
+
     def _begin(self):
-        self.top_node.top_down_call('_begin')
+        if self.memory_profiler is not None:
+            self.memory_profiler.start()
+        for sink in self._find_sinks():
+            sink._begin()
+        self._call_hooks('_begin', 'begin')
         self.initialize(with_push=True)
         self._is_running = True
+        self._is_stopped = False
 
     def _end(self):
-        self.top_node.top_down_call('end')
+        self._call_hooks('_end_hook', 'end')
+        for sink in self._find_sinks():
+            sink._end_hook()
+        self._close_timeout_guards()
         self._is_running = False
+        if self.memory_profiler is not None:
+            self.memory_profiler.stop()
+            sys.stderr.write(self.memory_profiler.report())
+
+    @property
+    def memory_stats(self):
+        """
+        When memory profiling is on, a dict mapping node names to dicts that
+        map each of 'begin', 'process' and 'end' to a ``MemoryUsage`` object
+        for the last run.  Otherwise None.
+        """
+        if self.memory_profiler is None:
+            return None
+        return self.memory_profiler.stats
 
     def push(self, item):
         """
@@ -231,10 +510,19 @@ class Pipeline(object):
 
         :type item: object
         :param item: Any object you would like the pipeline to process
+
+        Once a node raises ``StopPipeline``, further pushes are ignored until
+        ``.end()`` is called.
         """
         if not self._is_running:
+            self._check_single_root()
             self.begin()
-        self.top_node._process(item)
+        if self._is_stopped:
+            return
+        try:
+            self._input_process(item)
+        except StopPipeline:
+            self._is_stopped = True
 
     def consume(self, iterable):
         """
@@ -242,12 +530,153 @@ class Pipeline(object):
 
         :type iterable: A Python Iterable
         :param iterable: An iterable of objects you would like to process
+
+        If a node raises ``StopPipeline``, no more items are read from the
+        iterable and the pipeline ends normally.
+        """
+        self._check_single_root()
+        self.begin()
+        process = self._input_process
+        # the try is outside the loop so that it costs nothing per item
+        try:
+            for item in iterable:
+                process(item)
+        except StopPipeline:
+            self._is_stopped = True
+        return self.end()
+
+    def stream(self, iterable):
+        """
+        This generator processes each item in the iterable and lazily yields
+        the items pushed by the terminal nodes of the pipeline as they are
+        produced.  Only the outputs of the current input item are held in
+        memory.  Items pushed from the ``.end()`` methods of nodes are yielded
+        after the iterable is exhausted.
+
+        If you stop iterating early, or a node raises ``StopPipeline``, no more
+        items are pulled from the iterable.  The ``.end()`` method of the
+        pipeline is called when the generator is closed, and anything pushed
+        during it is discarded.
+
+        :type iterable: A Python Iterable
+        :param iterable: An iterable of objects you would like to process
+
+        :rtype: generator
+        :return: A generator of the items pushed by the terminal nodes
         """
+        self._check_single_root()
         self.begin()
-        for item in iterable:
-            self.top_node._process(item)
+
+        # terminal nodes have nothing downstream, so their pushes can be
+        # redirected into the output buffer
+        output = deque()
+        for node in self.top_node.terminal_node_set:
+            node._push_targets = (output.append,)
+            if node._logging != 'output':
+                self._set_push(node, output.append)
+
+        process = self._input_process
+        popleft = output.popleft
+        try:
+            for item in iterable:
+                process(item)
+                while output:
+                    yield popleft()
+        except StopPipeline:
+            self._is_stopped = True
+        except GeneratorExit:
+            self.end()
+            raise
+
+        self.end()
+        while output:
+            yield popleft()
+
+    def consume_sources(self, sources, key=None, order=None):
+        """
+        Consume several iterables at once, each feeding its own root node.
+
+        By default, the sources are interleaved round-robin, one item from
+        each in turn, until all of them are exhausted.  If an order is given,
+        each source is consumed completely before the next one is started.
+        With a key, the sources are merged in key order with a heap, so if
+        every source is sorted by the key, the root nodes see their items in
+        globally sorted order.  This lets sorted partitions feed a GroupBy node directly
+        without first being concatenated and re-sorted.
+
+        :type sources: dict
+        :param sources: A mapping of root node names to the iterables that
+                        feed them.  Every root node needs exactly one source.
+
+        :type key: callable
+        :param key: An optional function of an item returning the value the
+                    sources are sorted by.
+
+        :type order: list
+        :param order: An optional list of root node names giving the order
+                      in which the sources are consumed one after another.
+        """
+        names = {node.name for node in self.root_nodes}
+        if set(sources.keys()) != names:
+            raise ValueError(
+                '\n\nSources must be given for exactly the root nodes {}.  '
+                'Got {}\n'.format(sorted(names), sorted(sources.keys())))
+        if order is not None and sorted(order) != sorted(names):
+            raise ValueError(
+                '\n\nThe order must list each of the root nodes {} once.  '
+                'Got {}\n'.format(sorted(names), order))
+
+        self.begin()
+        feeds = [
+            (self[name]._process, iter(sources[name]))
+            for name in (order or sorted(names))
+        ]
+        try:
+            if key is not None:
+                self._merge(feeds, key)
+            elif order is not None:
+                self._concatenate(feeds)
+            else:
+                self._interleave(feeds)
+        except StopPipeline:
+            self._is_stopped = True
         return self.end()
 
+    def _concatenate(self, feeds):
+        for process, iterator in feeds:
+            for item in iterator:
+                process(item)
+
+    def _interleave(self, feeds):
+        while feeds:
+            remaining = []
+            for process, iterator in feeds:
+                for item in iterator:
+                    process(item)
+                    remaining.append((process, iterator))
+                    break
+            feeds = remaining
+
+    def _merge(self, feeds, key):
+        # Heap entries are (key, feed index, item).  The index breaks ties so
+        # items are never compared, and keeps equal keys in source order.
+        heap = []
+        for ind, (process, iterator) in enumerate(feeds):
+            for item in iterator:
+                heap.append((key(item), ind, item))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            ind, item = heap[0][1:]
+            process, iterator = feeds[ind]
+            process(item)
+            for item in iterator:
+                heapq.heapreplace(heap, (key(item), ind, item))
+                break
+            else:
+                heapq.heappop(heap)
+
     def plot(self, file_name='pipeline', kind='png'):
         """
         Call this method to produce a visualization of your pipeline.  The
@@ -265,6 +694,9 @@ class Pipeline(object):
         return self
 
     def __str__(self):
+        # build the pipeline repr by cycling through all the nodes
+        if self._node_repr is None:
+            self.top_node.top_down_make_repr()
         return (
             '\nPipeline\n'
             '----------------------------------'
@@ -279,3 +711,107 @@ class Pipeline(object):
     # No good way to test this unless you know dot is installed.
     def _repr_svg_(self):  # pragma: no cover
         return self.top_node._build_pydot_graph()._repr_svg_()
+
+
+class PipelineTemplate(object):
+    """
+    :type node: Node
+    :param node: Any node in a connected graph
+
+    :type pipeline_class: class
+    :param pipeline_class: The Pipeline class (or subclass) that will be
+                           created from this template.
+
+    A PipelineTemplate captures the topology of a graph of nodes once, so that
+    many independent pipelines with the same topology can be created from it
+    cheaply.  Wiring nodes with ``|`` or ``.add_downstream()`` checks the whole
+    graph for duplicate names and cycles on every connection.  A template has
+    already been validated, so each call to ``.create()`` simply connects
+    fresh copies of the template nodes and reuses the pipeline repr.
+
+    .. code-block:: python
+
+       from consecution import PipelineTemplate
+
+       template = PipelineTemplate(Extract('extract') | Load('load'))
+       for batch in batches:
+           pipe = template.create()
+           pipe.consume(batch)
+
+    The template holds a snapshot of the graph as it was when the template was
+    created.  Node copies are shallow, so node state should be initialized in
+    the ``.begin()`` method rather than the constructor.
+    """
+    def __init__(self, node, pipeline_class=Pipeline):
+        self.pipeline_class = pipeline_class
+
+        # creating a pipeline makes sure the graph has a single top node
+        prototype = pipeline_class(node)
+        str(prototype)
+        self._node_repr = prototype._node_repr
+        self._longest_node_name_len_ = prototype._longest_node_name_len_
+
+        self._nodes = prototype._walk_down()
+        index_for_node = {n: ind for (ind, n) in enumerate(self._nodes)}
+        self._edges = [
+            (index_for_node[upstream], index_for_node[downstream])
+            for upstream in self._nodes
+            for downstream in upstream._downstream_nodes
+        ]
+
+    def create(self, global_state=None, **kwargs):
+        """
+        Create a new pipeline made of fresh copies of the template nodes.
+
+        :type global_state:  object
+        :param global_state: Any python object you want to use for holding
+                             global state.
+
+        :type kwargs: keyword args
+        :param kwargs: Any other keyword args for the pipeline constructor
+
+        :rtype: Pipeline
+        :return: A new pipeline with the topology of the template
+        """
+        nodes = [node._fresh_copy() for node in self._nodes]
+
+        # the topology was validated when the template was made, so there is
+        # no need to go through add_downstream
+        for upstream_ind, downstream_ind in self._edges:
+            upstream, downstream = nodes[upstream_ind], nodes[downstream_ind]
+            upstream._downstream_nodes.append(downstream)
+            downstream._upstream_nodes.append(upstream)
+
+        # point routing nodes at the new copies of their end points
+        node_for_name = {node.name: node for node in nodes}
+        for node in nodes:
+            if hasattr(node, '_end_point_map'):
+                node._end_point_map = {
+                    name: node_for_name[name] for name in node._end_point_map
+                }
+
+        # dead-letter nodes outside the graph are copied once and shared the
+        # same way they were in the template
+        sink_copies = {}
+
+        def copy_sink(sink):
+            if sink.name in node_for_name:
+                return node_for_name[sink.name]
+            if id(sink) not in sink_copies:
+                sink_copies[id(sink)] = sink._fresh_copy()
+            return sink_copies[id(sink)]
+
+        for node in nodes:
+            if node._error_policy is not None and node._error_policy[1]:
+                policy, sink, max_per_second, max_errors = node._error_policy
+                node._error_policy = (
+                    policy, copy_sink(sink), max_per_second, max_errors)
+            if node._timeout_policy is not None and node._timeout_policy[2]:
+                seconds, policy, sink, mode = node._timeout_policy
+                node._timeout_policy = (seconds, policy, copy_sink(sink), mode)
+
+        pipeline = self.pipeline_class(
+            nodes[0], global_state=global_state, **kwargs)
+        pipeline._node_repr = self._node_repr
+        pipeline._longest_node_name_len_ = self._longest_node_name_len_
+        return pipeline
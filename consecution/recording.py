@@ -0,0 +1,242 @@
+import marshal
+import struct
+import time
+import zlib
+
+from consecution.nodes import StopPipeline
+from consecution.serialization import get_codec
+
+
+_MAGIC = b'consecution-recording-1\n'
+
+# every block is preceded by its length
+_LENGTH = struct.Struct('<I')
+
+
+class Recorder(object):
+    """
+    :type pipeline: Pipeline
+    :param pipeline: The pipeline to record.  It must not be running yet.
+
+    :type file_name: str
+    :param file_name: The file to record to.  It is overwritten.
+
+    :type codec: str or Codec
+    :param codec: The codec that encodes the items of a block
+
+    :type compression: int
+    :param compression: A zlib compression level from 1 to 9 for each block,
+                        or 0 to store blocks uncompressed
+
+    :type block_size: int
+    :param block_size: The number of items encoded together in one block
+
+    Records every item that enters the root nodes of a pipeline, however it
+    was fed, so that the input can be replayed later with a ``Replay``.
+    Each item is encoded by the codec as it enters, so nodes that change it
+    later don't change the recording.  Items are written in blocks of
+    ``block_size``, each with a length prefix.  The root node each item
+    entered is kept, so graphs with several roots replay the way they were
+    fed.
+
+    .. code-block:: python
+
+       from consecution import Recorder
+
+       with Recorder(pipe, 'input.rec', compression=1):
+           pipe.consume(production_items())
+    """
+    def __init__(self, pipeline, file_name, codec='pickle', compression=0,
+                 block_size=1000):
+        self.codec = get_codec(codec)
+        self.compression = compression
+        self.block_size = block_size
+        self.num_items = 0
+        self._pipeline = pipeline
+        self._runs = []
+        self._count = 0
+        self._file = open(file_name, 'wb')
+        self._file.write(_MAGIC)
+        self._write(marshal.dumps(
+            {'codec': self.codec.name, 'compression': compression}))
+        pipeline.add_process_wrapper(self.wrap_node)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def wrap_node(self, node, process):
+        """
+        A process wrapper for ``Pipeline.add_process_wrapper()``.  Only root
+        nodes are recorded.
+        """
+        if node._upstream_nodes:
+            return process
+        name = node.name
+        put = self._put
+
+        def recorded(item):
+            put(name, item)
+            return process(item)
+        return recorded
+
+    def _put(self, name, item):
+        data = self.codec.dumps([item])
+        runs = self._runs
+        if runs and runs[-1][0] == name:
+            runs[-1][1].append(data)
+        else:
+            runs.append((name, [data]))
+        self._count += 1
+        if self._count >= self.block_size:
+            self.flush()
+
+    def _write(self, block):
+        self._file.write(_LENGTH.pack(len(block)))
+        self._file.write(block)
+
+    def flush(self):
+        """
+        Write the items recorded so far as a block.
+        """
+        if not self._runs:
+            return
+        block = marshal.dumps(self._runs)
+        if self.compression:
+            block = zlib.compress(block, self.compression)
+        self._write(block)
+        self.num_items += self._count
+        self._runs = []
+        self._count = 0
+
+    def close(self):
+        """
+        Write the last block, close the file and stop recording the pipeline.
+        """
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+        self._pipeline.remove_process_wrapper(self.wrap_node)
+
+
+class Replay(object):
+    """
+    :type file_name: str
+    :param file_name: A file written by a ``Recorder``
+
+    :type codec: Codec
+    :param codec: The codec the file was recorded with.  Only needed for
+                  codecs that are not registered by name, like
+                  ``StructCodec``.
+
+    :type rate: float
+    :param rate: If set, items are replayed at this many items per second.
+                 Otherwise they are replayed as fast as the pipeline takes
+                 them.
+
+    Replays a recording.  Iterating a ``Replay`` yields the recorded items,
+    so it can be passed to ``.consume()``.  The
+    ``.feed()`` method instead sends each item to the root node it was
+    recorded at.
+
+    .. code-block:: python
+
+       from consecution import Replay
+
+       pipe.consume(Replay('input.rec'))
+    """
+    def __init__(self, file_name, codec=None, rate=None):
+        self.file_name = file_name
+        self.rate = rate
+        with open(file_name, 'rb') as in_file:
+            if in_file.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(
+                    '\n\n{} is not a consecution recording\n'.format(
+                        repr(file_name)))
+            header = marshal.loads(_read_block(in_file))
+        self.compression = header['compression']
+        if codec is None:
+            try:
+                codec = get_codec(header['codec'])
+            except ValueError:
+                raise ValueError(
+                    '\n\n{} was recorded with the {} codec, which is not '
+                    'registered.  Pass the codec to Replay.\n'.format(
+                        repr(file_name), repr(header['codec'])))
+        self.codec = codec
+
+    def _read_runs(self):
+        loads = self.codec.loads
+        with open(self.file_name, 'rb') as in_file:
+            in_file.read(len(_MAGIC))
+            _read_block(in_file)
+            while True:
+                block = _read_block(in_file)
+                if block is None:
+                    return
+                if self.compression:
+                    block = zlib.decompress(block)
+                for name, encoded in marshal.loads(block):
+                    yield name, [
+                        item for data in encoded for item in loads(data)]
+
+    def _paced(self, runs):
+        start, count = time.time(), 0
+        for name, items in runs:
+            for item in items:
+                delay = start + count / float(self.rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                count += 1
+                yield name, [item]
+
+    def runs(self):
+        """
+        :rtype: iterator
+        :return: An iterator of ``(root_name, items)`` tuples holding the
+                 recorded items in the order they were recorded
+        """
+        runs = self._read_runs()
+        if self.rate is None:
+            return runs
+        return self._paced(runs)
+
+    def __iter__(self):
+        for _, items in self.runs():
+            for item in items:
+                yield item
+
+    def feed(self, pipeline):
+        """
+        Send every item to the root node it was recorded at and end the
+        pipeline.
+
+        :type pipeline: Pipeline
+        :param pipeline: A pipeline with the root nodes of the recording
+
+        :return: Whatever the pipeline's ``.end()`` method returns
+        """
+        pipeline.begin()
+        processes = {node.name: node._process for node in pipeline.root_nodes}
+        try:
+            for name, items in self.runs():
+                if name not in processes:
+                    raise ValueError(
+                        '\n\nItems were recorded at root node {}, which is '
+                        'not a root of this pipeline\n'.format(repr(name)))
+                process = processes[name]
+                for item in items:
+                    process(item)
+        except StopPipeline:
+            pipeline._is_stopped = True
+        return pipeline.end()
+
+
+def _read_block(in_file):
+    prefix = in_file.read(_LENGTH.size)
+    if len(prefix) < _LENGTH.size:
+        return None
+    return in_file.read(_LENGTH.unpack(prefix)[0])
@@ -0,0 +1,165 @@
+import importlib.util
+import marshal
+import pickle
+import struct
+
+
+class Codec(object):
+    """
+    Base class for codecs that turn a batch of items into bytes and back.
+    Items cross process boundaries in batches, so codecs work on whole
+    batches and can amortize their per-call overhead over many items.
+    """
+    #: The name the codec is registered under
+    name = None
+
+    def dumps(self, items):  # pragma: no cover
+        """
+        :type items: list
+        :param items: A batch of items
+
+        :rtype: bytes
+        :return: The encoded batch
+        """
+        raise NotImplementedError
+
+    def loads(self, data):  # pragma: no cover
+        """
+        :type data: bytes
+        :param data: A batch encoded by ``.dumps()``
+
+        :rtype: list
+        :return: The items of the batch
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '{}()'.format(self.__class__.__name__)
+
+
+class PickleCodec(Codec):
+    """
+    :type protocol: int
+    :param protocol: The pickle protocol.  Defaults to 5 where available.
+
+    Handles any picklable item.  This is the default codec.
+    """
+    name = 'pickle'
+
+    def __init__(self, protocol=None):
+        if protocol is None:
+            protocol = min(5, pickle.HIGHEST_PROTOCOL)
+        self.protocol = protocol
+
+    def dumps(self, items):
+        return pickle.dumps(items, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MarshalCodec(Codec):
+    """
+    Handles items built only from None, bools, numbers, strings, bytes and
+    tuples, lists, sets and dicts of them.  Anything else raises a
+    ValueError.  The format depends on the python version, which is the same
+    on both sides of a local connection.
+    """
+    name = 'marshal'
+
+    def dumps(self, items):
+        return marshal.dumps(items)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    Handles the types msgpack supports.  Tuples come back as lists.  Needs
+    the msgpack package.
+    """
+    name = 'msgpack'
+
+    def __init__(self):
+        # doing import inside constructor so msgpack is only needed when used
+        import msgpack
+        self._packer = msgpack.Packer(use_bin_type=True)
+        self._unpackb = msgpack.unpackb
+
+    def dumps(self, items):
+        return self._packer.pack(items)
+
+    def loads(self, data):
+        return self._unpackb(data, raw=False, strict_map_key=False)
+
+
+class StructCodec(Codec):
+    """
+    :type fmt: str
+    :param fmt: A ``struct`` format string describing one item, for example
+                ``'<6sqd'``
+
+    Packs items that are tuples of fixed-size fields back to back, with no
+    per-item framing at all.  Items come back as tuples.  String fields must
+    be bytes and come back padded with null bytes to their full size.
+    """
+    name = 'struct'
+
+    def __init__(self, fmt):
+        self._struct = struct.Struct(fmt)
+
+    def dumps(self, items):
+        pack = self._struct.pack
+        return b''.join([pack(*item) for item in items])
+
+    def loads(self, data):
+        return list(self._struct.iter_unpack(data))
+
+    def __repr__(self):
+        return 'StructCodec({})'.format(repr(self._struct.format))
+
+
+_CODECS = {}
+
+
+def register_codec(name, factory):
+    """
+    Make a codec available by name.
+
+    :type name: str
+    :param name: The name of the codec
+
+    :type factory: callable
+    :param factory: A callable taking no arguments that returns a new codec
+    """
+    _CODECS[name] = factory
+
+
+def get_codec(codec):
+    """
+    :type codec: str or Codec
+    :param codec: The name of a registered codec, or a codec object
+
+    :rtype: Codec
+    :return: A codec object
+    """
+    if hasattr(codec, 'dumps') and hasattr(codec, 'loads'):
+        return codec
+    factory = _CODECS.get(codec)
+    if factory is None:
+        raise ValueError(
+            '\n\nUnknown codec {}.  Registered codecs are {}\n'.format(
+                repr(codec), sorted(_CODECS)))
+    return factory()
+
+
+def _register_builtin_codecs():
+    register_codec('pickle', PickleCodec)
+    register_codec('marshal', MarshalCodec)
+    # msgpack is optional, so its codec is only offered when it is installed
+    if importlib.util.find_spec('msgpack') is not None:
+        register_codec('msgpack', MsgpackCodec)
+
+
+_register_builtin_codecs()
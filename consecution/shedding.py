@@ -0,0 +1,217 @@
+import time
+
+from consecution.nodes import Node
+
+
+class _Shedder(Node):
+    """
+    Base class for nodes that let some items through and shed the rest.
+    Shed items are dropped, or sent to the downstream node named by
+    ``divert`` if there is one.
+    """
+    def __init__(self, name, divert=None, **kwargs):
+        super(_Shedder, self).__init__(name, **kwargs)
+        self.divert = divert
+        self.passed = 0
+        self.dropped = 0
+
+    def begin(self):
+        self.passed = 0
+        self.dropped = 0
+        if self.divert is not None:
+            names = [node.name for node in self._downstream_nodes]
+            if self.divert not in names:
+                raise ValueError(
+                    '\n\nNode {} diverts to {}, which is not one of its '
+                    'downstreams {}\n'.format(
+                        repr(self.name), repr(self.divert), sorted(names)))
+
+    def _keep(self, item):
+        self.passed += 1
+        if self.divert is None:
+            self.push(item)
+            return
+        # the push targets line up with the downstreams and are re-wired
+        # whenever one of them is replaced, so they are never stale
+        divert = self.divert
+        for node, target in zip(self._downstream_nodes, self._push_targets):
+            if node.name != divert:
+                target(item)
+
+    def _shed(self, item):
+        self.dropped += 1
+        if self.divert is None:
+            return
+        divert = self.divert
+        for node, target in zip(self._downstream_nodes, self._push_targets):
+            if node.name == divert:
+                target(item)
+
+
+class Sampler(_Shedder):
+    """
+    :type name: str
+    :param name: The name of this node
+
+    :type every: int
+    :param every: Let one in this many items through
+
+    :type divert: str
+    :param divert: The name of a downstream node that receives the items that
+                   are not sampled.  If not set, they are dropped.
+
+    Lets a fixed fraction of items through, the first of every ``every``
+    items, and sheds the rest.  The ``.passed`` and ``.dropped`` attributes
+    count the items let through and shed since the pipeline began.
+
+    .. code-block:: python
+
+       from consecution import Pipeline, Sampler
+
+       pipe = Pipeline(Sampler('one_in_ten', 10) | Expensive('expensive'))
+    """
+    def __init__(self, name, every, **kwargs):
+        super(Sampler, self).__init__(name, **kwargs)
+        self.every = every
+
+    def process(self, item):
+        if (self.passed + self.dropped) % self.every:
+            self._shed(item)
+        else:
+            self._keep(item)
+
+
+class TokenBucket(_Shedder):
+    """
+    :type name: str
+    :param name: The name of this node
+
+    :type rate: float
+    :param rate: The number of items per second let through on average
+
+    :type burst: int
+    :param burst: The most items let through at once after a quiet period.
+                  Defaults to one second's worth of items.
+
+    :type divert: str
+    :param divert: The name of a downstream node that receives the items over
+                   the limit.  If not set, they are dropped.
+
+    Limits the rate of items let through.  The bucket holds up to ``burst``
+    tokens and is refilled at ``rate`` tokens per second.  Each item let
+    through takes a token, and items arriving at an empty bucket are shed.
+    The ``.passed`` and ``.dropped`` attributes count the items let through
+    and shed since the pipeline began.
+    """
+    def __init__(self, name, rate, burst=None, **kwargs):
+        super(TokenBucket, self).__init__(name, **kwargs)
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self.burst
+        self._last = None
+
+    def begin(self):
+        super(TokenBucket, self).begin()
+        self._tokens = self.burst
+        self._last = None
+
+    def process(self, item):
+        now = time.monotonic()
+        if self._last is not None:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1.:
+            self._tokens -= 1.
+            self._keep(item)
+        else:
+            self._shed(item)
+
+
+class AdaptiveShedder(_Shedder):
+    """
+    :type name: str
+    :param name: The name of this node
+
+    :type target: float
+    :param target: The per-item latency in seconds to stay under
+
+    :type age: callable
+    :param age: An optional function of an item returning the seconds since
+                it arrived, for example from a timestamp it carries.  This
+                lets time spent waiting in a queue upstream count toward the
+                latency.  By default the latency is the time the downstream
+                nodes take to process the item.
+
+    :type smoothing: float
+    :param smoothing: The weight of each new measurement in the moving
+                      average of the latency
+
+    :type divert: str
+    :param divert: The name of a downstream node that receives the shed
+                   items.  If not set, they are dropped.
+
+    Sheds load when the latency of the items it lets through exceeds a
+    target.  The latency of every kept item is measured and averaged.  While
+    the average is over the target, the fraction of items let through is cut
+    by a quarter for every item measured.  While it is under, the fraction
+    grows back by a hundredth per item.  Kept items are spread evenly over
+    the input rather than chosen at random.  The ``.passed`` and ``.dropped``
+    attributes count the items let through and shed since the pipeline
+    began, ``.latency`` holds the average latency and ``.admit`` the
+    fraction of items currently let through.
+
+    .. code-block:: python
+
+       from consecution import AdaptiveShedder
+
+       shedder = AdaptiveShedder(
+           'shed', target=0.005, age=lambda item: time.time() - item['ts'])
+       pipe = Pipeline(shedder | Enrich('enrich') | Store('store'))
+    """
+    #: The factor the admitted fraction is cut by while over the target
+    decrease = 0.75
+    #: The amount the admitted fraction grows by while under the target
+    increase = 0.01
+    #: The admitted fraction never falls below this, so that the latency is
+    #: still measured now and then
+    min_admit = 0.01
+
+    def __init__(self, name, target, age=None, smoothing=0.1, **kwargs):
+        super(AdaptiveShedder, self).__init__(name, **kwargs)
+        self.target = target
+        self.age = age
+        self.smoothing = smoothing
+        self.latency = 0.
+        self.admit = 1.
+        self._credit = 0.
+
+    def begin(self):
+        super(AdaptiveShedder, self).begin()
+        self.latency = 0.
+        self.admit = 1.
+        self._credit = 0.
+
+    def process(self, item):
+        # items are admitted whenever the credit they build up reaches one
+        self._credit += self.admit
+        if self._credit < 1.:
+            self._shed(item)
+            return
+        self._credit -= 1.
+
+        if self.age is None:
+            start = time.perf_counter()
+            self._keep(item)
+            latency = time.perf_counter() - start
+        else:
+            self._keep(item)
+            latency = self.age(item)
+        self._measure(latency)
+
+    def _measure(self, latency):
+        self.latency += self.smoothing * (latency - self.latency)
+        if self.latency > self.target:
+            self.admit = max(self.min_admit, self.admit * self.decrease)
+        else:
+            self.admit = min(1., self.admit + self.increase)
@@ -0,0 +1,167 @@
+from array import array
+from itertools import count
+from unittest import TestCase
+
+from mock import patch
+import numpy
+
+from consecution.batches import (
+    ColumnBatch, ToColumnBatch, FromColumnBatch, iter_batches)
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline, PipelineTemplate, GlobalState
+from consecution.tests.testing_helpers import print_catcher
+from consecution.tuning import BatchTuner
+
+
+RECORDS = [
+    {'name': 'a', 'age': 12, 'spent': 1.5},
+    {'name': 'b', 'age': 45, 'spent': 20.},
+    {'name': 'c', 'age': 33, 'spent': 7.25},
+]
+
+
+class ColumnBatchTests(TestCase):
+    def test_from_records_infers_columns(self):
+        batch = ColumnBatch.from_records(RECORDS)
+        self.assertEqual(batch.names, ['name', 'age', 'spent'])
+        self.assertEqual(len(batch), 3)
+        self.assertIsInstance(batch['name'], list)
+        self.assertEqual(batch['age'].typecode, 'q')
+        self.assertEqual(batch['spent'].typecode, 'd')
+        self.assertTrue('age' in batch)
+        self.assertEqual(list(batch.columns.keys()), batch.names)
+
+    def test_from_records_typecodes_and_bools(self):
+        batch = ColumnBatch.from_records(
+            [{'x': 1, 'flag': True, 'skipped': 0}],
+            names=['x', 'flag'], typecodes={'x': 'd'})
+        self.assertEqual(batch.names, ['x', 'flag'])
+        self.assertEqual(batch['x'].typecode, 'd')
+        self.assertEqual(batch['flag'], [True])
+
+    def test_ints_out_of_range(self):
+        records = [{'id': 2 ** 63 - 1}, {'id': -2 ** 63}]
+        self.assertEqual(
+            ColumnBatch.from_records(records)['id'].typecode, 'q')
+        for big in [2 ** 63, -2 ** 63 - 1, 2 ** 64, 10 ** 400]:
+            batch = ColumnBatch.from_records([{'id': 1, 'x': 1.5}, {'id': big, 'x': big}])
+            self.assertEqual(batch['id'], [1, big])
+            self.assertEqual(batch['x'], [1.5, big])
+        batches = list(iter_batches([{'id': 2 ** 64}], 10))
+        self.assertEqual(batches[0]['id'], [2 ** 64])
+
+    def test_empty(self):
+        batch = ColumnBatch.from_records([])
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(batch.names, [])
+
+    def test_unequal_lengths(self):
+        with self.assertRaises(ValueError):
+            ColumnBatch({'a': [1, 2], 'b': [1]})
+
+    def test_select_slice_and_printing(self):
+        batch = ColumnBatch.from_records(RECORDS)
+        projected = batch.select('age')
+        self.assertEqual(projected.names, ['age'])
+        self.assertIs(projected['age'], batch['age'])
+
+        sliced = batch[1:]
+        self.assertEqual(sliced.to_records(), RECORDS[1:])
+
+        with print_catcher() as catcher:
+            print(repr(sliced))
+        self.assertTrue('rows=2' in catcher.txt)
+
+    def test_filter_and_take(self):
+        batch = ColumnBatch.from_records(RECORDS)
+        adults = batch.filter([age >= 18 for age in batch['age']])
+        self.assertEqual(adults.to_records(), RECORDS[1:])
+        self.assertEqual(adults['age'].typecode, 'q')
+
+        taken = batch.take([2, 0])
+        self.assertEqual(taken.to_records(), [RECORDS[2], RECORDS[0]])
+
+        with self.assertRaises(ValueError):
+            batch.filter([True])
+
+    def test_with_column(self):
+        batch = ColumnBatch.from_records(RECORDS).select('age')
+        batch = batch.with_column('double', array('q', [24, 90, 66]))
+        self.assertEqual(batch.names, ['age', 'double'])
+        self.assertEqual(batch.to_records()[0], {'age': 12, 'double': 24})
+
+    def test_numpy_columns(self):
+        batch = ColumnBatch.from_records(RECORDS, use_numpy=True)
+        self.assertIsInstance(batch['age'], numpy.ndarray)
+        adults = batch.filter(batch['age'] >= 18)
+        self.assertEqual(adults.to_records(), RECORDS[1:])
+        self.assertEqual(batch.take([2]).to_records(), [RECORDS[2]])
+
+    def test_iter_batches(self):
+        batches = list(iter_batches(RECORDS, 2))
+        self.assertEqual([len(b) for b in batches], [2, 1])
+        self.assertEqual(len(list(iter_batches(RECORDS, 3))), 1)
+
+
+class Collect(Node):
+    def process(self, item):
+        self.global_state.items.append(item)
+
+
+class BatchNodeTests(TestCase):
+    def test_round_trip(self):
+        nodes = ToColumnBatch('to_batch', batch_size=2) | FromColumnBatch('from_batch') | Collect('collect')
+        pipe = Pipeline(nodes, global_state=GlobalState(items=[]))
+        pipe.consume(RECORDS)
+        self.assertEqual(pipe.global_state.items, RECORDS)
+
+        pipe.global_state.items = []
+        pipe['from_batch'].process(ColumnBatch([]))
+        self.assertEqual(pipe.global_state.items, [])
+
+    def test_batches_pushed(self):
+        to_batch = ToColumnBatch('to_batch', batch_size=2, use_numpy=True)
+        pipe = Pipeline(to_batch | Collect('collect'), global_state=GlobalState(items=[]))
+        pipe.consume(RECORDS)
+        self.assertEqual([len(b) for b in pipe.global_state.items], [2, 1])
+
+        # an exact multiple of the batch size leaves nothing to flush at end
+        pipe.global_state.items = []
+        pipe.consume(RECORDS[:2])
+        self.assertEqual([len(b) for b in pipe.global_state.items], [2])
+
+        pipe.reset()
+        self.assertEqual(pipe['to_batch']._records, [])
+
+    def test_template_copies_are_empty(self):
+        template = PipelineTemplate(
+            ToColumnBatch('to_batch', batch_size=10) | Collect('collect'))
+        pipe1 = template.create(GlobalState(items=[]))
+        pipe2 = template.create(GlobalState(items=[]))
+        pipe1.push(RECORDS[0])
+        pipe2.consume(RECORDS[1:])
+        pipe1.end()
+        self.assertEqual(
+            [b.to_records() for b in pipe1.global_state.items], [RECORDS[:1]])
+        self.assertEqual(
+            [b.to_records() for b in pipe2.global_state.items], [RECORDS[1:]])
+
+    @patch('consecution.batches.time')
+    def test_tuned_batch_size(self, time):
+        # every batch takes a second, so bigger batches are faster
+        time.perf_counter.side_effect = count()
+        to_batch = ToColumnBatch('to_batch', BatchTuner(1, 4, window=1))
+        template = PipelineTemplate(to_batch | Collect('collect'))
+        pipe = template.create(GlobalState(items=[]))
+        pipe.consume(RECORDS * 5)
+        self.assertEqual(
+            [len(b) for b in pipe.global_state.items], [1, 2, 4, 4, 4])
+        self.assertIs(
+            pipe.batch_tuners['to_batch'], pipe['to_batch'].batch_tuner)
+        self.assertEqual(pipe.batch_tuners['to_batch'].size, 4)
+
+        # templates make nodes with tuners of their own
+        other = template.create(GlobalState(items=[]))
+        self.assertIsNot(
+            other['to_batch'].batch_tuner, pipe['to_batch'].batch_tuner)
+        self.assertEqual(other['to_batch'].batch_size, 1)
@@ -0,0 +1,126 @@
+import io
+from unittest import TestCase
+
+from mock import patch
+
+from consecution.cli import iter_line_batches, load_pipeline, main
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline, GlobalState
+
+
+class Collect(Node):
+    def process(self, item):
+        self.global_state.items.append(item)
+
+
+class CollectPipeline(Pipeline):
+    def end(self):
+        return self.global_state.items
+
+
+def make_pipeline():
+    return CollectPipeline(
+        Collect('collect'), global_state=GlobalState(items=[]))
+
+
+class Drop(Node):
+    def process(self, item):
+        pass
+
+
+def make_node():
+    return Drop('drop')
+
+
+FACTORY = 'consecution.tests.cli_tests:make_pipeline'
+
+
+class IterLineBatchesTests(TestCase):
+    def test_lines_across_blocks(self):
+        data = u'one\ntwo\n\nthrée\nfour'.encode('utf-8')
+        expected = [u'one', u'two', u'', u'thrée', u'four']
+        # small buffers cut lines and multi-byte characters in pieces
+        for buffer_size in [1, 2, 3, 5, 100]:
+            batches = list(iter_line_batches(io.BytesIO(data), buffer_size))
+            self.assertEqual(sum(batches, []), expected)
+
+    def test_bytes(self):
+        batches = iter_line_batches(
+            io.BytesIO(b'a\nb\n'), buffer_size=3, encoding=None)
+        self.assertEqual(sum(batches, []), [b'a', b'b'])
+        batches = iter_line_batches(io.BytesIO(b'a\nb'), encoding=None)
+        self.assertEqual(list(batches), [[b'a'], [b'b']])
+
+    def test_empty(self):
+        self.assertEqual(list(iter_line_batches(io.BytesIO(b''))), [])
+
+
+class LoadPipelineTests(TestCase):
+    def test_factories(self):
+        self.assertIsInstance(load_pipeline(FACTORY), CollectPipeline)
+        pipe = load_pipeline('consecution.tests.cli_tests:make_node')
+        self.assertIsInstance(pipe, Pipeline)
+        self.assertEqual(pipe.top_node.name, 'drop')
+
+    def test_bad_spec(self):
+        for spec in ['consecution.tests.cli_tests', ':make_node']:
+            with self.assertRaises(ValueError):
+                load_pipeline(spec)
+
+
+class MainTests(TestCase):
+    def run_main(self, args, data=b'a\nb\nc\nd\ne\n'):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        result = main(args, io.BytesIO(data), stdout, stderr)
+        return result, stdout.getvalue(), stderr.getvalue()
+
+    def test_run(self):
+        result, out, err = self.run_main(['run', FACTORY])
+        self.assertEqual(result, ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(out, "['a', 'b', 'c', 'd', 'e']\n")
+        self.assertEqual(err, '')
+
+    def test_nothing_returned(self):
+        result, out, _ = self.run_main(
+            ['run', 'consecution.tests.cli_tests:make_node'])
+        self.assertIsNone(result)
+        self.assertEqual(out, '')
+
+    def test_batch_size(self):
+        result, _, _ = self.run_main(
+            ['run', FACTORY, '--batch-size', '2', '--buffer-size', '3'])
+        self.assertEqual(result, [['a', 'b'], ['c', 'd'], ['e']])
+        result, _, _ = self.run_main(
+            ['run', FACTORY, '--batch-size', '5'])
+        self.assertEqual(result, [['a', 'b', 'c', 'd', 'e']])
+
+    def test_bytes(self):
+        result, _, _ = self.run_main(['run', FACTORY, '--bytes'], b'a\nb')
+        self.assertEqual(result, [b'a', b'b'])
+
+    def test_stats(self):
+        _, _, err = self.run_main(['run', FACTORY, '--stats'])
+        lines = err.splitlines()
+        self.assertEqual(lines[0].split(), ['node', 'items', 'seconds', 'us/item'])
+        self.assertEqual(lines[1].split()[:2], ['collect', '5'])
+        self.assertTrue(lines[-1].startswith('5 lines in'))
+
+    def test_profile(self):
+        _, _, err = self.run_main(
+            ['run', FACTORY, '--profile', '--sort', 'calls', '--limit', '3'])
+        self.assertIn('function calls', err)
+        self.assertIn('Ordered by: call count', err)
+
+    def test_module(self):
+        import consecution.__main__
+        self.assertIs(consecution.__main__.main, main)
+
+    def test_stdin(self):
+        class Stdin(object):
+            buffer = io.BytesIO(b'x\ny\n')
+
+        with patch('consecution.cli.sys') as sys:
+            sys.stdin = Stdin()
+            sys.stdout = io.StringIO()
+            self.assertEqual(main(['run', FACTORY]), ['x', 'y'])
+            self.assertEqual(sys.stdout.getvalue(), "['x', 'y']\n")
@@ -0,0 +1,133 @@
+from unittest import TestCase
+
+from consecution.control import Take, TakeWhile
+from consecution.nodes import GroupByNode, Node, StopPipeline
+from consecution.pipeline import Pipeline, GlobalState
+
+
+class Collect(Node):
+    def begin(self):
+        self.global_state.log.append('begin_' + self.name)
+
+    def process(self, item):
+        self.global_state.items.append(item)
+
+    def end(self):
+        self.global_state.log.append('end_' + self.name)
+
+
+class Pass(Node):
+    def process(self, item):
+        self.push(item)
+
+
+class Group(GroupByNode):
+    def key(self, item):
+        return item // 3
+
+    def process(self, batch):
+        self.push(batch)
+
+
+class ControlTests(TestCase):
+    def setUp(self):
+        self.pulled = []
+
+    def source(self, num=1000):
+        for ind in range(num):
+            self.pulled.append(ind)
+            yield ind
+
+    def make_pipeline(self, node):
+        return Pipeline(
+            node | Collect('collect'),
+            global_state=GlobalState(items=[], log=[])
+        )
+
+    def test_take(self):
+        pipe = self.make_pipeline(Take('take', 3))
+        pipe.consume(self.source())
+        self.assertEqual(pipe.global_state.items, [0, 1, 2])
+        self.assertEqual(self.pulled, [0, 1, 2])
+        self.assertEqual(
+            pipe.global_state.log, ['begin_collect', 'end_collect'])
+
+        # the count is reset when the pipeline begins again
+        pipe.global_state.items = []
+        pipe.consume(range(5))
+        self.assertEqual(pipe.global_state.items, [0, 1, 2])
+
+    def test_take_zero(self):
+        pipe = self.make_pipeline(Take('take', 0))
+        pipe.consume(self.source())
+        self.assertEqual(pipe.global_state.items, [])
+        self.assertEqual(self.pulled, [0])
+
+    def test_take_while(self):
+        pipe = self.make_pipeline(TakeWhile('take', lambda item: item < 4))
+        pipe.consume(self.source())
+        self.assertEqual(pipe.global_state.items, [0, 1, 2, 3])
+        self.assertEqual(self.pulled, [0, 1, 2, 3, 4])
+
+        pipe.global_state.items = []
+        pipe.consume(self.source(3))
+        self.assertEqual(pipe.global_state.items, [0, 1, 2])
+
+    def test_push_ignored_after_stop(self):
+        pipe = self.make_pipeline(Take('take', 2))
+        for item in range(5):
+            pipe.push(item)
+        self.assertEqual(pipe.global_state.items, [0, 1])
+        pipe.end()
+        self.assertEqual(pipe.global_state.log[-1], 'end_collect')
+
+        pipe.push(7)
+        self.assertEqual(pipe.global_state.items, [0, 1, 7])
+
+    def test_stream(self):
+        pipe = Pipeline(Take('take', 2) | Pass('pass'))
+        self.assertEqual(list(pipe.stream(self.source())), [0, 1])
+        self.assertEqual(self.pulled, [0, 1])
+
+    def test_stop_from_custom_node(self):
+        class Stopper(Node):
+            def process(self, item):
+                if item == 'stop':
+                    raise StopPipeline()
+                self.push(item)
+
+        pipe = self.make_pipeline(Stopper('stopper'))
+        pipe.consume(['a', 'stop', 'b'])
+        self.assertEqual(pipe.global_state.items, ['a'])
+
+    def test_stop_while_ending(self):
+        # the last group is pushed from .end(), after the take has stopped
+        pipe = Pipeline(
+            Group('group') | Take('take', 1) | Collect('collect'),
+            global_state=GlobalState(items=[], log=[]))
+        pipe.consume(range(10))
+        self.assertEqual(pipe.global_state.items, [[0, 1, 2]])
+        self.assertEqual(
+            pipe.global_state.log, ['begin_collect', 'end_collect'])
+        self.assertFalse(pipe._is_running)
+
+        take = TakeWhile('take', lambda batch: batch[0] < 3)
+        pipe = Pipeline(
+            Group('group') | take | Collect('collect'),
+            global_state=GlobalState(items=[], log=[]))
+        self.assertEqual(list(pipe.stream(range(8))), [])
+        self.assertEqual(pipe.global_state.items, [[0, 1, 2]])
+        self.assertFalse(pipe._is_running)
+
+    def test_stop_from_end(self):
+        # a node that stops the pipeline while ending does not keep the
+        # nodes after it from ending
+        class StopAtEnd(Pass):
+            def end(self):
+                raise StopPipeline()
+
+        pipe = self.make_pipeline(StopAtEnd('stop'))
+        pipe.consume(range(2))
+        self.assertEqual(pipe.global_state.items, [0, 1])
+        self.assertEqual(pipe.global_state.log[-1], 'end_collect')
+        self.assertFalse(pipe._is_running)
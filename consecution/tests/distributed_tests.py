@@ -0,0 +1,412 @@
+from contextlib import suppress
+import marshal
+import multiprocessing
+import os
+import threading
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from consecution.control import Take
+from consecution.distributed import (
+    DistributedPipeline, RemoteError, _Channel, _END)
+from consecution.joins import HashJoin
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline, GlobalState
+from consecution.serialization import MarshalCodec, PickleCodec, StructCodec
+from consecution.tuning import BatchTuner
+
+
+class Double(Node):
+    def process(self, item):
+        self.push(2 * item)
+
+
+class Strip(Node):
+    def process(self, item):
+        self.push(item[1])
+
+
+class Fail(Node):
+    def process(self, item):
+        if item == 6:
+            raise ValueError('bad item {}'.format(item))
+        self.push(item)
+
+
+class Collect(Node):
+    def begin(self):
+        self.global_state.log.append('begin_' + self.name)
+
+    def process(self, item):
+        self.global_state.pids.add(os.getpid())
+        self.global_state.items.append(item)
+
+    def end(self):
+        self.global_state.log.append('end_' + self.name)
+
+
+class Record(Node):
+    def begin(self):
+        self.global_state.log.append('begin_' + self.name)
+
+    def process(self, item):
+        self.global_state.pids.add(os.getpid())
+        self.push(item)
+
+    def end(self):
+        self.global_state.log.append('end_' + self.name)
+
+
+def make_state():
+    return GlobalState(items=[], log=[], pids=set())
+
+
+def route(item):
+    return item[0]
+
+
+class ThreadProcess(threading.Thread):
+    """
+    Runs a partition in a thread of the test process so that coverage sees
+    the code that normally runs in a child process.
+    """
+    def __init__(self, target, args, name):
+        super(ThreadProcess, self).__init__(name=name)
+        self._target_args = (target, args)
+
+    def run(self):
+        # the coordinator may close the control pipe before a failing
+        # partition reports
+        target, args = self._target_args
+        with suppress(Exception):
+            target(*args)
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        super(ThreadProcess, self).join(5)
+
+
+class SharedEnd(object):
+    """
+    The coordinator closes its copy of the child's end of the control pipe.
+    With threads there is only one copy, so closing it is left to the child.
+    """
+    def __init__(self, conn):
+        self.send = conn.send
+
+    def close(self):
+        pass
+
+
+class ThreadContext(object):
+    Process = ThreadProcess
+
+    @staticmethod
+    def Pipe(duplex=True):
+        receiver, sender = multiprocessing.Pipe(duplex)
+        return receiver, SharedEnd(sender)
+
+
+def in_threads():
+    return patch(
+        'consecution.distributed.multiprocessing.get_context',
+        return_value=ThreadContext)
+
+
+class ChannelTests(TestCase):
+    def test_batches_and_runs(self):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        channel = _Channel(
+            sender, 3, {'a': PickleCodec(), 'b': MarshalCodec()})
+
+        def recv():
+            return [(name, channel.codecs[name].loads(data))
+                    for (name, data) in marshal.loads(receiver.recv_bytes())]
+
+        self.assertFalse(channel.put('a', 1))
+        self.assertFalse(channel.put('a', 2))
+        self.assertTrue(channel.put('b', 3))
+        self.assertEqual(recv(), [('a', [1, 2]), ('b', [3])])
+        channel.flush()
+        self.assertFalse(receiver.poll())
+        channel.put('b', 4)
+        channel.close()
+        self.assertEqual(recv(), [('b', [4])])
+        self.assertEqual(receiver.recv_bytes(), _END)
+
+    @patch('consecution.distributed.time')
+    def test_tuned_frames(self, time):
+        # a frame takes a second to send and two to fill
+        time.perf_counter.side_effect = [0, 2, 3, 3, 5, 6]
+        tuner = BatchTuner(1, 10, window=1)
+        channel = _Channel(Mock(), tuner, {'a': PickleCodec()})
+        self.assertIsNot(channel.batch_tuner, tuner)
+        self.assertTrue(channel.put('a', 1))
+        self.assertEqual(channel.batch_size, 2)
+        self.assertFalse(channel.put('a', 2))
+        self.assertTrue(channel.put('a', 3))
+        self.assertEqual(channel.batch_size, 4)
+        self.assertEqual(channel.batch_tuner.latency, 3)
+        self.assertEqual(channel.batch_tuner.items_per_second, 2)
+
+
+class PlanTests(TestCase):
+    def make_pipeline(self):
+        return Pipeline(
+            Double('a') | [route, Record('b'), Record('c')] | Collect('d'))
+
+    def check_bad(self, partitions, pipeline=None, **kwargs):
+        with self.assertRaises(ValueError):
+            DistributedPipeline(
+                pipeline or self.make_pipeline(), partitions, **kwargs)
+
+    def test_bad_partitions(self):
+        self.check_bad([['a'], [], ['b', 'c', 'd']])
+        self.check_bad([['a', 'x'], ['b', 'c', 'd']])
+        self.check_bad([['a', 'b'], ['b', 'c', 'd']])
+        self.check_bad([['a'], ['b', 'c']])
+        self.check_bad([['a'], ['b'], ['c', 'd']])
+        self.check_bad([['a', 'a.route'], ['b', 'c', 'd']])
+        self.check_bad([['a', 'b', 'c', 'd']], family='AF_PIPE')
+        self.check_bad(
+            [['a', 'b', 'c']],
+            pipeline=Pipeline([Double('a'), Double('b')] | Collect('c')))
+
+    def test_partitions_not_cyclic(self):
+        pipe = Pipeline(Double('a') | Double('b') | Double('c'))
+        self.check_bad([['a', 'c'], ['b']], pipeline=pipe)
+
+    def test_partitions_connected(self):
+        pipe = Pipeline(Double('a') | [
+            Double('b') | Double('d'), Double('c') | Double('e')])
+        self.check_bad([['a', 'b', 'c'], ['d', 'e']], pipeline=pipe)
+
+    def test_partition_diamond(self):
+        a, b, c, d = Double('a'), Double('b'), Double('c'), Collect('d')
+        a.add_downstream(b)
+        a.add_downstream(c)
+        b.add_downstream(d)
+        c.add_downstream(d)
+        pipe = Pipeline(a)
+        dist = DistributedPipeline(pipe, [['a', 'b'], ['c'], ['d']])
+        self.assertEqual(dist._partitions[2].upstreams, {0, 1})
+
+    def test_one_outlet_per_partition(self):
+        pipe = Pipeline(Double('a') | [Double('b'), Double('c')])
+        dist = DistributedPipeline(pipe, [['a'], ['b', 'c']])
+        local = dist._partitions[0].build({1: Mock()})
+        self.assertEqual(
+            [n.name for n in local['a']._downstream_nodes],
+            ['a.to_partition_1'])
+        local = dist._partitions[1].build({})
+        self.assertEqual(
+            sorted(n.name for n in local['a']._downstream_nodes), ['b', 'c'])
+
+    def test_codecs(self):
+        marshal_codec = MarshalCodec()
+        dist = DistributedPipeline(
+            self.make_pipeline(), [['a'], ['b', 'c', 'd']],
+            codecs={(None, 'a'): marshal_codec, 'a': 'msgpack'})
+        codecs = dist._partitions[0].codecs
+        self.assertIs(codecs[('a', 0)], marshal_codec)
+        self.assertEqual(codecs[('a', 1)].name, 'msgpack')
+
+        dist = DistributedPipeline(
+            self.make_pipeline(), [['a'], ['b', 'c', 'd']],
+            default_codec='marshal')
+        self.assertEqual(
+            sorted((k, c.name) for (k, c) in dist._partitions[1].codecs.items()),
+            [(('a', 0), 'marshal'), (('a', 1), 'marshal')])
+
+    def test_bad_codecs(self):
+        pipe = Pipeline(Double('a') | [Double('b'), Double('c')])
+        partitions = [['a'], ['b', 'c']]
+        # edges sharing a connection must share a codec
+        self.check_bad(
+            partitions, pipeline=pipe,
+            codecs={('a', 'b'): 'marshal', ('a', 'c'): 'pickle'})
+        # edges must cross partitions
+        self.check_bad(partitions, pipeline=pipe, codecs={'b': 'marshal'})
+        self.check_bad(partitions, pipeline=pipe, codecs={'a': 'yaml'})
+
+    def test_router_joins_its_end_points(self):
+        dist = DistributedPipeline(
+            self.make_pipeline(), [['a'], ['b', 'c', 'd']])
+        self.assertEqual(dist._partitions[1].partition_of['a.route'], 1)
+        self.assertEqual(dist._partitions[1].inlets, {'a': ['a.route']})
+        self.assertEqual(dist._partitions[0].downstreams, {1})
+
+
+class ThreadedDistributedTests(TestCase):
+    def test_consume(self):
+        pipe = Pipeline(
+            Record('a') | Double('b') | Record('c') | Collect('d'),
+            global_state=make_state())
+        dist = DistributedPipeline(
+            pipe, [['a', 'b'], ['c'], ['d']], batch_size=3)
+        with in_threads():
+            dist.consume(range(10))
+        state = dist.global_states[2]
+        self.assertEqual(state.items, [2 * n for n in range(10)])
+        # every process begins before items flow and ends in top-down order
+        self.assertEqual(
+            set(state.log[:3]), {'begin_a', 'begin_c', 'begin_d'})
+        self.assertEqual(state.log[3:], ['end_a', 'end_c', 'end_d'])
+
+    def test_codecs(self):
+        pipe = Pipeline(
+            Double('a') | Strip('b') | Collect('c'), global_state=make_state())
+        dist = DistributedPipeline(
+            pipe, [['a'], ['b'], ['c']], batch_size=3,
+            codecs={
+                (None, 'a'): StructCodec('<4sq'),
+                ('a', 'b'): 'marshal',
+                'b': 'msgpack',
+            })
+        with in_threads():
+            dist.consume((b'item', n) for n in range(10))
+        self.assertEqual(dist.global_states[2].items, list(range(10)))
+
+    def test_push(self):
+        pipe = Pipeline(Double('a') | Collect('b'), global_state=make_state())
+        dist = DistributedPipeline(pipe, [['a'], ['b']], batch_size=2)
+        with in_threads():
+            for item in [1, 2, 3]:
+                dist.push(item)
+            dist.flush()
+            dist.end()
+        self.assertEqual(dist.global_states[1].items, [2, 4, 6])
+
+    def test_tuned_batch_size(self):
+        pipe = Pipeline(
+            Double('a') | Double('b') | Collect('c'), global_state=make_state())
+        dist = DistributedPipeline(
+            pipe, [['a'], ['b'], ['c']], batch_size=BatchTuner(1, 8))
+        with in_threads():
+            dist.consume(range(10))
+        self.assertEqual(dist.global_states[2].items, [4 * n for n in range(10)])
+        self.assertEqual(sorted(dist.batch_tuners), [
+            'coordinator.to_partition_0', 'partition_0.to_partition_1',
+            'partition_1.to_partition_2'])
+        self.assertEqual(
+            {tuner.min_size for tuner in dist.batch_tuners.values()}, {1})
+
+    def test_router_and_join(self):
+        join = HashJoin('join', 'events', 'users', route)
+        pipe = Pipeline(
+            Record('source') | [route, Strip('events'), Strip('users')] | join | Collect('collect'),
+            global_state=make_state())
+        dist = DistributedPipeline(
+            pipe, [['source'], ['events', 'users'], ['join', 'collect']])
+        items = [
+            ('users', (1, 'ann')), ('events', (1, 'click')),
+            ('events', (2, 'view')), ('users', (2, 'bob')),
+        ]
+        with in_threads():
+            dist.consume(items)
+        self.assertEqual(
+            sorted(dist.global_states[2].items),
+            [((1, 'click'), (1, 'ann')), ((2, 'view'), (2, 'bob'))])
+
+    def test_stop(self):
+        pipe = Pipeline(
+            Double('a') | Take('take', 3) | Collect('b'),
+            global_state=make_state())
+        dist = DistributedPipeline(pipe, [['a'], ['take', 'b']], batch_size=2)
+        pulled = []
+
+        def source():
+            num = 0
+            while True:
+                pulled.append(num)
+                yield num
+                num += 1
+
+        with in_threads():
+            dist.consume(source())
+        self.assertEqual(dist.global_states[1].items, [0, 2, 4])
+        self.assertLess(len(pulled), 10 ** 5)
+
+        # once stopped, pushes are ignored until the pipeline ends
+        dist._is_stopped, dist._is_running = True, True
+        dist.push(1)
+
+    def test_error(self):
+        pipe = Pipeline(
+            Double('a') | Fail('fail') | Collect('b'),
+            global_state=make_state())
+        dist = DistributedPipeline(pipe, [['a'], ['fail', 'b']], batch_size=1)
+        with in_threads():
+            with self.assertRaises(RemoteError) as context:
+                dist.consume(range(10))
+        self.assertIn('Partition 1 failed', str(context.exception))
+        self.assertIn('bad item 6', str(context.exception))
+        self.assertFalse(dist._is_running)
+
+    def make_dead(self, *message_lists):
+        # a pipeline whose partitions sent these messages before exiting
+        dist = DistributedPipeline(
+            Pipeline(Double('a') | Collect('b')), [['a'], ['b']])
+        receivers = []
+        for messages in message_lists:
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            for message in messages:
+                sender.send(message)
+            sender.close()
+            receivers.append(receiver)
+        dist._controls = receivers
+        dist._processes, dist._listeners, dist._feed = [], [], Mock()
+        return dist
+
+    def test_failed_send(self):
+        dist = self.make_dead(
+            [('broken', None)], [('error', 'Traceback: boom')])
+        channel = _Channel(Mock(), 1, {'a': PickleCodec()})
+        channel.conn.send_bytes.side_effect = BrokenPipeError()
+        with self.assertRaises(RemoteError) as context:
+            dist._send(channel.put, 'a', 1)
+        self.assertIn('Partition 1 failed', str(context.exception))
+        self.assertIn('boom', str(context.exception))
+
+    def test_process_died(self):
+        dist = self.make_dead([('done', 1)], [])
+        with self.assertRaises(RemoteError) as context:
+            dist._wait_for('done')
+        self.assertIn('exited unexpectedly', str(context.exception))
+
+    def test_stop_while_waiting(self):
+        dist = self.make_dead([('stop', None), ('done', 1)], [('done', 2)])
+        dist._wait_for('done')
+        self.assertEqual(dist.global_states, [1, 2])
+        self.assertTrue(dist._is_stopped)
+
+
+class ProcessDistributedTests(TestCase):
+    def test_runs_in_processes(self):
+        for family in ['AF_UNIX', 'AF_INET']:
+            pipe = Pipeline(
+                Record('a') | Double('b') | Collect('c'),
+                global_state=make_state())
+            dist = DistributedPipeline(
+                pipe, [['a'], ['b', 'c']], batch_size=7, family=family)
+            dist.consume(range(100))
+
+            first, second = dist.global_states
+            self.assertEqual(second.items, [2 * n for n in range(100)])
+            self.assertEqual(second.log, ['begin_c', 'end_c'])
+            self.assertEqual(pipe.global_state.items, [])
+            pids = first.pids | second.pids
+            self.assertEqual(len(pids), 2)
+            self.assertNotIn(os.getpid(), pids)
+
+    def test_error_in_process(self):
+        pipe = Pipeline(
+            Double('a') | Fail('fail') | Collect('b'),
+            global_state=make_state())
+        dist = DistributedPipeline(pipe, [['a'], ['fail', 'b']], batch_size=2)
+        with self.assertRaises(RemoteError) as context:
+            dist.consume(range(100000))
+        self.assertIn('bad item 6', str(context.exception))
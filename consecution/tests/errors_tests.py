@@ -0,0 +1,237 @@
+from unittest import TestCase
+
+from mock import patch
+
+from consecution.errors import DeadLetter, ErrorCounts
+from consecution.control import Take
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline, PipelineTemplate, GlobalState
+
+
+class Parse(Node):
+    def process(self, item):
+        self.push(int(item))
+
+
+class Collect(Node):
+    def begin(self):
+        self.global_state.log.append('begin_' + self.name)
+
+    def process(self, item):
+        self.global_state.items.append(item)
+
+    def end(self):
+        self.global_state.log.append('end_' + self.name)
+
+
+class Sink(Node):
+    def begin(self):
+        self.global_state.log.append('begin_' + self.name)
+
+    def process(self, item):
+        self.global_state.dead.append(item)
+
+    def end(self):
+        self.global_state.log.append('end_' + self.name)
+
+
+class Fail(Node):
+    def process(self, item):
+        if item == 2:
+            raise ValueError('downstream failure')
+
+
+def make_state():
+    return GlobalState(items=[], dead=[], log=[])
+
+
+class ErrorPolicyTests(TestCase):
+    def test_raise_by_default(self):
+        pipe = Pipeline(Parse('parse') | Collect('collect'),
+                        global_state=make_state())
+        with self.assertRaises(ValueError):
+            pipe.consume(['1', 'x'])
+
+    def test_happy_path_not_wrapped(self):
+        parse = Parse('parse')
+        parse.on_error('skip')
+        parse.on_error('raise')
+        pipe = Pipeline(parse | Collect('collect'), global_state=make_state())
+        pipe.consume(['1'])
+        collect = pipe['collect']
+        self.assertEqual(collect._process, collect.process)
+        self.assertEqual(parse._process, parse.process)
+        self.assertEqual(pipe.error_counts, {})
+
+    def test_skip(self):
+        parse = Parse('parse')
+        parse.on_error('skip')
+        pipe = Pipeline(parse | Collect('collect'), global_state=make_state())
+        pipe.consume(['1', 'x', '3', 'y'])
+        self.assertEqual(pipe.global_state.items, [1, 3])
+        counts = pipe.error_counts['parse']
+        self.assertEqual(
+            (counts.errors, counts.dead_lettered, counts.rate_limited),
+            (2, 0, 0))
+        self.assertIn('errors=2', repr(counts))
+
+    def test_dead_letter(self):
+        parse = Parse('parse')
+        parse.on_error('dead_letter', sink=Sink('sink'))
+        pipe = Pipeline(parse | Collect('collect'), global_state=make_state())
+        pipe.consume(['1', 'x', '3'])
+        self.assertEqual(pipe.global_state.items, [1, 3])
+        dead, = pipe.global_state.dead
+        self.assertIsInstance(dead, DeadLetter)
+        self.assertEqual(dead.item, 'x')
+        self.assertEqual(dead.node_name, 'parse')
+        self.assertIsInstance(dead.error, ValueError)
+        self.assertIn('Traceback', dead.traceback)
+        self.assertIn('int(item)', dead.traceback)
+        self.assertIn("node_name='parse'", repr(dead))
+        self.assertEqual(pipe.error_counts['parse'].dead_lettered, 1)
+        self.assertEqual(pipe['sink'].pipeline, pipe)
+        self.assertEqual(
+            pipe.global_state.log,
+            ['begin_sink', 'begin_collect', 'end_collect', 'end_sink'])
+
+    def test_shared_sink_begins_once(self):
+        sink = Sink('sink')
+        parse_a, parse_b = Parse('parse_a'), Parse('parse_b')
+        parse_a.on_error('dead_letter', sink=sink)
+        parse_b.on_error('dead_letter', sink=sink)
+        pipe = Pipeline(
+            Take('take', 10) | [parse_a, parse_b] | Collect('collect'),
+            global_state=make_state())
+        pipe.consume(['x'])
+        self.assertEqual(
+            [d.node_name for d in pipe.global_state.dead],
+            ['parse_a', 'parse_b'])
+        self.assertEqual(pipe.global_state.log.count('begin_sink'), 1)
+
+    def test_sink_in_graph(self):
+        sink = Sink('sink')
+        parse = Parse('parse')
+        parse.on_error('dead_letter', sink=sink)
+        pipe = Pipeline(parse | sink, global_state=make_state())
+        pipe.consume(['1', 'x'])
+        self.assertEqual(pipe.global_state.dead[0], 1)
+        self.assertEqual(pipe.global_state.dead[1].item, 'x')
+        self.assertEqual(pipe.global_state.log, ['begin_sink', 'end_sink'])
+
+    def test_sink_name_conflict(self):
+        parse = Parse('parse')
+        parse.on_error('dead_letter', sink=Sink('collect'))
+        with self.assertRaises(ValueError):
+            Pipeline(parse | Collect('collect'))
+
+    def test_rate_limit(self):
+        parse = Parse('parse')
+        parse.on_error('dead_letter', sink=Sink('sink'), max_per_second=2)
+        pipe = Pipeline(parse | Collect('collect'), global_state=make_state())
+        with patch('consecution.errors.time.time') as clock:
+            clock.return_value = 100.
+            pipe.consume(['a', 'b', 'c', 'd'])
+            self.assertEqual(len(pipe.global_state.dead), 2)
+            counts = pipe.error_counts['parse']
+            self.assertEqual((counts.dead_lettered, counts.rate_limited),
+                             (2, 2))
+
+            # a new window opens after a second
+            pipe.begin()
+            clock.return_value = 101.5
+            pipe.push('e')
+            pipe.end()
+        self.assertEqual(len(pipe.global_state.dead), 3)
+        self.assertEqual(pipe.error_counts['parse'].rate_limited, 0)
+
+    def test_max_errors(self):
+        parse = Parse('parse')
+        parse.on_error('skip', max_errors=2)
+        pipe = Pipeline(parse | Collect('collect'), global_state=make_state())
+        with self.assertRaises(ValueError):
+            pipe.consume(['x', '1', 'y', 'z', '2'])
+        self.assertEqual(pipe.global_state.items, [1])
+        self.assertEqual(pipe.error_counts['parse'].errors, 3)
+
+    def test_stop_pipeline_passes_through(self):
+        take = Take('take', 2)
+        take.on_error('skip')
+        pipe = Pipeline(take | Collect('collect'), global_state=make_state())
+        pipe.consume(range(10))
+        self.assertEqual(pipe.global_state.items, [0, 1])
+        self.assertEqual(pipe.error_counts['take'].errors, 0)
+
+    def test_downstream_error_passes_through(self):
+        parse = Parse('parse')
+        parse.on_error('dead_letter', sink=Sink('sink'))
+        pipe = Pipeline(parse | Fail('fail'), global_state=make_state())
+        with self.assertRaisesRegex(ValueError, 'downstream failure'):
+            pipe.consume(['1', '2', '3'])
+        self.assertEqual(pipe.global_state.dead, [])
+        self.assertEqual(pipe.error_counts['parse'].errors, 0)
+
+    def test_downstream_error_handled_downstream(self):
+        parse = Parse('parse')
+        parse.on_error('skip')
+        fail = Fail('fail')
+        fail.on_error('skip')
+        pipe = Pipeline(
+            parse | [fail, Collect('collect')], global_state=make_state())
+        pipe.consume(['1', '2', 'x', '3'])
+        self.assertEqual(pipe.global_state.items, [1, 2, 3])
+        self.assertEqual(pipe.error_counts['parse'].errors, 1)
+        self.assertEqual(pipe.error_counts['fail'].errors, 1)
+
+    def test_own_error_after_caught_downstream_error(self):
+        class Guarded(Node):
+            def process(self, item):
+                try:
+                    self.push(item)
+                except ValueError:
+                    raise ValueError('own failure')
+
+        guarded = Guarded('guarded')
+        guarded.on_error('dead_letter', sink=Sink('sink'))
+        pipe = Pipeline(guarded | Fail('fail'), global_state=make_state())
+        pipe.consume([1, 2, 3])
+        dead, = pipe.global_state.dead
+        self.assertEqual((dead.item, dead.node_name), (2, 'guarded'))
+        self.assertIn('own failure', dead.traceback)
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            Parse('parse').on_error('ignore')
+        with self.assertRaises(ValueError):
+            Parse('parse').on_error('dead_letter')
+
+    def test_template_copies_sink(self):
+        sink = Sink('sink')
+        parse_a, parse_b, parse_c = (
+            Parse('parse_a'), Parse('parse_b'), Parse('parse_c'))
+        parse_a.on_error('dead_letter', sink=sink)
+        parse_b.on_error('dead_letter', sink=sink)
+        parse_c.on_error('skip')
+        in_graph = Sink('in_graph')
+        parse_d = Parse('parse_d')
+        parse_d.on_error('dead_letter', sink=in_graph)
+        template = PipelineTemplate(Pipeline(
+            Take('take', 10) | [parse_a, parse_b, parse_c, parse_d] | in_graph))
+
+        pipe = template.create(global_state=make_state())
+        copy_a = pipe['parse_a']._error_policy[1]
+        self.assertIsNot(copy_a, sink)
+        self.assertIs(pipe['parse_b']._error_policy[1], copy_a)
+        self.assertIs(pipe['parse_d']._error_policy[1], pipe['in_graph'])
+        pipe.consume(['x'])
+        self.assertEqual(
+            sorted(d.node_name for d in pipe.global_state.dead
+                   if isinstance(d, DeadLetter)),
+            ['parse_a', 'parse_b', 'parse_d'])
+        self.assertIs(copy_a.pipeline, pipe)
+        self.assertIsNot(sink.pipeline, pipe)
+
+    def test_error_counts_repr(self):
+        self.assertEqual(
+            repr(ErrorCounts()),
+            'ErrorCounts(errors=0, dead_lettered=0, rate_limited=0)')
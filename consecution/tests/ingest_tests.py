@@ -0,0 +1,208 @@
+from queue import SimpleQueue
+import threading
+from unittest import TestCase
+
+from mock import patch
+
+from consecution.control import Take
+from consecution.ingest import ThreadedPusher
+from consecution.nodes import GroupByNode, Node
+from consecution.pipeline import Pipeline, GlobalState
+from consecution.tuning import BatchTuner
+
+
+class Batch(GroupByNode):
+    def key(self, item):
+        return item[0]
+
+    def process(self, batch):
+        self.push(len(batch))
+
+
+class Collect(Node):
+    def begin(self):
+        self.global_state.begins += 1
+        self.global_state.threads.add(threading.current_thread().name)
+
+    def process(self, item):
+        self.global_state.threads.add(threading.current_thread().name)
+        self.global_state.items.append(item)
+
+    def end(self):
+        self.global_state.ends += 1
+
+
+class Fail(Node):
+    def process(self, item):
+        if item == 'fail':
+            raise ValueError('bad item')
+        self.push(item)
+
+
+class SlowQueue(SimpleQueue):
+    # holds up the put of the 'slow' item until released
+    entered = threading.Event()
+    release = threading.Event()
+
+    def put(self, item):
+        if item == 'slow':
+            self.entered.set()
+            self.release.wait()
+        super(SlowQueue, self).put(item)
+
+
+class ThreadedPusherTests(TestCase):
+    def make_pipeline(self, node):
+        return Pipeline(
+            node | Collect('collect'),
+            global_state=GlobalState(
+                items=[], begins=0, ends=0, threads=set())
+        )
+
+    def test_many_producers(self):
+        pipe = self.make_pipeline(Batch('batch'))
+        pusher = ThreadedPusher(pipe, max_batch_size=7)
+
+        def produce(producer):
+            for ind in range(1000):
+                pusher.push((producer, ind))
+
+        threads = [
+            threading.Thread(target=produce, args=(num,)) for num in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pusher.close()
+
+        state = pipe.global_state
+        self.assertEqual(sum(state.items), 4000)
+        self.assertEqual((state.begins, state.ends), (1, 1))
+        self.assertEqual(state.threads, {'consecution-pusher'})
+        self.assertEqual(pusher.num_items, 4000)
+        self.assertGreaterEqual(pusher.num_batches, 4000 // 7)
+
+        # closing again is harmless but pushing is not allowed
+        pusher.close()
+        with self.assertRaises(ValueError):
+            pusher.push(1)
+
+    def test_close_while_pushing(self):
+        # every push that was accepted is processed and counted
+        for _ in range(5):
+            pipe = Pipeline(Collect('collect'), global_state=GlobalState(
+                items=[], begins=0, ends=0, threads=set()))
+            pusher = ThreadedPusher(pipe, max_batch_size=7)
+            accepted = [0] * 4
+
+            def produce(producer):
+                while True:
+                    try:
+                        pusher.push(producer)
+                    except ValueError:
+                        return
+                    accepted[producer] += 1
+
+            threads = [
+                threading.Thread(target=produce, args=(num,))
+                for num in range(4)]
+            for thread in threads:
+                thread.start()
+            pusher.close()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(pipe.global_state.items), sum(accepted))
+            self.assertEqual(pusher.num_items, sum(accepted))
+
+    @patch('consecution.ingest.SimpleQueue', SlowQueue)
+    def test_close_waits_for_push(self):
+        pipe = Pipeline(Collect('collect'), global_state=GlobalState(
+            items=[], begins=0, ends=0, threads=set()))
+        pusher = ThreadedPusher(pipe)
+        producer = threading.Thread(target=pusher.push, args=('slow',))
+        self.addCleanup(SlowQueue.release.set)
+        producer.start()
+        SlowQueue.entered.wait()
+        closer = threading.Thread(target=pusher.close)
+        closer.start()
+        closer.join(.05)
+        self.assertTrue(closer.is_alive())
+        SlowQueue.release.set()
+        producer.join()
+        closer.join()
+        self.assertEqual(pipe.global_state.items, ['slow'])
+        self.assertEqual(pusher.num_items, 1)
+
+    def test_multiple_roots(self):
+        pipe = Pipeline([Node('a'), Node('b')] | Collect('collect'))
+        with self.assertRaises(ValueError):
+            ThreadedPusher(pipe)
+
+    def test_context_manager_and_result(self):
+        class Summing(Pipeline):
+            def end(self):
+                return sum(self.global_state.items)
+
+        pipe = Summing(Collect('collect'), global_state=GlobalState(
+            items=[], begins=0, ends=0, threads=set()))
+        with ThreadedPusher(pipe) as pusher:
+            for ind in range(10):
+                pusher.push(ind)
+        self.assertEqual(pusher.close(), 45)
+
+    def test_error(self):
+        pipe = self.make_pipeline(Fail('fail'))
+        pusher = ThreadedPusher(pipe)
+        for item in ['a', 'fail', 'b']:
+            pusher.push(item)
+        with self.assertRaises(ValueError):
+            pusher.close()
+        self.assertEqual(pipe.global_state.ends, 0)
+        with self.assertRaises(ValueError):
+            pusher.push('c')
+
+    def test_error_in_end(self):
+        class BadEnd(Node):
+            def process(self, item):  # pragma: no cover
+                pass
+
+            def end(self):
+                raise ValueError('bad end')
+
+        pusher = ThreadedPusher(Pipeline(BadEnd('bad')))
+        with self.assertRaises(ValueError):
+            pusher.close()
+
+    def test_error_before_close_drains(self):
+        pipe = self.make_pipeline(Fail('fail'))
+        pusher = ThreadedPusher(pipe)
+        pusher.push('fail')
+        while pusher._error is None:  # pragma: no cover  timing dependent
+            pusher._thread.join(0.01)
+        with self.assertRaises(ValueError):
+            pusher.push('a')
+        with self.assertRaises(ValueError):
+            pusher.close()
+
+    def test_stop(self):
+        pipe = self.make_pipeline(Take('take', 2))
+        pusher = ThreadedPusher(pipe, max_batch_size=2)
+        for ind in range(10):
+            pusher.push(ind)
+        pusher.close()
+        self.assertEqual(pipe.global_state.items, [0, 1])
+        self.assertEqual(pipe.global_state.ends, 1)
+
+    def test_tuned_batch_size(self):
+        pipe = self.make_pipeline(Fail('fail'))
+        tuner = BatchTuner(1, 4, window=1)
+        pusher = ThreadedPusher(pipe, max_batch_size=tuner)
+        for ind in range(20):
+            pusher.push(ind)
+        pusher.close()
+        self.assertEqual(pipe.global_state.items, list(range(20)))
+        self.assertIs(pipe.batch_tuners['pusher'], tuner)
+        self.assertEqual(pusher.num_items, 20)
+        self.assertGreater(pusher.num_batches, 1)
+        self.assertEqual(pusher.max_batch_size, tuner.size)
@@ -0,0 +1,193 @@
+from unittest import TestCase
+
+from consecution.joins import HashJoin, MergeJoin
+from consecution.metrics import MetricsCollector
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline, PipelineTemplate
+from consecution.tracing import Tracer
+
+
+USERS = [(1, 'ann'), (2, 'bob'), (4, 'dee')]
+EVENTS = [(1, 'click'), (1, 'view'), (3, 'view'), (4, 'buy')]
+
+INNER = [
+    ((1, 'click'), (1, 'ann')),
+    ((1, 'view'), (1, 'ann')),
+    ((4, 'buy'), (4, 'dee')),
+]
+LEFT = INNER + [((3, 'view'), None)]
+OUTER = LEFT + [(None, (2, 'bob'))]
+
+
+def first(item):
+    return item[0]
+
+
+class Pass(Node):
+    def process(self, item):
+        self.push(item)
+
+
+class Collect(Node):
+    def begin(self):
+        self.global_state.items = []
+
+    def process(self, item):
+        self.global_state.items.append(item)
+
+
+def make_pipeline(join):
+    return Pipeline(
+        [Pass('events'), Pass('users')] | join | Collect('collect'))
+
+
+def by_repr(items):
+    return sorted(items, key=repr)
+
+
+class HashJoinTests(TestCase):
+    def run_join(self, order=None, **kwargs):
+        pipe = make_pipeline(
+            HashJoin('join', 'events', 'users', first, **kwargs))
+        pipe.consume_sources(
+            {'events': EVENTS, 'users': USERS}, order=order)
+        return by_repr(pipe.global_state.items)
+
+    def test_join_types(self):
+        for how, expected in [
+                ('inner', INNER), ('left', LEFT), ('outer', OUTER)]:
+            self.assertEqual(self.run_join(how=how), by_repr(expected))
+            self.assertEqual(
+                self.run_join(how=how, build='left'), by_repr(expected))
+
+    def test_build_first(self):
+        for how, expected in [('left', LEFT), ('outer', OUTER)]:
+            self.assertEqual(
+                self.run_join(
+                    how=how, build_first=True, order=['users', 'events']),
+                by_repr(expected))
+
+        with self.assertRaises(ValueError):
+            self.run_join(build_first=True)
+
+    def test_spill(self):
+        for how, expected in [
+                ('inner', INNER), ('left', LEFT), ('outer', OUTER)]:
+            self.assertEqual(
+                self.run_join(how=how, max_items=2, num_partitions=3),
+                by_repr(expected))
+        self.assertEqual(
+            self.run_join(
+                how='outer', build_first=True, order=['users', 'events'],
+                max_items=1),
+            by_repr(OUTER))
+
+    def test_template(self):
+        template = PipelineTemplate(make_pipeline(
+            HashJoin('join', 'events', 'users', first, max_items=1)))
+        for _ in range(2):
+            pipe = template.create()
+            pipe.consume_sources({'events': EVENTS, 'users': USERS})
+            self.assertEqual(by_repr(pipe.global_state.items), by_repr(INNER))
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            HashJoin('join', 'a', 'b', first, how='cross')
+        with self.assertRaises(ValueError):
+            HashJoin('join', 'a', 'b', first, build='both')
+
+    def test_bad_wiring(self):
+        pipe = Pipeline(
+            Pass('other') | HashJoin('join', 'events', 'users', first))
+        with self.assertRaises(ValueError):
+            pipe.consume([1])
+
+        pipe = Pipeline(HashJoin('join', 'events', 'users', first))
+        with self.assertRaises(ValueError):
+            pipe.consume([1])
+
+
+class WrappedJoinTests(TestCase):
+    def test_error_policy(self):
+        class Dead(Node):
+            def process(self, item):
+                self.global_state.dead.append(item)
+
+        join = HashJoin('join', 'events', 'users', first)
+        join.on_error('dead_letter', sink=Dead('dead'))
+        pipe = make_pipeline(join)
+        pipe.global_state.dead = []
+        pipe.consume_sources({'events': EVENTS + [()], 'users': USERS})
+        self.assertEqual(by_repr(pipe.global_state.items), by_repr(INNER))
+        self.assertEqual(pipe.error_counts['join'].errors, 1)
+        dead, = pipe.global_state.dead
+        self.assertEqual((dead.node_name, dead.item), ('join', ('events', ())))
+
+    def test_instrumented(self):
+        pipe = make_pipeline(HashJoin('join', 'events', 'users', first))
+        collector = MetricsCollector()
+        pipe.add_process_wrapper(collector.wrap_node)
+        tracer = Tracer(pipe, sample_every=1)
+        pipe.consume_sources({'events': EVENTS, 'users': USERS})
+        self.assertEqual(by_repr(pipe.global_state.items), by_repr(INNER))
+        self.assertEqual(collector.counters['join'].items, 7)
+        names = {span[0] for trace in tracer.traces for span in trace.spans}
+        self.assertIn('join', names)
+
+    def test_not_tagged(self):
+        join = HashJoin('join', 'events', 'users', first)
+        join.log('input')
+        pipe = Pipeline(join)
+        with self.assertRaises(ValueError):
+            pipe.consume([('other', 1)])
+
+
+class MergeJoinTests(TestCase):
+    def run_join(self, key=None, events=EVENTS, users=USERS, **kwargs):
+        pipe = make_pipeline(
+            MergeJoin('join', 'events', 'users', first, **kwargs))
+        pipe.consume_sources({'events': events, 'users': users}, key=key)
+        return pipe.global_state.items
+
+    def test_join_types(self):
+        for key in [None, first]:
+            for how, expected in [
+                    ('inner', INNER), ('left', LEFT), ('outer', OUTER)]:
+                self.assertEqual(
+                    by_repr(self.run_join(key=key, how=how)),
+                    by_repr(expected))
+
+    def test_many_to_many(self):
+        items = self.run_join(
+            events=[(1, 'a'), (1, 'b'), (2, 'c')],
+            users=[(1, 'x'), (1, 'y')],
+            right_key=first)
+        self.assertEqual(len(items), 4)
+
+    def test_constant_memory_when_merged(self):
+        class Watch(Node):
+            def process(self, item):
+                join = self.pipeline['join']
+                self.global_state.held = max(
+                    self.global_state.held,
+                    len(join._lefts) + len(join._rights))
+                self.push(item)
+
+        events = [(num, 'event') for num in range(1000)]
+        users = [(num, 'user') for num in range(1000)]
+        join = MergeJoin('join', 'events', 'users', first)
+        pipe = Pipeline(
+            [Pass('events'), Pass('users')] | join | Watch('watch') | Collect('collect'))
+        pipe.global_state.held = 0
+        pipe.consume_sources({'events': events, 'users': users}, key=first)
+        self.assertEqual(len(pipe.global_state.items), 1000)
+        self.assertLessEqual(pipe.global_state.held, 2)
+
+    def test_trailing_items(self):
+        items = self.run_join(
+            events=[(1, 'a')], users=[(1, 'x'), (9, 'z')], how='outer')
+        self.assertEqual(items, [((1, 'a'), (1, 'x')), (None, (9, 'z'))])
+
+    def test_unsorted(self):
+        with self.assertRaises(ValueError):
+            self.run_join(events=[(2, 'a'), (1, 'b')])
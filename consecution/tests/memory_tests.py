@@ -0,0 +1,104 @@
+from unittest import TestCase
+import tracemalloc
+
+from consecution.memory import MemoryProfiler
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline, GlobalState
+from consecution.tests.testing_helpers import print_catcher
+
+MEGABYTE = 2 ** 20
+
+
+class Hoarder(Node):
+    def begin(self):
+        self.kept = []
+
+    def process(self, item):
+        self.kept.append(bytearray(MEGABYTE))
+        self.push(item)
+
+    def end(self):
+        self.kept = []
+
+
+class Spiker(Node):
+    def process(self, item):
+        spike = bytearray(4 * MEGABYTE)
+        del spike
+        self.push(item)
+
+
+class Pass(Node):
+    def process(self, item):
+        self.push(item)
+
+
+class Sink(Node):
+    def process(self, item):
+        pass
+
+
+class MemoryProfilerTests(TestCase):
+    def setUp(self):
+        self.pipe = Pipeline(
+            Hoarder('hoarder') | Spiker('spiker') | Sink('sink'),
+            profile_memory=True
+        )
+
+    def test_attribution(self):
+        with print_catcher('stderr') as catcher:
+            self.pipe.consume(range(3))
+        stats = self.pipe.memory_stats
+        self.assertFalse(tracemalloc.is_tracing())
+
+        hoarder, spiker = stats['hoarder'], stats['spiker']
+        self.assertEqual(hoarder['process'].calls, 3)
+        self.assertEqual(stats['sink']['process'].calls, 3)
+
+        # the hoarder keeps what it allocates, but is not charged for the
+        # spike that happens downstream of it
+        self.assertGreater(hoarder['process'].retained, 3 * MEGABYTE)
+        self.assertLess(hoarder['process'].retained, 3.5 * MEGABYTE)
+        self.assertLess(hoarder['process'].peak, 2 * MEGABYTE)
+
+        # the spiker frees what it allocates
+        self.assertLess(abs(spiker['process'].retained), MEGABYTE)
+        self.assertGreater(spiker['process'].peak, 4 * MEGABYTE)
+
+        # memory is given back when the hoarder ends
+        self.assertLess(hoarder['end'].retained, -2 * MEGABYTE)
+        self.assertEqual(hoarder['begin'].calls, 1)
+
+        self.assertTrue('hoarder' in catcher.txt)
+        self.assertTrue('retained' in catcher.txt)
+        self.assertTrue('MemoryUsage(calls=3' in repr(hoarder['process']))
+
+    def test_already_tracing(self):
+        tracemalloc.start()
+        try:
+            with print_catcher('stderr'):
+                self.pipe.consume(range(1))
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+    def test_errors_unwind_stack(self):
+        class Fail(Node):
+            def process(self, item):
+                raise ValueError('boom')
+
+        pipe = Pipeline(Pass('a') | Fail('fail'), profile_memory=True)
+        with self.assertRaises(ValueError):
+            pipe.consume(range(1))
+        self.assertEqual(pipe.memory_profiler._stack, [])
+        pipe.memory_profiler.stop()
+
+    def test_off_by_default(self):
+        pipe = Pipeline(Sink('sink'), global_state=GlobalState())
+        self.assertIsNone(pipe.memory_stats)
+        profiler = MemoryProfiler()
+        self.assertEqual(profiler.report().count('\n'), 1)
+
+        # only phases that were measured are reported
+        self.assertEqual(profiler.call('node', 'process', len, [1, 2]), 2)
+        self.assertEqual(profiler.report().count('\n'), 2)
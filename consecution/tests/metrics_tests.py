@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+from urllib.request import urlopen
+
+from consecution.batches import ToColumnBatch
+from consecution.control import Take
+from consecution.metrics import MetricsReporter, MetricsCollector
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline
+from consecution.tuning import BatchTuner
+
+
+class Slow(Node):
+    def process(self, item):
+        time.sleep(.01)
+        self.push(item)
+
+
+class Fast(Node):
+    def process(self, item):
+        if item == 'bad':
+            raise ValueError('bad item')
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.pipe = Pipeline(Slow('slow') | Fast('fast"\n\\'))
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_counters(self):
+        reporter = MetricsReporter(self.pipe, interval=100)
+        self.pipe.consume(range(5))
+        counters = reporter.collector.counters
+        slow, fast = counters['slow'], counters['fast"\n\\']
+        self.assertEqual((slow.items, fast.items), (5, 5))
+
+        # time spent downstream is not charged to the slow node, and vice
+        # versa
+        self.assertGreater(slow.seconds, .05)
+        self.assertLess(fast.seconds, .01)
+        self.assertTrue('items=5' in repr(slow))
+
+        with self.assertRaises(ValueError):
+            self.pipe.consume(['bad'])
+        self.assertEqual(fast.errors, 1)
+
+        # stopping a reporter that never started just takes a snapshot
+        reporter.stop()
+        self.assertEqual(len(reporter.history), 1)
+
+        # a stopped reporter no longer instruments the pipeline, and starting
+        # it again does
+        self.pipe.consume(range(2))
+        self.assertEqual(slow.items, 6)
+        reporter.start()
+        self.pipe.consume(range(2))
+        reporter.stop()
+        reporter.stop()
+        self.pipe.consume(range(2))
+        self.assertEqual(slow.items, 8)
+
+        # stopping the pipeline is not an error
+        pipe = Pipeline(Take('take', 0))
+        collector = MetricsCollector()
+        pipe.add_process_wrapper(collector.wrap_node)
+        pipe.consume(range(2))
+        self.assertEqual(collector.counters['take'].errors, 0)
+
+    def test_sampling(self):
+        reporter = MetricsReporter(self.pipe, sample_every=2)
+        self.pipe.consume(range(5))
+        for counters in reporter.collector.counters.values():
+            self.assertEqual((counters.items, counters.timed), (5, 2))
+        slow = reporter.collector.counters['slow']
+        self.assertGreater(slow.seconds, .02)
+        self.assertLess(slow.seconds, .04)
+
+        # errors in sampled items are counted
+        with self.assertRaises(ValueError):
+            self.pipe.consume(['bad'])
+        self.assertEqual(reporter.collector.counters['fast"\n\\'].errors, 1)
+        self.assertFalse(reporter.collector._sampling[0])
+
+    def test_render_and_file(self):
+        path = os.path.join(self.temp_dir, 'metrics.prom')
+        reporter = MetricsReporter(self.pipe, interval=100, path=path)
+        self.assertTrue('# TYPE consecution_node_items_total counter' in
+                        reporter.render())
+
+        reporter.start()
+        self.pipe.consume(range(3))
+        reporter.stop()
+        with open(path) as in_file:
+            text = in_file.read()
+        self.assertEqual(text, reporter.render())
+        self.assertTrue(
+            'consecution_node_items_total{node="slow"} 3' in text)
+        self.assertTrue('node="fast\\"\\n\\\\"' in text)
+        self.assertTrue('consecution_node_latency_seconds{node="slow"}' in text)
+        self.assertEqual(os.listdir(self.temp_dir), ['metrics.prom'])
+
+    def test_batch_size(self):
+        pipe = Pipeline(
+            ToColumnBatch('to_batch', BatchTuner(start=50)) | Fast('fast'))
+        reporter = MetricsReporter(pipe)
+        self.assertTrue(
+            'consecution_batch_size{node="to_batch"} 50\n' in reporter.render())
+
+    def test_ring_buffer(self):
+        reporter = MetricsReporter(self.pipe, interval=.005, history=3)
+        with reporter:
+            self.pipe.consume(range(3))
+            time.sleep(.03)
+        self.assertEqual(len(reporter.history), 3)
+        rates = reporter._rates()
+        self.assertEqual(rates['slow'][1], 0.)
+
+        # an empty interval has no throughput
+        reporter.history.append(reporter.history[-1])
+        self.assertEqual(reporter._rates()['slow'], (0., 0.))
+
+    def test_http(self):
+        with MetricsReporter(self.pipe, interval=100, port=0) as reporter:
+            self.pipe.consume(range(2))
+            reporter.snapshot()
+            response = urlopen(
+                'http://127.0.0.1:{}/metrics'.format(reporter.port))
+            text = response.read().decode('utf-8')
+        self.assertTrue(
+            response.headers['Content-Type'].startswith('text/plain'))
+        self.assertTrue(
+            'consecution_node_items_total{node="slow"} 2' in text)
+
+    def test_must_attach_before_running(self):
+        self.pipe.push(1)
+        with self.assertRaises(ValueError):
+            MetricsReporter(self.pipe)
@@ -4,6 +4,8 @@ import shutil
 import tempfile
 from unittest import TestCase
 import subprocess
+import threading
+import time
 
 from mock import patch
 
@@ -47,6 +49,35 @@ class NodeUnitTests(TestCase):
         n = Node('my_node', silly_attribute='silly')
         self.assertEqual(n.silly_attribute, 'silly')
 
+    def test_compact(self):
+        class Sub(Node):
+            def begin(self):
+                self.total = 0
+
+        n = Node('a')
+        self.assertEqual(n.__dict__, {})
+        self.assertIsNone(n._clock)
+        self.assertIs(n.clock, n.clock)
+
+        sub = Sub('b')
+        sub.begin()
+        self.assertEqual(sub.__dict__, {'total': 0})
+
+        n | sub
+        self.assertEqual(
+            n._pydot_edge_kwarg_list, [dict(tail_name='a', head_name='b')])
+        self.assertEqual(n._pydot_node_kwargs, dict(name='a', shape='rectangle'))
+
+    def test_assign_clock(self):
+        class Timed(Node):
+            def begin(self):
+                self.clock = 'my_clock'
+
+        n = Timed('a')
+        n.begin()
+        self.assertEqual(n.clock, 'my_clock')
+        self.assertEqual(n.__dict__, {})
+
     def test_comparisons(self):
         a = Node('a')
         b = Node('b')
@@ -303,6 +334,75 @@ class DSLWiringTests(ExplicitWiringTests):
         self.do_graph_wiring()
 
 
+class TopologyCacheTests(TestCase):
+    def setUp(self):
+        self.a, self.b, self.c = Node('a'), Node('b'), Node('c')
+        self.a | self.b
+
+    def count_walks(self, func):
+        with patch.object(
+                Node, 'depth_first_walk', autospec=True,
+                side_effect=Node.depth_first_walk) as walk:
+            func()
+        return walk.call_count
+
+    def test_queries_are_cached(self):
+        def query():
+            for node in [self.a, self.b]:
+                node.all_nodes
+                node.root_nodes
+                node.top_node
+                node.terminal_node_set
+                node.initial_node_set
+
+        # the first round of queries needs walks.  Repeats don't.
+        self.assertGreater(self.count_walks(query), 0)
+        self.assertEqual(self.count_walks(query), 0)
+
+    def test_component_shares_cache(self):
+        self.a.all_nodes
+        self.assertIs(self.a._topology_cache, self.b._topology_cache)
+        self.assertIsNot(self.a._topology_cache, self.c._topology_cache)
+
+    def test_invalidated_by_add_and_remove(self):
+        self.assertEqual(self.a.terminal_node_set, {self.b})
+        self.b | self.c
+        self.assertEqual(self.a.terminal_node_set, {self.c})
+        self.assertEqual(self.c.all_nodes, {self.a, self.b, self.c})
+        self.assertEqual(self.c.top_node, self.a)
+
+        self.a.remove_downstream(self.b)
+        self.assertEqual(self.a.all_nodes, {self.a})
+        self.assertEqual(self.c.initial_node_set, {self.b})
+        self.assertEqual(self.c.root_nodes, [self.b])
+
+    def test_replace_with(self):
+        self.a.add_downstream(self.c)
+        self.a.remove_downstream(self.c)
+        self.assertEqual(
+            [kw['head_name'] for kw in self.a._pydot_edge_kwarg_list], ['b'])
+
+        # the cache was invalidated by the removal
+        replacement = Node('b')
+        self.b._replace_with(replacement)
+        self.assertEqual(self.a.all_nodes, {self.a, replacement})
+        self.assertEqual(replacement.top_node, self.a)
+        self.assertEqual(self.b.all_nodes, {self.b})
+
+        # a valid cache is updated in place
+        self.a.all_nodes
+        replacement._replace_with(self.b)
+        self.assertEqual(self.a.all_nodes, {self.a, self.b})
+        self.assertEqual(self.a.terminal_node_set, {self.b})
+        self.assertEqual(replacement.all_nodes, {replacement})
+
+    def test_results_are_copies(self):
+        self.a.all_nodes.clear()
+        self.a.root_nodes.pop()
+        self.assertEqual(self.a.all_nodes, {self.a, self.b})
+        self.assertEqual(self.a.root_nodes, [self.a])
+
+
 class TopDownCallTests(TestCase):
     def test_call_order_okay(self):
 
@@ -344,6 +444,48 @@ class TopDownCallTests(TestCase):
         self.assertTrue(call_number[e] < call_number[f])
         self.assertTrue(call_number[f] < call_number[g])
 
+    def test_layers(self):
+        a, b, c, d, e, f, g = [Node(name) for name in 'abcdefg']
+        a | [b | c, d | e | f] | g
+        layers = [[n.name for n in layer] for layer in g.topological_layers]
+        self.assertEqual(
+            layers, [['a'], ['b', 'd'], ['c', 'e'], ['f'], ['g']])
+
+    def test_layers_detect_cycles(self):
+        a, b = Node('a'), Node('b')
+        a | b
+        # sneak in a cycle behind the back of add_downstream
+        b._downstream_nodes.append(a)
+        a._upstream_nodes.append(b)
+        a._topology_cache.invalidate()
+        with self.assertRaises(ValueError):
+            a.topological_layers
+
+    def test_concurrent_calls(self):
+        class Slow(Node):
+            def begin(self):
+                time.sleep(.2)
+                self.threads.append(threading.current_thread().name)
+
+        threads = []
+        top = Node('top')
+        top | [Slow('s{}'.format(ind), threads=threads) for ind in range(4)]
+
+        starting = time.time()
+        top.top_down_call('begin', max_workers=4)
+        self.assertLess(time.time() - starting, .6)
+        self.assertEqual(len(set(threads)), 4)
+
+    def test_concurrent_call_errors(self):
+        class Bad(Node):
+            def begin(self):
+                raise RuntimeError('bad begin')
+
+        top = Node('top')
+        top | [Bad('bad'), Node('good')]
+        with self.assertRaises(RuntimeError):
+            top.top_down_call('begin', max_workers=2)
+
 
 class BreadthFirstSearchTests(TestCase):
     def test_top_down_order(self):
@@ -1,8 +1,10 @@
 from __future__ import print_function
 from collections import namedtuple, Counter
 from unittest import TestCase
-from consecution.nodes import Node, GroupByNode
-from consecution.pipeline import Pipeline, GlobalState
+from mock import patch
+from consecution.nodes import (
+    Node, GroupByNode, StreamingGroupByNode, StopPipeline)
+from consecution.pipeline import Pipeline, PipelineTemplate, GlobalState
 from consecution.tests.testing_helpers import print_catcher
 
 Item = namedtuple('Item', 'value parent source')
@@ -217,6 +219,54 @@ class PipelineUnitTests(TestCase):
         self.assertTrue(pipe['a'].was_reset)
         self.assertTrue(pipe['b'].was_reset)
 
+    def test_remove_process_wrapper(self):
+        calls = []
+
+        def wrapper(node, process):
+            def wrapped(item):
+                calls.append(node.name)
+                return process(item)
+            return wrapped
+
+        pipe = Pipeline(TestNode('a') | ResultNode('b'))
+        pipe.add_process_wrapper(wrapper)
+        pipe.global_state.final_items = []
+        pipe.consume(item_generator())
+        self.assertEqual(calls, ['a', 'b', 'a', 'b'])
+
+        pipe.remove_process_wrapper(wrapper)
+        pipe.consume(item_generator())
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(pipe.global_state.final_items), 4)
+        with self.assertRaises(ValueError):
+            pipe.remove_process_wrapper(wrapper)
+
+
+class HookWorkerTests(TestCase):
+    def test_begin_and_end_order(self):
+        class N(Node):
+            def begin(self):
+                self.global_state.calls.append(('begin', self.name))
+
+            def process(self, item):
+                self.push(item)
+
+            def end(self):
+                self.global_state.calls.append(('end', self.name))
+
+        pipe = Pipeline(
+            N('a') | [N('b'), N('c')] | N('d'),
+            global_state=GlobalState(calls=[]),
+            hook_workers=2,
+        )
+        pipe.consume(range(3))
+        calls = pipe.global_state.calls
+        for what in ['begin', 'end']:
+            order = [name for (kind, name) in calls if kind == what]
+            self.assertEqual(order[0], 'a')
+            self.assertEqual(set(order[1:3]), {'b', 'c'})
+            self.assertEqual(order[3], 'd')
+
 
 class LoggingTests(TestBase):
     def test_logging(self):
@@ -274,6 +324,83 @@ class ReplacementTests(TestBase):
         self.assertTrue('a | b' in catcher.txt)
 
 
+class LiveReplacementTests(TestCase):
+    class Tag(Node):
+        def begin(self):
+            self.global_state.calls.append(('begin', self.name, self.tag))
+
+        def process(self, item):
+            self.push('{}{}'.format(item, self.tag))
+
+        def end(self):
+            self.global_state.calls.append(('end', self.name, self.tag))
+
+    class Collect(Node):
+        def process(self, item):
+            self.global_state.items.append(item)
+
+    def make_pipeline(self):
+        Tag, Collect = self.Tag, self.Collect
+        return Pipeline(
+            Tag('a', tag='') | Tag('b', tag='x') | Collect('c'),
+            global_state=GlobalState(calls=[], items=[]))
+
+    def test_replace_middle(self):
+        pipe = self.make_pipeline()
+        pipe.push('1')
+        with patch.object(Node, '_check_for_cycles') as check:
+            pipe['b'] = self.Tag('b', tag='y')
+        self.assertFalse(check.called)
+        pipe.push('2')
+        pipe.end()
+        self.assertEqual(pipe.global_state.items, ['1x', '2y'])
+        self.assertEqual(pipe.global_state.calls[-4:], [
+            ('end', 'b', 'x'), ('begin', 'b', 'y'),
+            ('end', 'a', ''), ('end', 'b', 'y')])
+        self.assertIs(pipe['a']._downstream_nodes[0], pipe['b'])
+        self.assertIn(pipe['b'], pipe.top_node.all_nodes)
+        self.assertIs(pipe['a'].push.__self__, pipe['b'])
+
+    def test_replace_root(self):
+        pipe = self.make_pipeline()
+        pipe.push('1')
+        pipe['a'] = self.Tag('a', tag='z')
+        pipe.push('2')
+        pipe.end()
+        self.assertEqual(pipe.global_state.items, ['1x', '2zx'])
+        self.assertIs(pipe.top_node, pipe['a'])
+
+    def test_replace_while_streaming(self):
+        pipe = Pipeline(
+            self.Tag('a', tag='') | [self.Tag('b', tag='x'), self.Tag('c', tag='')],
+            global_state=GlobalState(calls=[]))
+        out = []
+        for item in pipe.stream(['1', '2']):
+            out.append(item)
+            if item == '1x':
+                pipe['b'] = self.Tag('b', tag='y')
+        self.assertEqual(out, ['1x', '1', '2y', '2'])
+
+    def test_replace_routed(self):
+        def route(item):
+            return item
+        branches = [self.Tag('x', tag='1'), self.Tag('y', tag='2'), route]
+        pipe = Pipeline(
+            self.Tag('a', tag='') | branches | self.Collect('c'),
+            global_state=GlobalState(calls=[], items=[]))
+        pipe.push('x')
+        pipe['x'] = self.Tag('x', tag='3')
+        pipe.push('x')
+        pipe.push('y')
+        pipe.end()
+        self.assertEqual(pipe.global_state.items, ['x1', 'x3', 'y2'])
+
+    def test_connected_replacement(self):
+        pipe = self.make_pipeline()
+        with self.assertRaises(ValueError):
+            pipe['b'] = self.Tag('b', tag='') | self.Collect('d')
+
+
 class ConsumingTests(TestBase):
     def test_even_odd(self):
         self.pipeline['g'].add_downstream(
@@ -358,3 +485,352 @@ class GroupByTests(TestCase):
 
         with self.assertRaises(NotImplementedError):
             pipe.consume(range(9))
+
+    def test_max_batch_size(self):
+        pipe = Pipeline(Batch('a', max_batch_size=2))
+        pipe.consume(range(10))
+        self.assertEqual(
+            pipe.global_state.batches,
+            [[0, 1], [2], [3, 4], [5], [6, 7], [8], [9]]
+        )
+
+        pipe = Pipeline(Batch('a', max_batch_size=3))
+        pipe.consume(range(6))
+        self.assertEqual(pipe.global_state.batches, [[0, 1, 2], [3, 4, 5]])
+
+
+class SumGroup(StreamingGroupByNode):
+    def begin(self):
+        self.global_state.sums = []
+
+    def key(self, item):
+        return item // 3
+
+    def begin_group(self, key):
+        self.total = 0
+
+    def process(self, item):
+        self.total += item
+
+    def end_group(self, key):
+        self.global_state.sums.append((key, self.total))
+
+
+class StreamingGroupByTests(TestCase):
+    def test_groups(self):
+        pipe = Pipeline(SumGroup('a'))
+        pipe.consume(range(8))
+        self.assertEqual(
+            pipe.global_state.sums, [(0, 3), (1, 12), (2, 13)])
+
+        # groups do not leak across runs, even with a repeated key
+        pipe.consume([7])
+        self.assertEqual(pipe.global_state.sums, [(2, 7)])
+
+        pipe.consume([])
+        self.assertEqual(pipe.global_state.sums, [])
+
+    def test_default_hooks_and_template(self):
+        class Count(StreamingGroupByNode):
+            def key(self, item):
+                return item
+
+            def process(self, item):
+                self.global_state.count += 1
+
+        template = PipelineTemplate(Count('a'))
+        pipe = template.create(GlobalState(count=0))
+        pipe.consume([1, 1, 2])
+        self.assertEqual(pipe.global_state.count, 3)
+        self.assertFalse(template.create()['a']._in_group)
+
+    def test_undefined_process(self):
+        class B(StreamingGroupByNode):
+            def key(self, item):
+                pass
+
+        with self.assertRaises(NotImplementedError):
+            Pipeline(B('a')).consume(range(3))
+
+
+class PushWiringTests(TestCase):
+    def test_linear_chain(self):
+        class Double(Node):
+            def process(self, item):
+                self.push(item)
+                self.push(item)
+
+        class Odd(Node):
+            def process(self, item):
+                if item % 2:
+                    self.push(item)
+
+        pipe = Pipeline(
+            Odd('a') | Double('b') | Odd('c') | ResultNode('d'),
+            global_state=GlobalState(final_items=[])
+        )
+        pipe.consume(range(4))
+        self.assertEqual(pipe.global_state.final_items, [1, 1, 3, 3])
+
+        self.assertEqual(pipe['a'].push, pipe['b'].process)
+        self.assertEqual(pipe['b'].push, pipe['c'].process)
+        self.assertEqual(pipe['c'].push, pipe['d'].process)
+
+    def test_branches(self):
+        base = TestBase('run')
+        base.setUp()
+        pipe = base.pipeline
+        pipe.consume(item_generator())
+        # nodes with several downstreams push through ._push
+        self.assertEqual(pipe['b'].push, pipe['b']._push)
+        self.assertEqual(pipe['a'].push, pipe['b'].process)
+
+    def test_logged_and_groupby_nodes(self):
+        class G(GroupByNode):
+            def key(self, item):
+                return item.value
+
+            def process(self, batch):
+                for item in batch:
+                    self.push(item)
+
+        pipe = Pipeline(
+            TestNode('a') | TestNode('b') | G('c') | TestNode('d'))
+        pipe['b'].log('output')
+        with print_catcher() as catcher:
+            pipe.consume(item_generator())
+        self.assertTrue('node_log,output,b,1|generator|a|b' in catcher.txt)
+
+        # a node with a single downstream still pushes straight into the
+        # _process callable of that downstream
+        self.assertEqual(pipe['a'].push, pipe['b']._logged_process)
+        self.assertEqual(pipe['b'].push, pipe['b']._push)
+        self.assertEqual(pipe['c'].push, pipe['d'].process)
+
+    def test_initialize_node_with_push(self):
+        pipe = Pipeline(TestNode('a') | TestNode('b'))
+        pipe.initialize_node(pipe['a'], with_push=True)
+        self.assertEqual(pipe['a'].push, pipe['b'].process)
+
+
+class TemplateTests(TestCase):
+    def test_created_pipelines_are_independent(self):
+        class Batch(GroupByNode):
+            def key(self, item):
+                return item.value
+
+            def process(self, batch):
+                self.push(len(batch))
+
+        template = PipelineTemplate(
+            TestNode('a') | Batch('b') | ResultNode('c'))
+        pipe1 = template.create(GlobalState(final_items=[]))
+        pipe2 = template.create(GlobalState(final_items=[]))
+
+        for name in ['a', 'b', 'c']:
+            self.assertIsNot(pipe1[name], pipe2[name])
+            self.assertIs(pipe1[name].pipeline, pipe1)
+
+        pipe1.push(Item(1, None, 'gen'))
+        pipe2.consume(item_generator())
+        pipe1.end()
+        self.assertEqual(pipe1.global_state.final_items, [1])
+        self.assertEqual(pipe2.global_state.final_items, [1, 1])
+
+    def test_routing(self):
+        class Collect(Node):
+            def begin(self):
+                self.global_state.final_items = []
+
+            def process(self, item):
+                self.global_state.final_items.append(item.source)
+
+        def even_odd(item):
+            return ['even', 'odd'][item.value % 2]
+
+        template = PipelineTemplate(
+            TestNode('a') | [TestNode('even'), TestNode('odd'), even_odd] | Collect('collect'))
+        pipe = template.create()
+        pipe.consume(item_generator())
+        self.assertEqual(pipe.global_state.final_items, ['odd', 'even'])
+        router = pipe['a.even_odd']
+        self.assertIs(router._end_point_map['even'], pipe['even'])
+
+    def test_repr_reused(self):
+        template = PipelineTemplate(
+            TestNode('a') | [TestNode('b'), TestNode('c')])
+        pipe = template.create()
+        with print_catcher() as catcher:
+            print(pipe)
+        self.assertTrue('a | [b, c]' in catcher.txt)
+        self.assertEqual(pipe._node_repr, template._node_repr)
+
+    def test_pipeline_class(self):
+        class MyPipeline(Pipeline):
+            pass
+
+        template = PipelineTemplate(TestNode('a'), pipeline_class=MyPipeline)
+        self.assertIsInstance(template.create(), MyPipeline)
+
+
+class StreamTests(TestCase):
+    def setUp(self):
+        class Double(Node):
+            def process(self, item):
+                self.push(item)
+                self.push(2 * item)
+
+        class Count(Node):
+            def begin(self):
+                self.count = 0
+
+            def process(self, item):
+                self.count += 1
+                self.push(item)
+
+            def end(self):
+                self.global_state.ended = True
+                self.push('count={}'.format(self.count))
+
+        self.pipeline = Pipeline(
+            Double('double') | Count('count'),
+            global_state=GlobalState(ended=False)
+        )
+        self.pulled = []
+
+    def source(self, num):
+        for ind in range(num):
+            self.pulled.append(ind)
+            yield ind
+
+    def test_stream(self):
+        self.assertEqual(
+            list(self.pipeline.stream(self.source(3))),
+            [0, 0, 1, 2, 2, 4, 'count=6']
+        )
+        self.assertTrue(self.pipeline.global_state.ended)
+
+    def test_lazy_and_early_stop(self):
+        stream = self.pipeline.stream(self.source(1000))
+        self.assertEqual(next(stream), 0)
+        self.assertEqual(next(stream), 0)
+        self.assertEqual(next(stream), 1)
+        self.assertEqual(self.pulled, [0, 1])
+        self.assertFalse(self.pipeline.global_state.ended)
+
+        stream.close()
+        self.assertEqual(self.pulled, [0, 1])
+        self.assertTrue(self.pipeline.global_state.ended)
+
+    def test_logged_terminal_node(self):
+        self.pipeline['count'].log('output')
+        with print_catcher() as catcher:
+            out = list(self.pipeline.stream(range(1)))
+        self.assertEqual(out, [0, 0, 'count=2'])
+        self.assertTrue('node_log,output,count,count=2' in catcher.txt)
+
+    def test_broadcast_terminals(self):
+        pipe = Pipeline(TestNode('a') | [TestNode('b'), TestNode('c')])
+        out = [str(item) for item in pipe.stream(item_generator())]
+        self.assertEqual(
+            sorted(out),
+            ['1|generator|a|b', '1|generator|a|c',
+             '2|generator|a|b', '2|generator|a|c']
+        )
+
+
+class Pass(Node):
+    def process(self, item):
+        self.push(item)
+
+
+class Collect(Node):
+    def begin(self):
+        self.global_state.items = []
+
+    def process(self, item):
+        self.global_state.items.append(item)
+
+
+class MultipleSourceTests(TestCase):
+    def setUp(self):
+        self.pipeline = Pipeline(
+            [Pass('b_source'), Pass('a_source')] | Collect('collect'))
+
+    def test_roots(self):
+        self.assertEqual(
+            [n.name for n in self.pipeline.root_nodes],
+            ['a_source', 'b_source'])
+        self.assertEqual(self.pipeline.top_node.name, 'a_source')
+        self.assertTrue('b_source' in str(self.pipeline))
+
+        with self.assertRaises(ValueError):
+            self.pipeline.consume(range(3))
+        with self.assertRaises(ValueError):
+            self.pipeline.consume_sources({'a_source': []})
+
+    def test_single_root_checked_before_begin(self):
+        feeds = [
+            lambda: self.pipeline.consume([]),
+            lambda: list(self.pipeline.stream([])),
+            lambda: self.pipeline.push(1),
+        ]
+        for feed in feeds:
+            with self.assertRaises(ValueError):
+                feed()
+            self.assertFalse(self.pipeline._is_running)
+            self.assertFalse(hasattr(self.pipeline.global_state, 'items'))
+
+    def test_interleave(self):
+        self.pipeline.consume_sources({
+            'a_source': ['a1', 'a2', 'a3'],
+            'b_source': ['b1'],
+        })
+        self.assertEqual(
+            self.pipeline.global_state.items, ['a1', 'b1', 'a2', 'a3'])
+
+    def test_merge(self):
+        self.pipeline.consume_sources({
+            'a_source': [(1, 'a'), (4, 'a'), (4, 'a2')],
+            'b_source': [(0, 'b'), (4, 'b'), (9, 'b')],
+        }, key=lambda item: item[0])
+        self.assertEqual(
+            self.pipeline.global_state.items,
+            [(0, 'b'), (1, 'a'), (4, 'a'), (4, 'a2'), (4, 'b'), (9, 'b')])
+
+        self.pipeline.consume_sources(
+            {'a_source': [], 'b_source': [1]}, key=int)
+        self.assertEqual(self.pipeline.global_state.items, [1])
+
+    def test_sorted_partitions_into_group_by(self):
+        pipe = Pipeline([Pass('p1'), Pass('p2'), Pass('p3')] | Batch('batch'))
+        pipe.consume_sources({
+            'p1': [0, 3, 6, 7],
+            'p2': [1, 4, 8],
+            'p3': [2, 5],
+        }, key=lambda item: item)
+        self.assertEqual(
+            pipe.global_state.batches, [[0, 1, 2], [3, 4, 5], [6, 7, 8]])
+
+    def test_stop_and_template(self):
+        class Stop(Node):
+            def process(self, item):
+                raise StopPipeline()
+
+        template = PipelineTemplate([Pass('a'), Stop('b')] | Collect('c'))
+        pipe = template.create()
+        pipe.consume_sources({'a': ['a1', 'a2'], 'b': ['b1', 'b2']})
+        self.assertEqual(pipe.global_state.items, ['a1'])
+        self.assertEqual(len(template._nodes), 3)
+
+    def test_order(self):
+        self.pipeline.consume_sources({
+            'a_source': ['a1', 'a2'],
+            'b_source': ['b1', 'b2'],
+        }, order=['b_source', 'a_source'])
+        self.assertEqual(
+            self.pipeline.global_state.items, ['b1', 'b2', 'a1', 'a2'])
+
+        with self.assertRaises(ValueError):
+            self.pipeline.consume_sources(
+                {'a_source': [], 'b_source': []}, order=['a_source'])
@@ -0,0 +1,148 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from consecution.control import Take
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline, GlobalState
+from consecution.recording import Recorder, Replay
+from consecution.serialization import StructCodec
+
+
+class Pass(Node):
+    def process(self, item):
+        self.push(item)
+
+
+class Collect(Node):
+    def process(self, item):
+        self.global_state.items.append(item)
+
+
+class Mutate(Node):
+    def process(self, item):
+        item['seen'] = True
+        self.push(item)
+
+
+def make_pipeline():
+    return Pipeline(Pass('a') | Collect('b'), global_state=GlobalState(items=[]))
+
+
+class RecordingTests(TestCase):
+    def setUp(self):
+        self.dir_name = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir_name, 'input.rec')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_name)
+
+    def test_record_and_replay(self):
+        items = [{'num': n, 'name': str(n)} for n in range(25)]
+        for codec, compression in [
+                ('pickle', 0), ('marshal', 1), ('msgpack', 9)]:
+            pipe = make_pipeline()
+            with Recorder(pipe, self.file_name, codec=codec,
+                          compression=compression, block_size=10) as recorder:
+                pipe.consume(items[:20])
+                for item in items[20:]:
+                    pipe.push(item)
+                pipe.end()
+            self.assertEqual(recorder.num_items, 25)
+            self.assertEqual(pipe.global_state.items, items)
+
+            replay = Replay(self.file_name)
+            self.assertEqual(replay.codec.name, codec)
+            self.assertEqual(list(replay), items)
+
+            replayed = make_pipeline()
+            replayed.consume(replay)
+            self.assertEqual(replayed.global_state.items, items)
+
+    def test_items_mutated_downstream(self):
+        pipe = Pipeline(
+            Pass('a') | Mutate('b') | Collect('c'),
+            global_state=GlobalState(items=[]))
+        with Recorder(pipe, self.file_name, block_size=10):
+            pipe.consume([{'num': n} for n in range(3)])
+        self.assertEqual(pipe.global_state.items[0], {'num': 0, 'seen': True})
+        self.assertEqual(
+            list(Replay(self.file_name)), [{'num': n} for n in range(3)])
+
+    def test_close_detaches(self):
+        pipe = make_pipeline()
+        recorder = Recorder(pipe, self.file_name)
+        with recorder:
+            pipe.consume(range(3))
+        pipe.consume(range(30))
+        recorder.close()
+        self.assertEqual(recorder.num_items, 3)
+        self.assertEqual(list(Replay(self.file_name)), [0, 1, 2])
+        self.assertEqual(
+            pipe.global_state.items, list(range(3)) + list(range(30)))
+
+    def test_struct_codec(self):
+        codec = StructCodec('<qd')
+        items = [(n, n / 2.) for n in range(5)]
+        pipe = make_pipeline()
+        with Recorder(pipe, self.file_name, codec=codec):
+            pipe.consume(items)
+        with self.assertRaises(ValueError):
+            Replay(self.file_name)
+        self.assertEqual(list(Replay(self.file_name, codec=codec)), items)
+
+    def test_empty(self):
+        Recorder(make_pipeline(), self.file_name).close()
+        self.assertEqual(list(Replay(self.file_name)), [])
+
+    def test_not_a_recording(self):
+        with open(self.file_name, 'wb') as out_file:
+            out_file.write(b'a,b,c\n')
+        with self.assertRaises(ValueError):
+            Replay(self.file_name)
+
+    def test_feed_several_roots(self):
+        def make():
+            return Pipeline(
+                [Pass('left'), Pass('right')] | Collect('collect'),
+                global_state=GlobalState(items=[]))
+
+        pipe = make()
+        with Recorder(pipe, self.file_name, block_size=3):
+            pipe.consume_sources({'left': 'abcd', 'right': 'wxyz'}, order=[
+                'right', 'left'])
+        pipe = make()
+        Replay(self.file_name).feed(pipe)
+        self.assertEqual(''.join(pipe.global_state.items), 'wxyzabcd')
+
+        with self.assertRaises(ValueError):
+            Replay(self.file_name).feed(make_pipeline())
+
+    def test_feed_stops(self):
+        pipe = make_pipeline()
+        with Recorder(pipe, self.file_name):
+            pipe.consume(range(10))
+        pipe = Pipeline(
+            Take('a', 3) | Collect('b'), global_state=GlobalState(items=[]))
+        Replay(self.file_name).feed(pipe)
+        self.assertEqual(pipe.global_state.items, [0, 1, 2])
+
+    def test_rate(self):
+        pipe = make_pipeline()
+        with Recorder(pipe, self.file_name):
+            pipe.consume(range(4))
+
+        # the clock moves on by 0.1 seconds on every read
+        times = [100. + 0.1 * n for n in range(10)]
+        with patch('consecution.recording.time') as clock:
+            clock.time.side_effect = times
+            items = list(Replay(self.file_name, rate=5))
+        self.assertEqual(items, [0, 1, 2, 3])
+        # item n is due 0.2 * n seconds after the start
+        delays = [c[0][0] for c in clock.sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        for delay, expected in zip(delays, [0.1, 0.2]):
+            self.assertAlmostEqual(delay, expected)
@@ -0,0 +1,94 @@
+import pickle
+from unittest import TestCase
+
+from mock import patch
+
+from consecution.serialization import (
+    Codec, MarshalCodec, MsgpackCodec, PickleCodec, StructCodec,
+    _CODECS, _register_builtin_codecs, get_codec, register_codec)
+
+
+class Point(object):
+    def __init__(self, x):
+        self.x = x
+
+
+ROWS = [
+    {'gender': 'male', 'age': 11, 'spent': 39.39},
+    {'gender': 'female', 'age': 10, 'spent': 34.72},
+]
+
+
+class CodecTests(TestCase):
+    def round_trip(self, codec, items):
+        data = codec.dumps(items)
+        self.assertIsInstance(data, bytes)
+        return codec.loads(data)
+
+    def test_pickle(self):
+        codec = PickleCodec()
+        self.assertEqual(codec.protocol, min(5, pickle.HIGHEST_PROTOCOL))
+        points = self.round_trip(codec, [Point(1), Point(2)])
+        self.assertEqual([p.x for p in points], [1, 2])
+        self.assertEqual(PickleCodec(protocol=2).protocol, 2)
+        self.assertEqual(repr(codec), 'PickleCodec()')
+
+    def test_marshal(self):
+        items = ROWS + [('a', b'b', None, 1.5, [1, {2}])]
+        self.assertEqual(self.round_trip(MarshalCodec(), items), items)
+        with self.assertRaises(ValueError):
+            MarshalCodec().dumps([Point(1)])
+
+    def test_msgpack(self):
+        codec = MsgpackCodec()
+        self.assertEqual(self.round_trip(codec, ROWS), ROWS)
+        # tuples come back as lists and integer keys are allowed
+        self.assertEqual(
+            self.round_trip(codec, [(1, b'x'), {1: 'a'}]),
+            [[1, b'x'], {1: 'a'}])
+
+    def test_struct(self):
+        codec = StructCodec('<6sqd')
+        items = [(b'male', 11, 39.39), (b'female', 10, 34.72)]
+        self.assertEqual(len(codec.dumps(items)), 2 * 22)
+        self.assertEqual(
+            self.round_trip(codec, items),
+            [(b'male\x00\x00', 11, 39.39), (b'female', 10, 34.72)])
+        self.assertEqual(repr(codec), "StructCodec('<6sqd')")
+
+
+class RegistryTests(TestCase):
+    def test_get_codec(self):
+        self.assertIsInstance(get_codec('pickle'), PickleCodec)
+        self.assertIsInstance(get_codec('marshal'), MarshalCodec)
+        self.assertIsInstance(get_codec('msgpack'), MsgpackCodec)
+        codec = StructCodec('<q')
+        self.assertIs(get_codec(codec), codec)
+        with self.assertRaises(ValueError):
+            get_codec('yaml')
+
+    def test_register_codec(self):
+        class Lines(Codec):
+            name = 'lines'
+
+            def dumps(self, items):
+                return '\n'.join(items).encode('utf-8')
+
+            def loads(self, data):
+                return data.decode('utf-8').split('\n')
+
+        register_codec('lines', Lines)
+        self.addCleanup(_CODECS.pop, 'lines')
+        codec = get_codec('lines')
+        self.assertEqual(codec.loads(codec.dumps(['a', 'b'])), ['a', 'b'])
+
+    @patch('consecution.serialization.importlib.util.find_spec')
+    def test_msgpack_not_installed(self, find_spec):
+        find_spec.return_value = None
+        with patch.dict(_CODECS, clear=True):
+            _register_builtin_codecs()
+            self.assertEqual(sorted(_CODECS), ['marshal', 'pickle'])
+            with self.assertRaises(ValueError) as context:
+                get_codec('msgpack')
+            self.assertIn("['marshal', 'pickle']", str(context.exception))
+        find_spec.assert_called_with('msgpack')
@@ -0,0 +1,150 @@
+from unittest import TestCase
+
+from mock import patch
+
+from consecution.joins import HashJoin
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline, GlobalState
+from consecution.shedding import AdaptiveShedder, Sampler, TokenBucket
+
+
+class Pass(Node):
+    def process(self, item):
+        self.push(item)
+
+
+class Collect(Node):
+    def process(self, item):
+        self.global_state[self.name].append(item)
+
+
+def make_pipeline(shedder, divert=False):
+    downstreams = [Collect('kept')]
+    if divert:
+        downstreams.append(Collect('overflow'))
+    return Pipeline(
+        shedder | downstreams,
+        global_state=GlobalState(kept=[], overflow=[]))
+
+
+class SamplerTests(TestCase):
+    def test_sampler(self):
+        pipe = make_pipeline(Sampler('sample', 3))
+        pipe.consume(range(10))
+        self.assertEqual(pipe.global_state.kept, [0, 3, 6, 9])
+        self.assertEqual(pipe['sample'].passed, 4)
+        self.assertEqual(pipe['sample'].dropped, 6)
+
+        # counts start over when the pipeline begins again
+        pipe.consume(range(2))
+        self.assertEqual(pipe['sample'].passed, 1)
+        self.assertEqual(pipe['sample'].dropped, 1)
+
+    def test_divert(self):
+        pipe = make_pipeline(Sampler('sample', 2, divert='overflow'), True)
+        pipe.consume(range(5))
+        self.assertEqual(pipe.global_state.kept, [0, 2, 4])
+        self.assertEqual(pipe.global_state.overflow, [1, 3])
+
+        # a replaced downstream gets the items from then on
+        class Negate(Node):
+            def process(self, item):
+                self.global_state.overflow.append(-item)
+
+        pipe.begin()
+        pipe.push(0)
+        pipe.push(1)
+        pipe['overflow'] = Negate('overflow')
+        pipe.push(2)
+        pipe.push(3)
+        pipe.end()
+        self.assertEqual(pipe.global_state.overflow, [1, 3, 1, -3])
+
+    def test_divert_above_join(self):
+        # a join tells its inputs apart by the callable each upstream pushes to
+        sample = Sampler('events', 2, divert='overflow')
+        join = HashJoin('join', 'events', 'users', lambda item: item[0])
+        [sample, Pass('users')] | join | Collect('kept')
+        sample.add_downstream(Collect('overflow'))
+        pipe = Pipeline(sample, global_state=GlobalState(kept=[], overflow=[]))
+        pipe.consume_sources({
+            'users': [(1, 'ann'), (2, 'bob')],
+            'events': [(1, 'click'), (2, 'view'), (2, 'buy')],
+        }, order=['users', 'events'])
+        self.assertEqual(pipe.global_state.kept, [
+            ((1, 'click'), (1, 'ann')), ((2, 'buy'), (2, 'bob'))])
+        self.assertEqual(pipe.global_state.overflow, [(2, 'view')])
+
+    def test_bad_divert(self):
+        pipe = make_pipeline(Sampler('sample', 2, divert='nowhere'))
+        with self.assertRaises(ValueError):
+            pipe.consume(range(5))
+
+
+class TokenBucketTests(TestCase):
+    @patch('consecution.shedding.time')
+    def test_token_bucket(self, clock):
+        clock.monotonic.side_effect = [0., 0., 0., 0.5, 0.5, 1.5, 100.]
+        pipe = make_pipeline(
+            TokenBucket('limit', rate=2, divert='overflow'), True)
+        pipe.consume(range(7))
+        self.assertEqual(pipe.global_state.kept, [0, 1, 3, 5, 6])
+        self.assertEqual(pipe.global_state.overflow, [2, 4])
+        self.assertEqual(pipe['limit'].dropped, 2)
+
+    def test_burst(self):
+        bucket = TokenBucket('limit', rate=0.5, burst=3)
+        self.assertEqual(bucket.burst, 3)
+        # by default a second's worth of items, but at least one
+        self.assertEqual(TokenBucket('limit', rate=0.5).burst, 1)
+        self.assertEqual(TokenBucket('limit', rate=100).burst, 100)
+
+        pipe = make_pipeline(bucket)
+        pipe.consume(range(10))
+        self.assertEqual(pipe.global_state.kept, [0, 1, 2])
+        self.assertEqual(bucket.dropped, 7)
+
+
+class AdaptiveShedderTests(TestCase):
+    def test_age(self):
+        # items are their own ages
+        shedder = AdaptiveShedder(
+            'shed', target=0.1, age=lambda item: item, smoothing=1.)
+        pipe = make_pipeline(shedder)
+        pipe.begin()
+        for _ in range(1000):
+            pipe.push(1.)
+        self.assertEqual(shedder.admit, shedder.min_admit)
+        self.assertLess(shedder.passed, 50)
+        self.assertEqual(shedder.passed + shedder.dropped, 1000)
+
+        # the fraction let through grows back once latency is under target
+        for _ in range(5000):
+            pipe.push(0.)
+        self.assertEqual(shedder.admit, 1.)
+        pipe.end()
+
+    def test_evenly_spread(self):
+        shedder = AdaptiveShedder('shed', target=1.)
+        shedder.increase = 0.
+        pipe = make_pipeline(shedder)
+        pipe.begin()
+        shedder.admit = 0.25
+        for item in range(12):
+            pipe.push(item)
+        pipe.end()
+        self.assertEqual(pipe.global_state.kept, [3, 7, 11])
+
+    @patch('consecution.shedding.time')
+    def test_processing_time(self, clock):
+        # the downstream takes 1 second for the first item and none after
+        clock.perf_counter.side_effect = [0., 1.] + [5.] * 100
+        shedder = AdaptiveShedder('shed', target=0.5, divert='overflow')
+        pipe = make_pipeline(shedder, True)
+        pipe.consume(range(4))
+        self.assertAlmostEqual(shedder.latency, 0.1 * 0.9 ** 3)
+        self.assertEqual(shedder.admit, 1.)
+        self.assertEqual(pipe.global_state.kept, [0, 1, 2, 3])
+
+        pipe.consume([])
+        self.assertEqual(shedder.latency, 0.)
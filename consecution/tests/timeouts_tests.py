@@ -0,0 +1,278 @@
+import os
+import time
+from unittest import TestCase
+
+from consecution.errors import DeadLetter
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline, PipelineTemplate, GlobalState
+from consecution.timeouts import ProcessTimeout, TimeoutCounts, TimeoutGuard
+
+
+class Work(Node):
+    def process(self, item):
+        value = item['value'] if isinstance(item, dict) else item
+        if value == 'slow':
+            time.sleep(.5)
+        elif value == 'fail':
+            self.push('before_fail')
+            raise ValueError('failed')
+        elif value == 'unpicklable':  # pragma: no cover  runs in a child process
+            raise UnpicklableError()
+        elif value == 'die':  # pragma: no cover  runs in a child process
+            os._exit(1)
+        self.push(value)
+
+    def end(self):
+        self.push('from_end')
+
+
+class UnpicklableError(Exception):
+    def __reduce__(self):  # pragma: no cover  runs in a child process
+        raise TypeError('can not pickle')
+
+
+class Count(Node):
+    def begin(self):
+        self.count = 0
+
+    def process(self, item):
+        self.count += 1
+
+    def end(self):
+        self.push(self.count)
+
+
+class Collect(Node):
+    def process(self, item):
+        self.global_state.items.append(item)
+
+
+class Sink(Node):
+    def begin(self):
+        self.global_state.log.append('begin_' + self.name)
+
+    def process(self, item):
+        self.global_state.dead.append(item)
+
+    def end(self):
+        self.global_state.log.append('end_' + self.name)
+
+
+def make_pipeline(work, **kwargs):
+    return Pipeline(
+        work | Collect('collect'),
+        global_state=GlobalState(items=[], dead=[], log=[]), **kwargs)
+
+
+class ThreadTimeoutTests(TestCase):
+    def test_skip(self):
+        work = Work('work')
+        work.on_timeout(.05)
+        pipe = make_pipeline(work)
+        pipe.consume([1, 'slow', 3])
+        self.assertEqual(pipe.global_state.items, [1, 3, 'from_end'])
+        counts = pipe.timeout_counts['work']
+        self.assertEqual(
+            (counts.timed_out, counts.expired, counts.dead_lettered),
+            (1, 0, 0))
+        self.assertIn('timed_out=1', repr(counts))
+
+    def test_dead_letter(self):
+        work = Work('work')
+        work.on_timeout(.05, 'dead_letter', sink=Sink('sink'))
+        pipe = make_pipeline(work)
+        pipe.consume(['slow', 2])
+        self.assertEqual(pipe.global_state.items, [2, 'from_end'])
+        self.assertEqual(pipe.global_state.log, ['begin_sink', 'end_sink'])
+        dead, = pipe.global_state.dead
+        self.assertIsInstance(dead, DeadLetter)
+        self.assertEqual((dead.item, dead.node_name), ('slow', 'work'))
+        self.assertIsInstance(dead.error, ProcessTimeout)
+        self.assertIn('longer than 0.05 seconds', str(dead.error))
+        self.assertEqual(pipe.timeout_counts['work'].dead_lettered, 1)
+
+    def test_raise(self):
+        work = Work('work')
+        work.on_timeout(.05, 'raise')
+        pipe = make_pipeline(work)
+        with self.assertRaises(ProcessTimeout):
+            pipe.consume(['slow'])
+
+    def test_error_after_push(self):
+        work = Work('work')
+        work.on_timeout(1)
+        pipe = make_pipeline(work)
+        with self.assertRaises(ValueError):
+            pipe.consume([1, 'fail'])
+        self.assertEqual(pipe.global_state.items, [1, 'before_fail'])
+
+    def test_stream(self):
+        work = Work('work')
+        work.on_timeout(.05)
+        pipe = Pipeline(work)
+        self.assertEqual(
+            list(pipe.stream([1, 'slow', 3])), [1, 3, 'from_end'])
+
+    def test_no_timeout_not_wrapped(self):
+        pipe = make_pipeline(Work('work'))
+        self.assertEqual(pipe['work']._process, pipe['work'].process)
+        self.assertEqual(pipe.timeout_counts, {})
+
+
+class ProcessTimeoutTests(TestCase):
+    def make_pipeline(self):
+        work = Work('work')
+        work.on_timeout(.2, mode='process')
+        return make_pipeline(work)
+
+    def test_kill_and_restart(self):
+        pipe = self.make_pipeline()
+        pipe.consume([1, 'slow', 3])
+        self.assertEqual(pipe.global_state.items, [1, 3, 'from_end'])
+        self.assertEqual(pipe.timeout_counts['work'].timed_out, 1)
+
+    def test_errors(self):
+        pipe = self.make_pipeline()
+        with self.assertRaises(ValueError):
+            pipe.consume(['fail'])
+        self.assertEqual(pipe.global_state.items, ['before_fail'])
+
+        pipe = self.make_pipeline()
+        with self.assertRaises(RuntimeError) as context:
+            pipe.consume(['unpicklable'])
+        self.assertIn('UnpicklableError', str(context.exception))
+
+    def test_died(self):
+        pipe = self.make_pipeline()
+        with self.assertRaises(RuntimeError) as context:
+            pipe.consume([1, 'die'])
+        self.assertIn("node 'work' died", str(context.exception))
+
+    def test_end_in_child(self):
+        count = Count('count')
+        count.on_timeout(1, mode='process')
+        pipe = Pipeline(
+            count | Collect('collect'), global_state=GlobalState(items=[]))
+        pipe.consume(range(3))
+        # the count only went up in the child
+        self.assertEqual(pipe.global_state.items, [3])
+        self.assertEqual(pipe['count'].count, 0)
+
+    def test_died_before_end(self):
+        pipe = self.make_pipeline()
+        pipe.begin()
+        pipe.push(1)
+        process, _ = pipe._timeout_guards['work'].runner._worker
+        process.terminate()
+        process.join()
+        with self.assertRaises(RuntimeError) as context:
+            pipe.end()
+        self.assertIn("node 'work' died", str(context.exception))
+
+    def test_close_after_exit(self):
+        pipe = self.make_pipeline()
+        pipe.begin()
+        pipe.push(1)
+        guard = pipe._timeout_guards['work']
+        process, _ = guard.runner._worker
+        process.terminate()
+        process.join()
+        guard.close()
+        # without a child, the node is ended here
+        pipe.end()
+        self.assertEqual(pipe.global_state.items, [1, 'from_end'])
+
+
+class DeadlineTests(TestCase):
+    def test_expired(self):
+        work = Work('work')
+        work.on_timeout()
+        pipe = make_pipeline(work, deadline=lambda item: item['deadline'])
+        now = time.time()
+        pipe.consume([
+            {'value': 1, 'deadline': now + 60},
+            {'value': 2, 'deadline': now - 1},
+            {'value': 3, 'deadline': None},
+        ])
+        self.assertEqual(pipe.global_state.items, [1, 3, 'from_end'])
+        self.assertEqual(pipe.timeout_counts['work'].expired, 1)
+
+    def test_deadline_shortens_timeout(self):
+        work = Work('work')
+        work.on_timeout(60, 'raise')
+        pipe = make_pipeline(work, deadline=lambda item: item['deadline'])
+        with self.assertRaises(ProcessTimeout):
+            pipe.consume([
+                {'value': 1, 'deadline': time.time() + 120},
+                {'value': 'slow', 'deadline': time.time() + .05}])
+        self.assertEqual(pipe.global_state.items, [1])
+        self.assertEqual(pipe.timeout_counts['work'].timed_out, 1)
+
+    def test_replaced_root_reads_deadline(self):
+        first = Work('work')
+        first.on_timeout()
+        pipe = make_pipeline(first, deadline=lambda item: item['deadline'])
+        pipe.begin()
+        replacement = Work('work')
+        replacement.on_timeout()
+        pipe['work'] = replacement
+        pipe.push({'value': 1, 'deadline': time.time() - 1})
+        pipe.end()
+        self.assertEqual(pipe.global_state.items, ['from_end', 'from_end'])
+        self.assertEqual(pipe.timeout_counts['work'].expired, 1)
+
+    def test_end_pushes_have_no_deadline(self):
+        collect = Collect('collect')
+        collect.on_timeout()
+        pipe = Pipeline(
+            Count('count') | collect, global_state=GlobalState(items=[]),
+            deadline=lambda item: item['deadline'])
+        pipe.consume([
+            {'deadline': time.time() + 60}, {'deadline': time.time() - 1}])
+        self.assertEqual(pipe.global_state.items, [2])
+        self.assertIsNone(pipe._deadline[0])
+
+    def test_live_replacement(self):
+        pipe = make_pipeline(Work('work'))
+        pipe.begin()
+        pipe.push(1)
+        replacement = Work('work')
+        replacement.on_timeout(.05)
+        pipe['work'] = replacement
+        pipe.push('slow')
+        pipe.push(3)
+        pipe.end()
+        self.assertEqual(
+            pipe.global_state.items, [1, 'from_end', 3, 'from_end'])
+        self.assertEqual(pipe.timeout_counts['work'].timed_out, 1)
+
+
+class OnTimeoutTests(TestCase):
+    def test_validation(self):
+        work = Work('work')
+        with self.assertRaises(ValueError):
+            work.on_timeout(policy='bad')
+        with self.assertRaises(ValueError):
+            work.on_timeout(mode='bad')
+        with self.assertRaises(ValueError):
+            work.on_timeout(policy='dead_letter')
+
+    def test_template_copies_sink(self):
+        work = Work('work')
+        work.on_timeout(.05, 'dead_letter', sink=Sink('sink'))
+        template = PipelineTemplate(Pipeline(work | Collect('collect')))
+        first, second = [
+            template.create(global_state=GlobalState(items=[], dead=[], log=[]))
+            for _ in range(2)]
+        first_sink = first['work']._timeout_policy[2]
+        self.assertIsNot(first_sink, second['work']._timeout_policy[2])
+        self.assertIsNot(first_sink, work._timeout_policy[2])
+        first.consume(['slow'])
+        self.assertEqual(len(first.global_state.dead), 1)
+
+    def test_guard_close_without_worker(self):
+        work = Work('work')
+        work.on_timeout(1)
+        guard = TimeoutGuard(work, work.process, TimeoutCounts(), [None])
+        guard.close()
+        self.assertIsNone(guard.runner._worker)
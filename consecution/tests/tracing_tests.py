@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from consecution.nodes import Node
+from consecution.pipeline import Pipeline
+from consecution.tracing import Tracer
+
+
+class Pass(Node):
+    def process(self, item):
+        self.push(item)
+
+
+class Sink(Node):
+    def process(self, item):
+        if item == 'bad':
+            raise ValueError('bad item')
+
+
+class TracerTests(TestCase):
+    def setUp(self):
+        # a broadcast to a router that picks one of two sinks
+        def route(item):
+            return 'even' if item % 2 == 0 else 'odd'
+
+        self.pipe = Pipeline(
+            Pass('top') | [
+                Sink('side'),
+                Pass('middle') | [Sink('even'), Sink('odd'), route],
+            ]
+        )
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_sampling_and_spans(self):
+        tracer = Tracer(self.pipe, sample_every=3)
+        self.pipe.consume(range(7))
+        self.assertEqual([t.trace_id for t in tracer.traces], [3, 6])
+
+        trace = tracer.traces[0]
+        self.assertEqual(trace.item, '2')
+        names = [span[0] for span in trace.spans]
+        self.assertEqual(names[0], 'top')
+        self.assertEqual(
+            sorted(names[1:]), ['even', 'middle', 'middle.route', 'side'])
+        depths = {span[0]: span[3] for span in trace.spans}
+        self.assertEqual(
+            (depths['top'], depths['side'], depths['even']), (0, 1, 3))
+
+        # the root span covers all its downstream spans
+        top = trace.spans[0]
+        for name, start, end, depth in trace.spans:
+            self.assertTrue(top[1] <= start <= end <= top[2])
+        self.assertEqual(trace.duration, top[2] - top[1])
+        self.assertTrue('spans=5' in repr(trace))
+
+    def test_close_detaches(self):
+        with Tracer(self.pipe, sample_every=1) as tracer:
+            self.pipe.consume(range(2))
+        self.pipe.consume(range(3))
+        tracer.close()
+        self.assertEqual([t.trace_id for t in tracer.traces], [1, 2])
+
+    def test_errors_close_spans(self):
+        tracer = Tracer(self.pipe, sample_every=1)
+        with self.assertRaises(ValueError):
+            self.pipe.consume([0, 'bad'])
+        self.assertEqual(len(tracer.traces), 2)
+        self.assertTrue(
+            all(span[2] is not None for span in tracer.traces[1].spans))
+        self.assertIsNone(tracer._current)
+
+    def test_chrome_export(self):
+        tracer = Tracer(self.pipe, sample_every=2, max_traces=2)
+        self.assertEqual(tracer.chrome_trace()['traceEvents'], [])
+
+        self.pipe.consume(range(10))
+        self.assertEqual([t.trace_id for t in tracer.traces], [8, 10])
+
+        file_name = os.path.join(self.temp_dir, 'trace.json')
+        tracer.export_chrome(file_name)
+        with open(file_name) as in_file:
+            document = json.load(in_file)
+        events = document['traceEvents']
+        metadata = [e for e in events if e['ph'] == 'M']
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(
+            [e['args']['name'] for e in metadata], ['item 8', 'item 10'])
+        self.assertEqual(len(spans), 10)
+        self.assertEqual(spans[0]['ts'], 0)
+        self.assertTrue(all(e['dur'] >= 0 for e in spans))
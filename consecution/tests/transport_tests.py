@@ -0,0 +1,182 @@
+from array import array
+import multiprocessing
+import pickle
+from unittest import TestCase
+
+import numpy
+
+from consecution.transport import SharedMemoryTransport
+
+
+def make_item():
+    return {
+        'values': numpy.arange(10000, dtype=float),
+        'raw': b'x' * 10000,
+        'mutable': bytearray(b'y' * 10000),
+        'counts': array('q', range(10000)),
+        'small': b'z',
+    }
+
+
+def worker(transport, conn):  # pragma: no cover  runs in a child process
+    frame = conn.recv_bytes()
+    item = transport.loads(frame)
+    result = (float(item['values'].sum()), len(item['raw']))
+    del item
+    transport.release(frame)
+    transport.close()
+    conn.send(result)
+
+
+class SharedMemoryTransportTests(TestCase):
+    def setUp(self):
+        self.transport = SharedMemoryTransport(min_segment_size=1024)
+
+    def tearDown(self):
+        self.transport.close()
+
+    def assert_round_trip(self, item, loaded):
+        self.assertTrue(numpy.array_equal(item['values'], loaded['values']))
+        self.assertEqual(loaded['raw'], item['raw'])
+        self.assertEqual(type(loaded['mutable']), bytearray)
+        self.assertEqual(loaded['mutable'], item['mutable'])
+        self.assertEqual(loaded['counts'], item['counts'])
+        self.assertEqual(loaded['small'], b'z')
+
+    def test_round_trip(self):
+        item = make_item()
+        frame = self.transport.dumps(item)
+        self.assertLess(len(frame), 1000)
+        loaded = self.transport.loads(frame)
+        self.assert_round_trip(item, loaded)
+        del loaded
+        self.transport.release(frame)
+
+    def test_in_band_only(self):
+        frame = self.transport.dumps({'a': 1, 'b': numpy.arange(3)})
+        loaded = self.transport.loads(frame)
+        self.assertEqual(list(loaded['b']), [0, 1, 2])
+        self.transport.release(frame)
+        self.assertEqual(self.transport.num_segments, 0)
+
+    def test_segments_recycled(self):
+        item = make_item()
+        for _ in range(5):
+            frame = self.transport.dumps(item)
+            self.transport.loads(frame, copy=True)
+        self.assertEqual(self.transport.num_segments, 1)
+
+    def test_max_free_segments(self):
+        transport = SharedMemoryTransport(max_free_segments=0)
+        frame = transport.dumps(make_item())
+        transport.release(frame)
+        self.assertEqual(transport.num_segments, 0)
+        transport.release(b'ignored' and frame)
+        transport.close()
+
+    def test_close_unlinks(self):
+        self.transport.dumps(make_item())
+        self.transport.dumps(make_item())
+        self.assertEqual(self.transport.num_segments, 2)
+        self.transport.close()
+        self.assertEqual(self.transport.num_segments, 0)
+
+    def test_pickled_transport_has_no_segments(self):
+        self.transport.dumps(make_item())
+        state = self.transport.__getstate__()
+        self.assertNotIn('_owned', state)
+        clone = SharedMemoryTransport.__new__(SharedMemoryTransport)
+        clone.__setstate__(state)
+        self.assertEqual(clone.num_segments, 0)
+        self.assertEqual(clone.min_size, self.transport.min_size)
+
+    def test_list_items(self):
+        item = [b'x' * 10000, (b'small',), bytearray(10000)]
+        loaded = self.transport.loads(self.transport.dumps(item))
+        self.assertEqual(loaded, item)
+        item = tuple(item)
+        self.assertEqual(
+            self.transport.loads(self.transport.dumps(item), copy=True), item)
+
+    def test_receiving_side(self):
+        # a receiving side is a copy of the transport that owns no segments
+        receiver = SharedMemoryTransport.__new__(SharedMemoryTransport)
+        receiver.__setstate__(self.transport.__getstate__())
+
+        frame = self.transport.dumps(make_item())
+        loaded = receiver.loads(frame)
+        self.assertEqual(loaded['raw'], b'x' * 10000)
+        self.assertEqual(receiver.loads(frame, copy=True)['small'], b'z')
+        del loaded
+        receiver.close()
+
+        # the release from the receiver lets the sender reuse the segment
+        self.transport.dumps(make_item())
+        self.assertEqual(self.transport.num_segments, 1)
+
+        # names of segments that were already unlinked are ignored
+        self.transport.close()
+        self.transport.dumps(make_item())
+        receiver.release(frame)
+        self.transport.dumps(make_item())
+        self.assertEqual(self.transport.num_segments, 2)
+
+    def test_receiver_unmaps_released_segments(self):
+        transport = SharedMemoryTransport(min_segment_size=1024, max_free_segments=1)
+        receiver = SharedMemoryTransport.__new__(SharedMemoryTransport)
+        receiver.__setstate__(transport.__getstate__())
+        for _ in range(20):
+            frames = [transport.dumps(make_item()) for _ in range(3)]
+            for frame in frames:
+                receiver.loads(frame, copy=True)
+        self.assertEqual(receiver._attached, {})
+        self.assertEqual(receiver._detaching, [])
+
+        # a segment with a live view stays mapped until a later release
+        frame = transport.dumps(make_item())
+        loaded = receiver.loads(frame)
+        receiver.release(frame)
+        self.assertEqual(len(receiver._detaching), 1)
+        del loaded
+        frame = transport.dumps(make_item())
+        receiver.loads(frame, copy=True)
+        self.assertEqual(receiver._detaching, [])
+        receiver.close()
+        transport.close()
+
+    def test_forked_state_is_reset(self):
+        self.transport.dumps(make_item())
+        owned = dict(self.transport._owned)
+
+        # pretend to be a forked child.  It must not unlink parent segments.
+        self.transport._pid = -1
+        self.transport.close()
+        self.assertEqual(self.transport.num_segments, 0)
+
+        for segment in owned.values():
+            segment.close()
+            segment.unlink()
+
+    def test_bytes_item(self):
+        frame = self.transport.dumps(b'x' * 10000)
+        self.assertEqual(self.transport.loads(frame), b'x' * 10000)
+
+    def test_across_processes(self):
+        item = make_item()
+        parent_conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(
+            target=worker, args=(self.transport, child_conn))
+        proc.start()
+        parent_conn.send_bytes(self.transport.dumps(item))
+        self.assertEqual(
+            parent_conn.recv(), (float(item['values'].sum()), 10000))
+        proc.join()
+
+        # the worker released the segment, so it gets reused
+        self.transport.dumps(item)
+        self.assertEqual(self.transport.num_segments, 1)
+
+    def test_frame_is_pickle(self):
+        frame = self.transport.dumps(make_item())
+        name, layout, data = pickle.loads(frame)
+        self.assertEqual(len(layout), 4)
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from consecution.tuning import BatchTuner
+
+
+def run(tuner, seconds_for, num_batches):
+    # feed the tuner batches that take seconds_for(size) each
+    sizes = []
+    for _ in range(num_batches):
+        sizes.append(tuner.size)
+        tuner.record(tuner.size, seconds_for(tuner.size))
+    return sizes
+
+
+class BatchTunerTests(TestCase):
+    def test_grows_while_faster(self):
+        # a fixed cost per batch makes bigger batches faster
+        tuner = BatchTuner(1, 1000, window=2)
+        sizes = run(tuner, lambda size: .001 + 1e-6 * size, 40)
+        self.assertEqual(sizes[:6], [1, 1, 2, 2, 4, 4])
+        self.assertEqual(sizes[-1], 1000)
+        self.assertEqual(tuner.decisions[0].reason, 'faster')
+        self.assertEqual(
+            (tuner.decisions[0].old_size, tuner.decisions[0].new_size), (1, 2))
+        self.assertIn('1 -> 2', repr(tuner.decisions[0]))
+        self.assertIn('size=1000', repr(tuner))
+
+    def test_turns_around_when_slower(self):
+        # the throughput peaks at a batch size of 1000
+        tuner = BatchTuner(1, 100000, start=64, window=1)
+        run(tuner, lambda size: .001 + 1e-6 * size + 1e-9 * size ** 2, 50)
+        reasons = {decision.reason for decision in tuner.decisions}
+        self.assertEqual(reasons, {'faster', 'slower'})
+        self.assertIn(tuner.size, [256, 512, 1024, 2048])
+
+    def test_latency_ceiling(self):
+        tuner = BatchTuner(1, 100000, max_latency=.01, start=1000, window=1)
+        sizes = run(tuner, lambda size: 2e-5 * size, 20)
+        self.assertEqual(sizes[:2], [1000, 500])
+        self.assertEqual(tuner.decisions[0].reason, 'over_latency')
+        # growing back would go over the ceiling, so the size stays
+        self.assertEqual(set(sizes[1:]), {500})
+
+    def test_latency_measured_separately(self):
+        tuner = BatchTuner(1, 100, max_latency=.5, start=10, window=1)
+        tuner.record(10, .001, latency=1.)
+        self.assertEqual(tuner.size, 5)
+        self.assertEqual(tuner.latency, 1.)
+        self.assertEqual(tuner.items_per_second, 10000.)
+
+    def test_bounds(self):
+        tuner = BatchTuner(4, 6, start=100, window=1)
+        self.assertEqual(tuner.size, 6)
+        self.assertEqual(run(tuner, lambda size: .001, 3), [6, 6, 6])
+        self.assertEqual(len(tuner.decisions), 0)
+        with self.assertRaises(ValueError):
+            BatchTuner(0, 10)
+        with self.assertRaises(ValueError):
+            BatchTuner(10, 5)
+        with self.assertRaises(ValueError):
+            BatchTuner(1, 10, factor=1)
+
+    def test_copy(self):
+        tuner = BatchTuner(1, 1000, window=1)
+        run(tuner, lambda size: .001, 5)
+        copy = tuner.copy()
+        self.assertEqual(copy.size, 1)
+        self.assertEqual(len(copy.decisions), 0)
+        self.assertEqual(
+            (copy.min_size, copy.max_size, copy.window), (1, 1000, 1))
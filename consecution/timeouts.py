@@ -0,0 +1,330 @@
+from queue import Empty, SimpleQueue
+import multiprocessing
+import threading
+import time
+import traceback
+
+from consecution.errors import DeadLetter
+
+
+# tells a worker thread to finish
+_CLOSE = object()
+
+
+class ProcessTimeout(Exception):
+    """
+    The error for an item that a node did not finish processing in time, or
+    whose deadline had passed before the node got to it.
+    """
+
+
+class TimeoutCounts(object):
+    """
+    Timeout counters for one node.
+
+    :ivar timed_out: The number of calls abandoned because they ran too long
+    :ivar expired: The number of items skipped because their deadline had
+                   passed before the node got to them
+    :ivar dead_lettered: The number of records sent to the timeout sink
+    """
+    __slots__ = ['timed_out', 'expired', 'dead_lettered']
+
+    def __init__(self):
+        self.timed_out = 0
+        self.expired = 0
+        self.dead_lettered = 0
+
+    def __repr__(self):
+        return 'TimeoutCounts(timed_out={}, expired={}, dead_lettered={})'.format(
+            self.timed_out, self.expired, self.dead_lettered)
+
+
+class _Inline(object):
+    """
+    Runs calls in the calling thread.  Used by nodes that only check
+    deadlines, which needs no way of abandoning a call.
+    """
+    def __init__(self, node, process):
+        self._node = node
+        self._process = process
+        self.push = None
+
+    def wire(self, push):
+        self.push = push
+        return push
+
+    def call(self, item, limit):
+        self._process(item)
+        return (), None
+
+    def end(self):
+        self._node.end()
+        return (), None
+
+    def close(self):
+        pass
+
+
+class _ThreadRunner(object):
+    """
+    Runs the calls of a node on a worker thread while the calling thread
+    waits.  Items the node pushes are buffered and pushed downstream by the
+    calling thread once the call is done, so downstream nodes never run on
+    the worker.  A call that runs too long is abandoned, and its worker
+    thread exits once the call returns.  Whatever it pushes in the meantime
+    is thrown away.
+    """
+    def __init__(self, node, process):
+        self._node = node
+        self._process = process
+        self._local = threading.local()
+        self._worker = None
+        self.push = None
+
+    def wire(self, push):
+        self.push = push
+        local = self._local
+
+        def buffered_push(item):
+            outputs = getattr(local, 'outputs', None)
+            if outputs is None:
+                # pushes from .end() and friends are not on a worker
+                push(item)
+            else:
+                outputs.append(item)
+        return buffered_push
+
+    def _serve(self, requests, results):
+        local = self._local
+        while True:
+            item = requests.get()
+            if item is _CLOSE:
+                return
+            local.outputs = outputs = []
+            try:
+                self._process(item)
+            except Exception as error:
+                results.put((outputs, error))
+            else:
+                results.put((outputs, None))
+
+    def call(self, item, limit):
+        if self._worker is None:
+            self._worker = (SimpleQueue(), SimpleQueue())
+            thread = threading.Thread(
+                target=self._serve, args=self._worker,
+                name='consecution-timeout')
+            thread.daemon = True
+            thread.start()
+        requests, results = self._worker
+        requests.put(item)
+        try:
+            return results.get(timeout=limit)
+        except Empty:
+            self.close()
+            raise ProcessTimeout()
+
+    def end(self):
+        # the worker shares the state of the node, so it ends right here
+        self._node.end()
+        return (), None
+
+    def close(self):
+        if self._worker is not None:
+            self._worker[0].put(_CLOSE)
+            self._worker = None
+
+
+class _ProcessRunner(object):
+    """
+    Runs the calls of a node in a forked child process.  Items and the items
+    the node pushes are pickled across.  A call that runs too long kills the
+    process, and the next call starts a new one, so the node starts over from
+    the state it had when the pipeline began.  The node is ended in the child
+    as well, since that is where its state is.
+    """
+    def __init__(self, node, process):
+        self._node = node
+        self._process = process
+        self._worker = None
+        self.push = None
+
+    def wire(self, push):
+        self.push = push
+        return push
+
+    def _serve(self, conn):  # pragma: no cover  runs in a child process
+        outputs = []
+        self._node.push = outputs.append
+        while True:
+            request = conn.recv()
+            if request is None:
+                return
+            del outputs[:]
+            try:
+                if request:
+                    self._process(request[0])
+                else:
+                    self._node.end()
+                conn.send((outputs, None))
+            except Exception as error:
+                try:
+                    conn.send((outputs, error))
+                except Exception:
+                    # the error can't be pickled, so its traceback is sent
+                    conn.send((outputs, RuntimeError(traceback.format_exc())))
+
+    def _start(self):
+        context = multiprocessing.get_context('fork')
+        conn, child_conn = context.Pipe()
+        process = context.Process(
+            target=self._serve, args=(child_conn,),
+            name='consecution-timeout-{}'.format(self._node.name))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self._worker = (process, conn)
+
+    def call(self, item, limit):
+        if self._worker is None:
+            self._start()
+        conn = self._worker[1]
+        conn.send((item,))
+        if not conn.poll(limit):
+            self._kill()
+            raise ProcessTimeout()
+        return self._receive()
+
+    def end(self):
+        if self._worker is None:
+            # nothing ran in a child since the node began, so its state is
+            # still here
+            self._node.end()
+            return (), None
+        try:
+            self._worker[1].send(())
+        except OSError:
+            # the process is gone, which receiving reports
+            pass
+        return self._receive()
+
+    def _receive(self):
+        try:
+            return self._worker[1].recv()
+        except EOFError:
+            self._kill()
+            raise RuntimeError(
+                '\n\nThe process running node {} died\n'.format(
+                    repr(self._node.name)))
+
+    def _kill(self):
+        process, conn = self._worker
+        self._worker = None
+        process.terminate()
+        process.join()
+        conn.close()
+
+    def close(self):
+        if self._worker is not None:
+            process, conn = self._worker
+            self._worker = None
+            try:
+                conn.send(None)
+            except OSError:
+                # the process is already gone
+                pass
+            process.join()
+            conn.close()
+
+
+_RUNNERS = {'thread': _ThreadRunner, 'process': _ProcessRunner}
+
+
+class TimeoutGuard(object):
+    """
+    Enforces the timeout policy of one node, set by ``.on_timeout()``.  Only
+    nodes with a policy get one.
+
+    :type node: Node
+    :param node: A node with a timeout policy
+
+    :type process: callable
+    :param process: The processing callable of the node
+
+    :type counts: TimeoutCounts
+    :param counts: The counters to update
+
+    :type deadline: list
+    :param deadline: A one-element list holding the deadline of the root item
+                     being processed, as a ``time.time()`` value, or None
+    """
+    def __init__(self, node, process, counts, deadline):
+        self.seconds, self.policy, self.sink, mode = node._timeout_policy
+        self.name = node.name
+        self.counts = counts
+        self._deadline = deadline
+        if self.seconds is None:
+            self.runner = _Inline(node, process)
+        else:
+            self.runner = _RUNNERS[mode](node, process)
+
+    def wire(self, push):
+        """
+        :type push: callable
+        :param push: The push callable wired for the node
+
+        :rtype: callable
+        :return: The push callable to give the node instead
+        """
+        return self.runner.wire(push)
+
+    def __call__(self, item):
+        limit = self.seconds
+        deadline = self._deadline[0]
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.counts.expired += 1
+                return self._time_out(item, ProcessTimeout(
+                    'The deadline of the item passed before node {} got to '
+                    'it'.format(repr(self.name))))
+            if limit is None or remaining < limit:
+                limit = remaining
+
+        try:
+            outputs, error = self.runner.call(item, limit)
+        except ProcessTimeout:
+            self.counts.timed_out += 1
+            return self._time_out(item, ProcessTimeout(
+                'Node {} took longer than {:.6g} seconds'.format(
+                    repr(self.name), limit)))
+        self._push_outputs(outputs, error)
+
+    def end(self):
+        """
+        Call the ``.end()`` method of the node where its calls run, and push
+        what it pushed.
+        """
+        self._push_outputs(*self.runner.end())
+
+    def _push_outputs(self, outputs, error):
+        # items pushed before an error still go downstream, as they would
+        # have without a timeout
+        push = self.runner.push
+        for output in outputs:
+            push(output)
+        if error is not None:
+            raise error
+
+    def _time_out(self, item, error):
+        if self.policy == 'raise':
+            raise error
+        if self.policy == 'dead_letter':
+            self.counts.dead_lettered += 1
+            self.sink._process(DeadLetter(item, self.name, error, ''))
+
+    def close(self):
+        """
+        Stop the worker thread or process, if there is one.
+        """
+        self.runner.close()
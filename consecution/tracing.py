@@ -0,0 +1,161 @@
+from collections import deque
+import json
+import os
+import time
+
+
+class Trace(object):
+    """
+    The spans recorded while one sampled input item moved through the graph.
+
+    :ivar trace_id: The number of the input item this trace followed
+    :ivar item: A short repr of the input item
+    :ivar spans: A list of ``[node_name, start, end, depth]`` lists in the
+                 order the nodes were entered.  Times are in seconds from
+                 ``time.perf_counter()``.  Depth is the number of enclosing
+                 node calls, so a node's downstreams are one level deeper.
+    """
+    __slots__ = ['trace_id', 'item', 'spans']
+
+    def __init__(self, trace_id, item):
+        self.trace_id = trace_id
+        self.item = item
+        self.spans = []
+
+    @property
+    def duration(self):
+        """
+        Seconds from the item entering its root node until every node it
+        reached was done with it.
+        """
+        return self.spans[0][2] - self.spans[0][1]
+
+    def __repr__(self):
+        return 'Trace(trace_id={}, spans={}, duration={:.6f})'.format(
+            self.trace_id, len(self.spans), self.duration)
+
+
+class Tracer(object):
+    """
+    :type pipeline: Pipeline
+    :param pipeline: The pipeline to trace.  It must not be running yet.
+
+    :type sample_every: int
+    :param sample_every: Trace one in this many items pushed to the root
+                         nodes
+
+    :type max_traces: int
+    :param max_traces: The number of most recent traces kept
+
+    Records how long sampled input items take to produce all of their
+    downstream effects.  Every node records a span when it is entered and
+    left while a sampled item is being processed, including nodes reached
+    through broadcasts and routers.  Nodes are called synchronously by
+    ``.push()``, so the spans of one trace nest like a call stack.
+
+    .. code-block:: python
+
+       from consecution import Tracer
+
+       with Tracer(pipe, sample_every=1000) as tracer:
+           pipe.consume(items)
+       tracer.export_chrome('trace.json')
+
+    The exported file can be opened in Perfetto or ``chrome://tracing``.  Each
+    trace is drawn on its own track.
+    """
+    def __init__(self, pipeline, sample_every=100, max_traces=1000):
+        self.sample_every = sample_every
+        self.traces = deque(maxlen=max_traces)
+        self._current = None
+        self._depth = 0
+        self._num_items = 0
+        self._pipeline = pipeline
+        pipeline.add_process_wrapper(self.wrap_node)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop tracing the pipeline.  The traces recorded so far are kept.
+        """
+        if self._pipeline is not None:
+            self._pipeline.remove_process_wrapper(self.wrap_node)
+            self._pipeline = None
+
+    def wrap_node(self, node, process):
+        """
+        A process wrapper for ``Pipeline.add_process_wrapper()``.
+        """
+        name = node.name
+        tracer = self
+        clock = time.perf_counter
+
+        def traced(item):
+            trace = tracer._current
+            if trace is None:
+                return process(item)
+            span = [name, clock(), None, tracer._depth]
+            trace.spans.append(span)
+            tracer._depth += 1
+            try:
+                return process(item)
+            finally:
+                tracer._depth -= 1
+                span[2] = clock()
+
+        if node._upstream_nodes:
+            return traced
+
+        every = self.sample_every
+
+        def traced_root(item):
+            tracer._num_items += 1
+            if tracer._num_items % every:
+                return process(item)
+            tracer._current = Trace(tracer._num_items, repr(item)[:100])
+            try:
+                return traced(item)
+            finally:
+                tracer.traces.append(tracer._current)
+                tracer._current = None
+                tracer._depth = 0
+        return traced_root
+
+    def chrome_trace(self):
+        """
+        :rtype: dict
+        :return: The traces as a Chrome trace-event format document
+        """
+        traces = list(self.traces)
+        origin = min([t.spans[0][1] for t in traces] or [0.])
+        pid = os.getpid()
+        events = []
+        for trace in traces:
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                'tid': trace.trace_id,
+                'args': {'name': 'item {}'.format(trace.trace_id)},
+            })
+            for name, start, end, depth in trace.spans:
+                events.append({
+                    'name': name, 'cat': 'node', 'ph': 'X',
+                    'ts': 1e6 * (start - origin), 'dur': 1e6 * (end - start),
+                    'pid': pid, 'tid': trace.trace_id,
+                    'args': {'depth': depth, 'item': trace.item},
+                })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome(self, file_name):
+        """
+        Write the traces to a Chrome trace-event JSON file.
+
+        :type file_name: str
+        :param file_name: The name of the file to write
+        """
+        with open(file_name, 'w') as out_file:
+            json.dump(self.chrome_trace(), out_file)
@@ -0,0 +1,353 @@
+from array import array
+import io
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import os
+import pickle
+
+
+# out-of-band buffers are laid out at offsets that are multiples of this
+_ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _size_class(nbytes, min_segment_size):
+    """
+    Segments are allocated in power-of-two sizes so they can be recycled for
+    frames of similar size.
+    """
+    size = min_segment_size
+    while size < nbytes:
+        size *= 2
+    return size
+
+
+def _bytes_from_buffer(buf):
+    return bytes(buf)
+
+
+def _bytearray_from_buffer(buf):
+    return bytearray(buf)
+
+
+def _array_from_buffer(typecode, buf):
+    arr = array(typecode)
+    arr.frombytes(buf)
+    return arr
+
+
+class _BytesPayload(object):
+    """
+    The C pickler writes bytes and bytearrays straight into the pickle stream
+    without consulting ``reducer_override``, so large ones are wrapped in this
+    class to get them sent out of band.
+    """
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce__(self):
+        if type(self.data) is bytes:
+            return _bytes_from_buffer, (pickle.PickleBuffer(self.data),)
+        return _bytearray_from_buffer, (pickle.PickleBuffer(self.data),)
+
+
+def _wrap_bytes(obj, min_size):
+    if type(obj) in (bytes, bytearray) and len(obj) >= min_size:
+        return _BytesPayload(obj)
+    return obj
+
+
+def _wrap_payloads(item, min_size):
+    """
+    Wrap large bytes payloads found in the item itself or directly inside a
+    dict, list or tuple item.
+    """
+    item_type = type(item)
+    if item_type is dict:
+        return {k: _wrap_bytes(v, min_size) for (k, v) in item.items()}
+    elif item_type is list or item_type is tuple:
+        return item_type(_wrap_bytes(v, min_size) for v in item)
+    return _wrap_bytes(item, min_size)
+
+
+class _OutOfBandPickler(pickle.Pickler):
+    """
+    A protocol 5 pickler that also sends large array.array payloads out of
+    band.  NumPy arrays already do this on their own.
+    """
+    def __init__(self, file, min_size, buffer_callback):
+        super(_OutOfBandPickler, self).__init__(
+            file, protocol=5, buffer_callback=buffer_callback)
+        self._min_size = min_size
+
+    def reducer_override(self, obj):
+        if type(obj) is array and len(obj) * obj.itemsize >= self._min_size:
+            return _array_from_buffer, (obj.typecode, pickle.PickleBuffer(obj))
+        return NotImplemented
+
+
+class SharedMemoryTransport(object):
+    """
+    :type min_size: int
+    :param min_size: Buffers smaller than this many bytes are pickled in-band.
+
+    :type min_segment_size: int
+    :param min_segment_size: The smallest shared memory segment allocated.
+                             Larger segments are allocated in powers of two.
+
+    :type max_free_segments: int
+    :param max_free_segments: The maximum number of released segments kept
+                              around for reuse.
+
+    A transport for moving items between processes.  Items are pickled with
+    protocol 5.  Large buffers are copied once into a ``multiprocessing``
+    shared memory segment instead of being written into the pickle stream,
+    and the small frame returned by ``.dumps()`` is all that needs to travel
+    through a pipe or socket.  This applies to NumPy arrays and array.array
+    objects anywhere in the item, and to bytes and bytearrays that are either
+    the item itself or values of a dict, list or tuple item.
+
+    NumPy arrays loaded with ``.loads()`` are views onto shared memory, so the
+    receiving side must call ``.release(frame)`` once it is done with the
+    loaded item.  Released segments are unmapped on the receiving side,
+    handed back to the sending side and recycled instead of being allocated
+    again.  Call ``.loads(frame, copy=True)`` to copy the buffers out and
+    release the segment right away.
+
+    A transport carries items in one direction, so use one transport for each
+    direction.  Create it before starting the worker processes so that both
+    sides share its release queue.  The sending side owns every segment and
+    unlinks them when ``.close()`` is called.
+
+    ``DistributedPipeline`` does not use this transport.  Its partitions exit
+    as soon as they have sent their last batch, while the partitions below
+    may still be reading it, and the nodes there are free to keep the items
+    they are handed, so nothing could tell when a segment may be unlinked.
+    """
+    def __init__(
+            self, min_size=4096, min_segment_size=2 ** 16,
+            max_free_segments=16):
+        self.min_size = min_size
+        self.min_segment_size = min_segment_size
+        self.max_free_segments = max_free_segments
+        # a SimpleQueue writes straight to its pipe, so a release made by a
+        # worker is visible here as soon as the worker's put() returns
+        self._released = multiprocessing.SimpleQueue()
+        self._init_local_state()
+
+        # Worker processes started after this point share the resource
+        # tracker of this process.  Otherwise each worker would start its own
+        # tracker and unlink the segments it attached to when it exits.
+        resource_tracker.ensure_running()
+
+    def _init_local_state(self):
+        self._pid = os.getpid()
+        # segments created by this process, keyed by name
+        self._owned = {}
+        # recycled segments waiting to be reused, keyed by size
+        self._free = {}
+        # segments created by another process that this process attached to
+        self._attached = {}
+        # released segments that could not be unmapped yet because views
+        # onto them were still alive
+        self._detaching = []
+
+    def __getstate__(self):
+        # only configuration and the release queue cross process boundaries
+        state = dict(self.__dict__)
+        for key in ['_pid', '_owned', '_free', '_attached', '_detaching']:
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local_state()
+
+    def _check_process(self):
+        # a forked worker inherits a copy of the parent's segment lookups, but
+        # the segments still belong to the parent
+        if os.getpid() != self._pid:
+            self._init_local_state()
+
+    def _collect_released(self):
+        # only the sending side owns segments, so only it takes releases
+        if not self._owned:
+            return
+        while not self._released.empty():
+            self._recycle(self._released.get())
+
+    def _recycle(self, name):
+        segment = self._owned.get(name)
+        if segment is None:
+            return
+        free_list = self._free.setdefault(segment.size, [])
+        if sum(len(f) for f in self._free.values()) < self.max_free_segments:
+            free_list.append(segment)
+        else:
+            self._unlink(name)
+
+    def _unlink(self, name):
+        segment = self._owned.pop(name)
+        segment.close()
+        segment.unlink()
+
+    def _allocate(self, nbytes):
+        self._collect_released()
+        size = _size_class(nbytes, self.min_segment_size)
+        free_list = self._free.get(size)
+        if free_list:
+            return free_list.pop()
+        segment = shared_memory.SharedMemory(create=True, size=size)
+        self._owned[segment.name] = segment
+        return segment
+
+    def _attach(self, name):
+        segment = self._attached.get(name)
+        if segment is None:
+            segment = self._owned.get(name)
+        if segment is None:
+            segment = shared_memory.SharedMemory(name=name)
+            self._attached[name] = segment
+        return segment
+
+    def _detach(self, name):
+        # Unmap a segment of another process once its frame is released, so
+        # that a long-running receiver does not keep every segment it ever saw
+        # mapped.  Segments with live views are retried on the next release.
+        segment = self._attached.pop(name, None)
+        if segment is not None:
+            self._detaching.append(segment)
+        still_mapped = []
+        for segment in self._detaching:
+            try:
+                segment.close()
+            except BufferError:
+                still_mapped.append(segment)
+        self._detaching = still_mapped
+
+    @property
+    def num_segments(self):
+        """
+        The number of shared memory segments this process has allocated and
+        not yet unlinked.
+        """
+        return len(self._owned)
+
+    def dumps(self, item):
+        """
+        Serialize an item into a small frame, moving its large buffers into
+        shared memory.
+
+        :type item: object
+        :param item: Any picklable object
+
+        :rtype: bytes
+        :return: A frame that can be sent to another process
+        """
+        self._check_process()
+        buffers = []
+
+        def buffer_callback(buf):
+            # returning a true value keeps small buffers in-band
+            if buf.raw().nbytes < self.min_size:
+                return True
+            buffers.append(buf)
+
+        stream = io.BytesIO()
+        pickler = _OutOfBandPickler(stream, self.min_size, buffer_callback)
+        pickler.dump(_wrap_payloads(item, self.min_size))
+        data = stream.getvalue()
+
+        if not buffers:
+            return pickle.dumps((None, [], data), protocol=5)
+
+        raws = [buf.raw() for buf in buffers]
+        layout = []
+        offset = 0
+        for raw in raws:
+            offset = _align(offset)
+            layout.append((offset, raw.nbytes))
+            offset += raw.nbytes
+
+        segment = self._allocate(offset)
+        for raw, (start, nbytes) in zip(raws, layout):
+            segment.buf[start:start + nbytes] = raw
+        return pickle.dumps((segment.name, layout, data), protocol=5)
+
+    def loads(self, frame, copy=False):
+        """
+        Rebuild an item from a frame made by ``.dumps()``.
+
+        :type frame: bytes
+        :param frame: A frame made by ``.dumps()``
+
+        :type copy: Bool
+        :param copy: If true, the buffers are copied out of shared memory and
+                     the frame is released immediately.
+
+        :rtype: object
+        :return: The item
+        """
+        self._check_process()
+        name, layout, data = pickle.loads(frame)
+        if name is None:
+            return pickle.loads(data)
+
+        segment = self._attach(name)
+        views = [segment.buf[start:start + nbytes]
+                 for (start, nbytes) in layout]
+        if copy:
+            copies = [bytearray(view) for view in views]
+            for view in views:
+                view.release()
+            item = pickle.loads(data, buffers=copies)
+            self.release(frame)
+        else:
+            item = pickle.loads(data, buffers=views)
+        return item
+
+    def release(self, frame):
+        """
+        Tell the sending side that the shared memory behind a frame can be
+        reused.  Items loaded from the frame without copying must not be used
+        after this is called.
+
+        :type frame: bytes
+        :param frame: A frame made by ``.dumps()``
+        """
+        self._check_process()
+        name = pickle.loads(frame)[0]
+        if name is None:
+            return
+        if name in self._owned:
+            self._recycle(name)
+        else:
+            self._released.put(name)
+            self._detach(name)
+
+    def close(self):
+        """
+        Detach from shared memory and unlink every segment this process
+        created.
+        """
+        self._check_process()
+        for segment in list(self._attached.values()) + self._detaching:
+            try:
+                segment.close()
+            except BufferError:  # pragma: no cover  views still alive
+                pass
+        self._attached = {}
+        self._detaching = []
+        self._collect_released()
+        for name in list(self._owned.keys()):
+            try:
+                self._unlink(name)
+            except BufferError:  # pragma: no cover  views still alive
+                self._owned[name].unlink()
+                self._owned.pop(name)
+        self._free = {}
@@ -0,0 +1,195 @@
+from collections import deque
+import time
+
+
+class TuningDecision(object):
+    """
+    A change of batch size made by a ``BatchTuner``.
+
+    :ivar time: The ``time.time()`` the decision was made at
+    :ivar old_size: The batch size before the decision
+    :ivar new_size: The batch size after it
+    :ivar items_per_second: The throughput measured at the old size
+    :ivar latency: The mean latency of a batch at the old size
+    :ivar reason: Why the size changed.  'faster' if the last change raised
+                  the throughput, so the tuner kept going the same way,
+                  'slower' if it lowered it, so the tuner turned around, and
+                  'over_latency' if the batches took longer than allowed.
+    """
+    __slots__ = [
+        'time', 'old_size', 'new_size', 'items_per_second', 'latency',
+        'reason']
+
+    def __init__(self, old_size, new_size, items_per_second, latency, reason):
+        self.time = time.time()
+        self.old_size = old_size
+        self.new_size = new_size
+        self.items_per_second = items_per_second
+        self.latency = latency
+        self.reason = reason
+
+    def __repr__(self):
+        return (
+            'TuningDecision({} -> {}, items_per_second={:.6g}, '
+            'latency={:.6g}, reason={})'
+        ).format(self.old_size, self.new_size, self.items_per_second,
+                 self.latency, repr(self.reason))
+
+
+class BatchTuner(object):
+    """
+    :type min_size: int
+    :param min_size: The smallest batch size to use
+
+    :type max_size: int
+    :param max_size: The largest batch size to use
+
+    :type max_latency: float
+    :param max_latency: If set, the batch size is kept small enough that a
+                        batch takes no more than this many seconds on average
+
+    :type start: int
+    :param start: The batch size to start with.  Defaults to ``min_size``.
+
+    :type window: int
+    :param window: The number of batches measured before each decision
+
+    :type factor: float
+    :param factor: The batch size is multiplied or divided by this at each
+                   step
+
+    :type tolerance: float
+    :param tolerance: The fraction the throughput may drop by between windows
+                      before it counts as slower rather than noise
+
+    :type history: int
+    :param history: The number of decisions kept in ``.decisions``
+
+    Finds the batch size with the best throughput under a latency ceiling,
+    by measuring batches as they are processed.  Pass one in place of the
+    batch size of ``ToColumnBatch``, ``ThreadedPusher`` or
+    ``DistributedPipeline``.  Every ``window`` batches the tuner compares the
+    items per second to the previous window.  It keeps stepping the size the
+    same way while the throughput rises and turns around when it falls.  If
+    the batches took longer than ``max_latency``, the size is stepped down,
+    and it is never stepped up to where the latency, scaled by the size,
+    would go over.
+
+    The current size is in ``.size``, the last measurements in
+    ``.items_per_second`` and ``.latency``, and the latest changes of size
+    in ``.decisions``.  Pipelines list the tuners of their stages in their
+    ``.batch_tuners`` dict.
+
+    .. code-block:: python
+
+       from consecution import BatchTuner, ToColumnBatch
+
+       to_batch = ToColumnBatch(
+           'to_batch', BatchTuner(100, 100000, max_latency=0.05))
+    """
+    def __init__(self, min_size=1, max_size=10000, max_latency=None,
+                 start=None, window=10, factor=2., tolerance=0.05,
+                 history=100):
+        if not 1 <= min_size <= max_size:
+            raise ValueError(
+                '\n\nBatch sizes must satisfy 1 <= min_size <= max_size.  '
+                'Got {} and {}\n'.format(min_size, max_size))
+        if factor <= 1:
+            raise ValueError(
+                '\n\nfactor must be greater than 1.  Got {}\n'.format(factor))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self.start = start
+        self.window = window
+        self.factor = factor
+        self.tolerance = tolerance
+        self.history = history
+
+        self.size = min(max_size, max(min_size, start or min_size))
+        self.items_per_second = None
+        self.latency = None
+        self.decisions = deque(maxlen=history)
+        self._direction = 1
+        self._previous = None
+        self._reset_window()
+
+    def __repr__(self):
+        return 'BatchTuner(size={}, items_per_second={}, latency={})'.format(
+            self.size, self.items_per_second, self.latency)
+
+    def copy(self):
+        """
+        :rtype: BatchTuner
+        :return: A new tuner with the same settings that starts over
+        """
+        return BatchTuner(
+            self.min_size, self.max_size, self.max_latency, self.start,
+            self.window, self.factor, self.tolerance, self.history)
+
+    def _reset_window(self):
+        self._batches = 0
+        self._items = 0
+        self._seconds = 0.
+        self._latency = 0.
+
+    def record(self, num_items, seconds, latency=None):
+        """
+        Measure a processed batch.
+
+        :type num_items: int
+        :param num_items: The number of items in the batch
+
+        :type seconds: float
+        :param seconds: The seconds spent processing the batch
+
+        :type latency: float
+        :param latency: The seconds the batch kept its items waiting, if that
+                        is longer than the processing time, for example
+                        because the batch had to fill up first
+
+        :rtype: int
+        :return: The batch size to use next
+        """
+        self._batches += 1
+        self._items += num_items
+        self._seconds += seconds
+        self._latency += seconds if latency is None else latency
+        if self._batches >= self.window:
+            self._decide()
+        return self.size
+
+    def _decide(self):
+        # a window too quick for the clock counts as very fast
+        throughput = self._items / max(self._seconds, 1e-9)
+        latency = self._latency / self._batches
+        self._reset_window()
+        self.items_per_second, self.latency = throughput, latency
+
+        previous, self._previous = self._previous, throughput
+        if self.max_latency is not None and latency > self.max_latency:
+            # Step down, then try growing again from the smaller size.  The
+            # smaller size is not compared to this one, which was too slow.
+            step, reason = -1, 'over_latency'
+            self._direction, self._previous = 1, None
+        elif previous is not None and throughput < previous * (
+                1 - self.tolerance):
+            self._direction = step = -self._direction
+            reason = 'slower'
+        else:
+            step, reason = self._direction, 'faster'
+
+        size = self.size
+        if step > 0:
+            new_size = min(self.max_size, max(size + 1, int(size * self.factor)))
+            # don't grow into batches that would be too slow
+            limit = self.max_latency
+            if limit is not None and latency * new_size / size > limit:
+                new_size = size
+        else:
+            new_size = max(self.min_size, min(size - 1, int(size / self.factor)))
+
+        if new_size != size:
+            self.size = new_size
+            self.decisions.append(TuningDecision(
+                size, new_size, throughput, latency, reason))
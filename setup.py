@@ -46,12 +46,17 @@ setup(
         'Environment :: Console',
         'Intended Audience :: Developers',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Scientific/Engineering',
     ],
-    extras_require={'dev': ['nose', 'coverage', 'mock', 'flake8', 'coveralls']},
+    extras_require={
+        'dev': ['nose', 'coverage', 'mock', 'flake8', 'coveralls', 'numpy'],
+        'numpy': ['numpy'],
+    },
+    python_requires='>=3.9',
     install_requires=['graphviz']
 )